@@ -0,0 +1,268 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+"""
+This module contains a compact, array-backed form of the DAG of a (large) Workflow. The links
+are stored as CSR (compressed sparse row) adjacency and reverse-adjacency arrays and the states
+of the FireWorks as int8 codes, so that root and leaf detection, the aggregation of the
+Workflow state and the readiness of children become vectorized NumPy operations instead of
+loops over Python dicts and lists.
+
+The Workflow switches to a CompactDAG automatically at WF_COMPACT_THRESHOLD FireWorks (see
+fw_config) if NumPy is installed.
+"""
+
+from bisect import bisect_left
+from itertools import chain
+
+try:
+    import numpy as np
+
+    NUMPY_INSTALLED = True
+except ImportError:
+    NUMPY_INSTALLED = False
+
+STATES = ('ARCHIVED', 'FIZZLED', 'DEFUSED', 'PAUSED', 'WAITING', 'READY', 'RESERVED', 'RUNNING',
+          'COMPLETED')
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+UNKNOWN_STATE = -1
+COMPLETED_CODE = STATE_CODES['COMPLETED']
+FINISHED_CODES = (STATE_CODES['COMPLETED'], STATE_CODES['FIZZLED'])
+
+
+class CompactDAG(object):
+    """
+    Array-backed snapshot of Workflow.Links, plus the states of the FireWorks. The links are
+    immutable: the Workflow builds a new CompactDAG whenever the Links change (see version),
+    while the states are kept in sync by Workflow.FWStates through set_state(). The counts of
+    the states and, for every FireWork, the number of parents that are not COMPLETED and of
+    those that are neither COMPLETED nor FIZZLED are counted with vectorized operations when
+    all states are set, and kept up to date by set_state(). That way neither the Workflow state
+    nor the readiness of a FireWork needs a scan.
+    """
+
+    def __init__(self, links, fw_states=None):
+        """
+        Args:
+            links (Workflow.Links): the links to take the DAG from
+            fw_states (dict): initial states of the FireWorks
+        """
+        self.links = links
+        self.version = links._version
+        self.ids = np.array(sorted(links.nodes), dtype=np.int64)
+        self._id_list = self.ids.tolist()  # for fast scalar lookups with bisect
+        n = len(self.ids)
+        # ids handed out by the LaunchPad are usually contiguous, then they map by an offset
+        self._offset = self._id_list[0] if n and self._id_list[-1] - self._id_list[0] == n - 1 \
+            else None
+
+        # adjacency (parent -> children), in the order of the links
+        self.out_degree = np.fromiter((len(links.get(fw_id, [])) for fw_id in self._id_list),
+                                      dtype=np.int64, count=n)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.out_degree, out=self.indptr[1:])
+        children = np.fromiter(chain.from_iterable(links.get(fw_id, []) for fw_id in
+                                                   self._id_list),
+                               dtype=np.int64, count=int(self.indptr[-1]))
+        self.indices = np.searchsorted(self.ids, children)
+
+        # reverse adjacency (child -> parents)
+        self.in_degree = np.bincount(self.indices, minlength=n).astype(np.int64)
+        self.rindptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.in_degree, out=self.rindptr[1:])
+        parents = np.repeat(np.arange(n, dtype=np.int64), self.out_degree)
+        self.rindices = parents[np.argsort(self.indices, kind='stable')]
+
+        self.is_leaf = self.out_degree == 0
+        self.n_leaves = int(np.count_nonzero(self.is_leaf))
+        self.codes = np.full(n, UNKNOWN_STATE, dtype=np.int8)
+        self.set_states(fw_states)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, fw_ids):
+        """
+        Map FireWork ids to their position in the arrays.
+
+        Args:
+            fw_ids (int or [int])
+
+        Returns:
+            int or array: the indices, -1 for ids that are not part of the DAG
+        """
+        if isinstance(fw_ids, int):
+            if self._offset is not None:
+                i = fw_ids - self._offset
+                return i if 0 <= i < len(self._id_list) else -1
+            i = bisect_left(self._id_list, fw_ids)
+            return i if i < len(self._id_list) and self._id_list[i] == fw_ids else -1
+        fw_ids = np.asarray(fw_ids, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.ids, fw_ids), max(len(self.ids) - 1, 0))
+        return np.where(self.ids[idx] == fw_ids, idx, -1)
+
+    def set_state(self, fw_id, state):
+        """
+        Args:
+            fw_id (int)
+            state (str): new state of the FireWork, None if unknown
+        """
+        i = self.index(fw_id)
+        if i < 0:
+            return
+        old_code = int(self.codes[i])
+        code = STATE_CODES.get(state, UNKNOWN_STATE)
+        self.codes[i] = code
+        self.state_counts[old_code - UNKNOWN_STATE] -= 1
+        self.state_counts[code - UNKNOWN_STATE] += 1
+        if self.is_leaf[i]:
+            self.completed_leaves += (code == COMPLETED_CODE) - (old_code == COMPLETED_CODE)
+        uncompleted_diff = (code != COMPLETED_CODE) - (old_code != COMPLETED_CODE)
+        unfinished_diff = (code not in FINISHED_CODES) - (old_code not in FINISHED_CODES)
+        if uncompleted_diff or unfinished_diff:
+            child_idx = self.indices[self.indptr[i]:self.indptr[i + 1]]
+            np.add.at(self.uncompleted_parents, child_idx, uncompleted_diff)
+            np.add.at(self.unfinished_parents, child_idx, unfinished_diff)
+
+    def set_states(self, fw_states):
+        """
+        Args:
+            fw_states (dict): mapping of FireWork ids to states
+        """
+        self.codes.fill(UNKNOWN_STATE)
+        if fw_states:
+            idx = self.index(list(fw_states.keys()))
+            codes = np.fromiter((STATE_CODES.get(s, UNKNOWN_STATE) for s in fw_states.values()),
+                                dtype=np.int8, count=len(fw_states))
+            known = idx >= 0
+            self.codes[idx[known]] = codes[known]
+
+        # the counts are indexed by code - UNKNOWN_STATE
+        self.state_counts = np.bincount(self.codes.astype(np.int64) - UNKNOWN_STATE,
+                                        minlength=len(STATES) - UNKNOWN_STATE).tolist()
+        self.completed_leaves = int(np.count_nonzero(self.codes[self.is_leaf] == COMPLETED_CODE))
+
+        # count the links whose parent is not completed or not finished, per child
+        uncompleted = self.codes != COMPLETED_CODE
+        unfinished = ~np.isin(self.codes, FINISHED_CODES)
+        self.uncompleted_parents = np.bincount(
+            self.indices[np.repeat(uncompleted, self.out_degree)],
+            minlength=len(self.ids)).astype(np.int64)
+        self.unfinished_parents = np.bincount(
+            self.indices[np.repeat(unfinished, self.out_degree)],
+            minlength=len(self.ids)).astype(np.int64)
+
+    @property
+    def root_ids(self):
+        """
+        Returns:
+            [int]: ids of the FireWorks without parents
+        """
+        return self.ids[self.in_degree == 0].tolist()
+
+    @property
+    def leaf_ids(self):
+        """
+        Returns:
+            [int]: ids of the FireWorks without children
+        """
+        return self.ids[self.is_leaf].tolist()
+
+    def _gather(self, indptr, indices, idx):
+        """
+        Internal method to concatenate the CSR rows of the given indices in one vectorized step.
+
+        Args:
+            indptr (array): row pointers of the adjacency or reverse adjacency
+            indices (array): column indices of the adjacency or reverse adjacency
+            idx (array): the rows to gather
+
+        Returns:
+            array: the concatenated columns
+        """
+        lens = indptr[idx + 1] - indptr[idx]
+        starts = np.cumsum(lens) - lens
+        offsets = np.repeat(indptr[idx] - starts, lens) + np.arange(int(lens.sum()),
+                                                                    dtype=np.int64)
+        return indices[offsets]
+
+    def get_state(self, allows_fizzled_parents):
+        """
+        Derive the Workflow state from the state counts, see Workflow.state. A FIZZLED FireWork
+        blocks the Workflow if it is a leaf or has a child that doesn't allow fizzled parents;
+        the FIZZLED FireWorks and their children are found with vectorized operations and only
+        the specs of these children are looked at.
+
+        Args:
+            allows_fizzled_parents (callable): maps a FireWork id to whether its spec allows
+                fizzled parents
+
+        Returns:
+            str: state of the Workflow
+        """
+        counts = self.state_counts[-UNKNOWN_STATE:]
+        if self.completed_leaves == self.n_leaves:
+            return 'COMPLETED'
+        if counts[STATE_CODES['ARCHIVED']] == len(self.ids):
+            return 'ARCHIVED'
+        if counts[STATE_CODES['DEFUSED']]:
+            return 'DEFUSED'
+        if counts[STATE_CODES['PAUSED']]:
+            return 'PAUSED'
+        if counts[STATE_CODES['FIZZLED']]:
+            fizzled = np.flatnonzero(self.codes == STATE_CODES['FIZZLED'])
+            if not self.out_degree[fizzled].all():  # a fizzled leaf
+                return 'FIZZLED'
+            child_idx = np.unique(self._gather(self.indptr, self.indices, fizzled))
+            if not all(allows_fizzled_parents(fw_id) for fw_id in self.ids[child_idx].tolist()):
+                return 'FIZZLED'
+            return 'RUNNING'
+        if counts[COMPLETED_CODE] or counts[STATE_CODES['RUNNING']]:
+            return 'RUNNING'
+        if counts[STATE_CODES['RESERVED']]:
+            return 'RESERVED'
+        return 'READY'
+
+    def parents_completed(self, fw_id, allow_fizzled=False):
+        """
+        Args:
+            fw_id (int)
+            allow_fizzled (bool): whether FIZZLED parents count as completed
+
+        Returns:
+            bool: whether all parents of the FireWork are completed
+        """
+        i = self.index(fw_id)
+        return not (self.unfinished_parents if allow_fizzled else self.uncompleted_parents)[i]
+
+    def parents_in_state(self, fw_id, state):
+        """
+        Args:
+            fw_id (int)
+            state (str)
+
+        Returns:
+            [int]: ids of the parents of the FireWork in the given state
+        """
+        i = self.index(fw_id)
+        parent_idx = self.rindices[self.rindptr[i]:self.rindptr[i + 1]]
+        return self.ids[parent_idx[self.codes[parent_idx] == STATE_CODES[state]]].tolist()
+
+    def children_to_refresh(self, fw_id):
+        """
+        Get the children of a FireWork that need a refresh after it finished. WAITING children
+        that still have a parent which is neither COMPLETED nor FIZZLED stay WAITING and are
+        skipped.
+
+        Args:
+            fw_id (int)
+
+        Returns:
+            [int]: ids of the children to refresh, in the order of the links
+        """
+        i = self.index(fw_id)
+        child_idx = self.indices[self.indptr[i]:self.indptr[i + 1]]
+        skip = (self.unfinished_parents[child_idx] > 0) & \
+            (self.codes[child_idx] == STATE_CODES['WAITING'])
+        return self.ids[child_idx[~skip]].tolist()
@@ -0,0 +1,421 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+"""
+This module contains the CompletionWriter, which completes the Launches of finished Rockets in a
+background thread and in batches (see ASYNC_COMPLETION in fw_config), so that rapidfire can start
+the next Rocket right away instead of waiting for the database. Every completion is appended to a
+local journal before it is handed over.
+
+Every journal has a lock file naming the host and pid of its writer, which the writer keeps
+touching while it is alive. The journal of a process that died before writing its completions is
+claimed and replayed by the next CompletionWriter or "lpad admin maintain" that sees it: right
+away on the same host, and from any host once the lock was not touched for
+COMPLETION_JOURNAL_EXPIRATION_SECS, e.g. after a job was killed at its walltime.
+"""
+
+import atexit
+import errno
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import ConnectionFailure
+
+from fireworks.core.firework import FWAction
+from fireworks.fw_config import COMPLETION_BATCH_SIZE, COMPLETION_FLUSH_SECS, \
+    COMPLETION_JOURNAL_DIR, COMPLETION_JOURNAL_EXPIRATION_SECS
+from fireworks.utilities.fw_serializers import DATETIME_HANDLER, reconstitute_dates
+from fireworks.utilities.fw_utilities import get_fw_logger
+
+_writers = {}  # id of the LaunchPad -> its CompletionWriter in this process
+_writers_lock = threading.Lock()
+
+
+def get_completion_writer(launchpad):
+    """
+    Get the CompletionWriter of a LaunchPad, starting it on first use in this process.
+
+    Args:
+        launchpad (LaunchPad)
+
+    Returns:
+        CompletionWriter
+    """
+    with _writers_lock:
+        writer = _writers.get(id(launchpad))
+        if writer is None or writer.pid != os.getpid():
+            writer = CompletionWriter(launchpad)
+            writer.start()
+            _writers[id(launchpad)] = writer
+        return writer
+
+
+def flush_completions(launchpad):
+    """
+    Write the pending completions of a LaunchPad now, if it has a CompletionWriter.
+
+    Args:
+        launchpad (LaunchPad)
+
+    Returns:
+        int: the number of completions written or dropped
+    """
+    writer = _writers.get(id(launchpad))
+    if writer is None or writer.pid != os.getpid():
+        return 0
+    return writer.flush()
+
+
+def replay_completion_journals(launchpad, journal_dir=None):
+    """
+    Replay the journals of the CompletionWriters that died before writing their completions,
+    e.g. from "lpad admin maintain".
+
+    Args:
+        launchpad (LaunchPad)
+        journal_dir (str): directory of the journals, see CompletionWriter
+
+    Returns:
+        int: the number of completions replayed
+    """
+    writer = CompletionWriter(launchpad, journal_dir=journal_dir)
+    if not os.path.isdir(writer.journal_dir):
+        return 0
+    try:
+        return writer.replay()
+    finally:
+        writer.close()
+
+
+@atexit.register
+def close_completion_writers():
+    """
+    Write the pending completions of all CompletionWriters of this process and stop them.
+    """
+    with _writers_lock:
+        writers = [w for w in _writers.values() if w.pid == os.getpid()]
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+class CompletionWriter(object):
+    """
+    Complete Launches in a background thread with LaunchPad.complete_launches(). Completions are
+    written once batch_size of them are pending, or flush_secs after the first one of a batch.
+    """
+
+    def __init__(self, launchpad, batch_size=None, flush_secs=None, journal_dir=None):
+        """
+        Args:
+            launchpad (LaunchPad)
+            batch_size (int): max number of completions written at once
+            flush_secs (float): max time a completion waits for its batch to fill up
+            journal_dir (str): directory of the journals, ~/.fireworks/journal if None
+        """
+        self.launchpad = launchpad
+        self.batch_size = batch_size if batch_size else COMPLETION_BATCH_SIZE
+        self.flush_secs = flush_secs if flush_secs is not None else COMPLETION_FLUSH_SECS
+        self.journal_dir = journal_dir or COMPLETION_JOURNAL_DIR or \
+            os.path.join(os.path.expanduser('~'), '.fireworks', 'journal')
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self.journal_name = 'completions_{}_{}'.format(self.host, self.pid)
+        self.journal_path = os.path.join(self.journal_dir, self.journal_name + '.json')
+        self.lock_path = os.path.join(self.journal_dir, self.journal_name + '.lock')
+        self.lock_refresh_secs = COMPLETION_JOURNAL_EXPIRATION_SECS / 10.0
+        self.logger = get_fw_logger('rocket.completions', l_dir=launchpad.get_logdir())
+        self.metrics = {'completions': 0, 'batches': 0, 'errors': 0, 'dropped': 0,
+                        'replayed': 0}
+
+        self._pending = []  # (launch_id, action, state, completed_on) tuples not written yet
+        self._cond = threading.Condition()  # guards _pending and the journal
+        self._write_lock = threading.Lock()  # one batch is written at a time
+        self._closed = False
+        self._thread = None
+        self._lock_refreshed_on = None
+
+    def start(self):
+        """
+        Replay the journals of dead processes, then start the background thread.
+        """
+        try:
+            os.makedirs(self.journal_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.replay()
+        self._thread = threading.Thread(target=self._run, name='CompletionWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, launch_id, action, state):
+        """
+        Journal the completion of a Launch and queue it to be written.
+
+        Args:
+            launch_id (int)
+            action (FWAction): the FWAction of what to do next
+            state (str): COMPLETED or FIZZLED
+        """
+        completion = (launch_id, action, state, datetime.utcnow())
+        with self._cond:
+            if self._closed:
+                raise ValueError('The CompletionWriter is closed!')
+            self._append_journal(self._to_entry(completion))
+            self._pending.append(completion)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        Write all pending completions now.
+
+        Returns:
+            int: the number of completions written or dropped
+        """
+        n_written = 0
+        while True:
+            n = self._write_batch()
+            if not n:
+                return n_written
+            n_written += n
+
+    def close(self):
+        """
+        Write all pending completions and stop the background thread. Completions that cannot be
+        written stay in the journal and are replayed later.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        with self._cond:
+            if not self._pending:
+                for path in (self.journal_path, self.lock_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        self.logger.debug(self.get_summary())
+
+    def pending(self):
+        """
+        Returns:
+            int: the number of completions not written yet
+        """
+        with self._cond:
+            return len(self._pending)
+
+    def get_summary(self):
+        """
+        Returns:
+            str: a summary of the metrics of the writer
+        """
+        return 'Wrote {} completions in {} batches ({} errors, {} dropped, {} replayed)'.format(
+            self.metrics['completions'], self.metrics['batches'], self.metrics['errors'],
+            self.metrics['dropped'], self.metrics['replayed'])
+
+    def replay(self):
+        """
+        Claim and write the journals of dead processes: of the processes on this host that are
+        not alive anymore, and of the processes on any host whose lock was not touched for
+        COMPLETION_JOURNAL_EXPIRATION_SECS.
+
+        Returns:
+            int: the number of completions replayed
+        """
+        self._refresh_lock()
+        n_replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, 'completions_*.json'))):
+            name = os.path.basename(path)[:-len('.json')]
+            # a claimed journal is named after its claimer, followed by '+' and its former name
+            owner = name.split('+')[0]
+            if path == self.journal_path or (owner != self.journal_name and
+                                             not self._is_abandoned(owner)):
+                continue
+            if owner != self.journal_name:
+                # claim the journal, so that it is replayed by a single process
+                claimed_path = os.path.join(self.journal_dir,
+                                            '{}+{}.json'.format(self.journal_name, name))
+                try:
+                    os.rename(path, claimed_path)
+                except OSError:
+                    continue  # claimed by someone else
+                path = claimed_path
+            completions = self._read_journal(path)
+            if completions:
+                self.logger.info('Replaying {} completions of {}'.format(len(completions), name))
+                try:
+                    self.launchpad.complete_launches(completions)
+                except ConnectionFailure:
+                    # keep the claimed journal, it is retried by the next replay
+                    self.metrics['errors'] += 1
+                    self.logger.exception('Could not replay the completions of {}!'.format(name))
+                    break
+                except Exception:
+                    self.metrics['errors'] += 1
+                    self.metrics['dropped'] += len(completions)
+                    self.logger.exception('Could not replay the completions of {}, dropping '
+                                          'them!'.format(name))
+                else:
+                    n_replayed += len(completions)
+            os.remove(path)
+        # forget the locks of the dead processes whose journals were all replayed
+        owners = set(os.path.basename(path)[:-len('.json')].split('+')[0] for path in
+                     glob.glob(os.path.join(self.journal_dir, 'completions_*.json')))
+        for path in glob.glob(os.path.join(self.journal_dir, 'completions_*.lock')):
+            owner = os.path.basename(path)[:-len('.lock')]
+            if owner != self.journal_name and owner not in owners and self._is_abandoned(owner):
+                _remove(path)
+        self.metrics['replayed'] += n_replayed
+        return n_replayed
+
+    def _is_abandoned(self, journal_name):
+        """
+        Args:
+            journal_name (str): name of the journal of a writer, without extension
+
+        Returns:
+            bool: True if the writer of the journal is dead
+        """
+        lock_path = os.path.join(self.journal_dir, journal_name + '.lock')
+        try:
+            with open(lock_path) as f:
+                lock = json.load(f)
+            touched_on = os.path.getmtime(lock_path)
+        except (IOError, OSError, ValueError):
+            return True  # the writer died before or while locking its journal
+        if lock.get('host') == self.host and not _pid_exists(lock.get('pid')):
+            return True
+        return time.time() - touched_on > COMPLETION_JOURNAL_EXPIRATION_SECS
+
+    def _refresh_lock(self):
+        """
+        Create the lock file of the journal, or touch it to show that this writer is alive.
+        """
+        if self._lock_refreshed_on is None or not os.path.exists(self.lock_path):
+            with open(self.lock_path, 'w') as f:
+                json.dump({'host': self.host, 'pid': self.pid}, f)
+        else:
+            os.utime(self.lock_path, None)
+        self._lock_refreshed_on = time.time()
+
+    def _keep_lock(self):
+        if time.time() - self._lock_refreshed_on >= self.lock_refresh_secs:
+            self._refresh_lock()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait(self.lock_refresh_secs)
+                    self._keep_lock()
+                if self._closed:
+                    return
+                deadline = time.time() + self.flush_secs
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if not self._write_batch() and self.pending():
+                time.sleep(self.flush_secs)  # the database is not available, retry later
+            self._keep_lock()
+
+    def _write_batch(self):
+        """
+        Write up to batch_size pending completions. If the database cannot be reached, the batch
+        stays pending and is retried later. A batch that fails for any other reason would fail
+        the same way again and hold up all later completions, so it is logged and dropped.
+
+        Returns:
+            int: the number of completions written or dropped
+        """
+        with self._write_lock:
+            with self._cond:
+                batch = self._pending[:self.batch_size]
+            if not batch:
+                return 0
+            try:
+                self.launchpad.complete_launches(batch)
+            except ConnectionFailure:
+                self.metrics['errors'] += 1
+                self.logger.exception('Could not write {} completions, will retry!'.format(
+                    len(batch)))
+                return 0
+            except Exception:
+                self.metrics['errors'] += 1
+                self.metrics['dropped'] += len(batch)
+                self.logger.exception('Could not write {} completions, dropping them!'.format(
+                    len(batch)))
+            else:
+                self.metrics['completions'] += len(batch)
+                self.metrics['batches'] += 1
+            with self._cond:
+                del self._pending[:len(batch)]
+                if self._pending:
+                    self._append_journal({'done': [c[0] for c in batch]})
+                else:
+                    open(self.journal_path, 'w').close()  # everything was written
+            return len(batch)
+
+    def _append_journal(self, entry):
+        if self._lock_refreshed_on is None:
+            self._refresh_lock()
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry, default=DATETIME_HANDLER) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _to_entry(completion):
+        launch_id, action, state, completed_on = completion
+        return {'launch_id': launch_id, 'action': action.to_dict() if action else None,
+                'state': state, 'completed_on': completed_on}
+
+    @staticmethod
+    def _read_journal(path):
+        """
+        Returns:
+            [tuple]: the journaled completions that were not written
+        """
+        completions = {}
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # the process died while writing this line
+                if 'done' in entry:
+                    for launch_id in entry['done']:
+                        completions.pop(launch_id, None)
+                else:
+                    action = FWAction.from_dict(entry['action']) if entry['action'] else None
+                    completions[entry['launch_id']] = (
+                        entry['launch_id'], action, entry['state'],
+                        reconstitute_dates(entry['completed_on']))
+        return sorted(completions.values(), key=lambda c: c[3])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # removed by someone else meanwhile
+
+
+def _pid_exists(pid):
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
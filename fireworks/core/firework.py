@@ -15,22 +15,29 @@ This module contains some of the most central FireWorks classes:
         a job completes.
 """
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict, Counter
 import abc
 from datetime import datetime
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+import heapq
 import os
 import pprint
 
-from monty.io import reverse_readline, zopen
+from monty.io import zopen
 from monty.os.path import zpath
 
 from six import add_metaclass
 
-from fireworks.fw_config import TRACKER_LINES, NEGATIVE_FWID_CTR, EXCEPT_DETAILS_ON_RERUN
+from fireworks.fw_config import TRACKER_LINES, NEGATIVE_FWID_CTR, EXCEPT_DETAILS_ON_RERUN, \
+    WF_COMPACT_THRESHOLD
+from fireworks.core.compact_dag import CompactDAG, NUMPY_INSTALLED
 from fireworks.core.fworker import FWorker
 from fireworks.utilities.dict_mods import apply_mod, dict_select, dict_inject
 from fireworks.utilities.fw_serializers import FWSerializable, recursive_serialize, \
-    recursive_deserialize, serialize_fw
+    recursive_deserialize, serialize_fw, reconstitute_dates
 from fireworks.utilities.fw_utilities import get_my_host, get_my_ip, NestedClassGetter
 
 __author__ = "Anubhav Jain"
@@ -286,6 +293,7 @@ class Firework(FWSerializable):
         self.parents = parents if parents else []
 
         self._state = state
+        self._db_dict = None  # the document stored in the database, if known
 
     @property
     def state(self):
@@ -360,8 +368,40 @@ class Firework(FWSerializable):
         # the archived launches are stored separately
         m_dict['archived_launches'] = [l.launch_id for l in self.archived_launches]
         m_dict['state'] = self.state
+        # the spec keys FWorkers select on, with explicit defaults (see FWorker.query)
+        m_dict['_fworker'] = self.spec.get('_fworker')
+        m_dict['_category'] = self.spec.get('_category')
         return m_dict
 
+    def _set_db_dict(self, db_dict):
+        """
+        Internal method to remember the document of this Firework in the database, so that
+        _get_db_changes() can compute the fields that changed since.
+
+        Args:
+            db_dict (dict): the stored document, None if unknown
+        """
+        self._db_dict = db_dict
+
+    def _get_db_changes(self, m_dict=None):
+        """
+        Internal method to compare the Firework with its document in the database.
+
+        Args:
+            m_dict (dict): the current to_db_dict(), computed if not given
+
+        Returns:
+            (dict, [str]): fields to $set and fields to $unset, None if the stored document is
+                unknown
+        """
+        if self._db_dict is None:
+            return None
+        m_dict = m_dict if m_dict is not None else self.to_db_dict()
+        to_set = {k: v for k, v in m_dict.items()
+                  if k not in self._db_dict or self._db_dict[k] != v}
+        to_unset = [k for k in self._db_dict if k not in m_dict and k != '_id']
+        return to_set, to_unset
+
     @classmethod
     @recursive_deserialize
     def from_dict(cls, m_dict):
@@ -383,9 +423,13 @@ class Firework(FWSerializable):
 class Tracker(FWSerializable, object):
     """
     A Tracker monitors a file and returns the last N lines for updating the Launch object.
+
+    The Tracker remembers how far it has read the file, so that repeated calls of track_file()
+    (e.g. on every ping of a running Launch) only read the bytes appended since the last call.
     """
 
     MAX_TRACKER_LINES = 1000
+    BLOCK_SIZE = 4096
 
     def __init__(self, filename, nlines=TRACKER_LINES, content='', allow_zipped=False):
         """
@@ -402,6 +446,19 @@ class Tracker(FWSerializable, object):
         self.nlines = nlines
         self.content = content
         self.allow_zipped = allow_zipped
+        self._reset(None)
+
+    def _reset(self, file_id):
+        """
+        Forget the read position, e.g. when the tracked file changed or was truncated.
+
+        Args:
+            file_id (tuple): path and inode of the tracked file
+        """
+        self._file = file_id
+        self._offset = 0  # position right after the last complete line read
+        self._lines = deque(maxlen=self.nlines)
+        self._partial = b''  # trailing bytes not terminated by a newline yet
 
     def track_file(self, launch_dir=None):
         """
@@ -416,18 +473,73 @@ class Tracker(FWSerializable, object):
         m_file = self.filename
         if launch_dir and not os.path.isabs(self.filename):
             m_file = os.path.join(launch_dir, m_file)
-        lines = []
         if self.allow_zipped:
-            m_file = zpath(m_file)
-        if os.path.exists(m_file):
-            with zopen(m_file, "rt", errors='surrogateescape') as f:
-                for l in reverse_readline(f):
-                    lines.append(l)
-                    if len(lines) == self.nlines:
-                        break
-            self.content = '\n'.join(reversed(lines))
+            zipped_file = zpath(m_file)
+            if zipped_file != m_file:
+                # compressed files cannot be read from an offset, read them completely
+                if os.path.exists(zipped_file):
+                    with zopen(zipped_file, "rt", errors='surrogateescape') as f:
+                        lines = deque((l.rstrip('\r\n') for l in f), maxlen=self.nlines)
+                    self.content = '\n'.join(lines)
+                return self.content
+        if not os.path.exists(m_file):
+            return self.content
+
+        stat = os.stat(m_file)
+        size = stat.st_size
+        if (m_file, stat.st_ino) != self._file or size < self._offset + len(self._partial):
+            # new, replaced or truncated file
+            self._reset((m_file, stat.st_ino))
+        with open(m_file, 'rb') as f:
+            if self._offset == 0 and not self._lines:
+                data = self._read_tail(f, size)
+            else:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+        end = data.rfind(b'\n') + 1
+        if end:
+            self._lines.extend(self._decode(l) for l in data[:end - 1].split(b'\n'))
+        self._offset += end
+        self._partial = data[end:]
+
+        lines = list(self._lines)
+        if self._partial:
+            lines = lines[1:] if len(lines) == self.nlines else lines
+            lines.append(self._decode(self._partial))
+        self.content = '\n'.join(lines)
         return self.content
 
+    def _read_tail(self, f, size):
+        """
+        Read just enough blocks from the end of the file to get the last N lines, and move the
+        read position to the first of them.
+
+        Args:
+            f (file): the tracked file, opened in binary mode
+            size (int): size of the file
+
+        Returns:
+            bytes: the end of the file, starting at the beginning of a line
+        """
+        start = size
+        data = b''
+        while start > 0 and data.count(b'\n') <= self.nlines:
+            step = min(self.BLOCK_SIZE, start)
+            start -= step
+            f.seek(start)
+            data = f.read(step) + data
+        if start > 0:
+            # drop the (possibly incomplete) first line
+            skip = data.index(b'\n') + 1
+            start += skip
+            data = data[skip:]
+        self._offset = start
+        return data
+
+    @staticmethod
+    def _decode(line):
+        return line.decode('utf-8', 'surrogateescape').rstrip('\r')
+
     def to_dict(self):
         m_dict = {'filename': self.filename, 'nlines': self.nlines, 'allow_zipped': self.allow_zipped}
         if self.content:
@@ -552,6 +664,17 @@ class Launch(FWSerializable, object):
         """
         return self._get_time('RUNNING', True)
 
+    @property
+    def state_updated_on(self):
+        """
+        Returns:
+            datetime: the time of the last state change or ping of the Launch
+        """
+        if self.state_history:
+            last = self.state_history[-1]
+            # pings from offline runs may carry the time as a string
+            return reconstitute_dates(last.get('updated_on') or last.get('created_on'))
+
     @property
     def runtime_secs(self):
         """
@@ -587,8 +710,15 @@ class Launch(FWSerializable, object):
                 'state_history': self.state_history,
                 'launch_id': self.launch_id}
 
-    @recursive_serialize
     def to_db_dict(self):
+        m_d = self._to_db_dict()
+        # stored as a native datetime (not serialized to a string like the other dates) so that
+        # lost runs and stale reservations can be found with an indexed range query
+        m_d['state_updated_on'] = self.state_updated_on
+        return m_d
+
+    @recursive_serialize
+    def _to_db_dict(self):
         m_d = self.to_dict()
         m_d['time_start'] = self.time_start
         m_d['time_end'] = self.time_end
@@ -648,6 +778,28 @@ class Launch(FWSerializable, object):
                 return data['created_on']
 
 
+class _ParentLinksView(Mapping):
+    """
+    Read-only view of the reverse links of Workflow.Links, which must only be changed through
+    the Links themselves.
+    """
+
+    def __init__(self, parent_links):
+        self._parent_links = parent_links
+
+    def __getitem__(self, key):
+        return list(self._parent_links[key])
+
+    def __iter__(self):
+        return iter(self._parent_links)
+
+    def __len__(self):
+        return len(self._parent_links)
+
+    def __repr__(self):
+        return repr(self._parent_links)
+
+
 class Workflow(FWSerializable):
     """
     A Workflow connects a group of FireWorks in an execution order.
@@ -656,6 +808,11 @@ class Workflow(FWSerializable):
     class Links(dict, FWSerializable):
         """
         An inner class for storing the DAG links between FireWorks
+
+        The reverse links (child -> parents) and the set of nodes are kept up to date whenever
+        links are set or deleted. Always assign a new list of children, e.g.
+        links[fw_id] = links[fw_id] + [child_id], rather than modifying the list in place,
+        otherwise the reverse links get out of sync.
         """
 
         def __init__(self, *args, **kwargs):
@@ -663,41 +820,116 @@ class Workflow(FWSerializable):
 
             for k, v in list(self.items()):
                 if not isinstance(v, (list, tuple)):
-                    self[k] = [v]  # v must be list
+                    dict.__setitem__(self, k, [v])  # v must be list
 
-                self[k] = [x.fw_id if hasattr(x, "fw_id") else x for x in self[k]]
+                dict.__setitem__(self, k, [x.fw_id if hasattr(x, "fw_id") else x
+                                           for x in self[k]])
 
                 if not isinstance(k, int):
                     if hasattr(k, "fw_id"):  # maybe it's a String?
-                        self[k.fw_id] = self[k]
+                        dict.__setitem__(self, k.fw_id, self[k])
                     else:  # maybe it's a String?
                         try:
-                            self[int(k)] = self[k]  # k must be int
+                            dict.__setitem__(self, int(k), self[k])  # k must be int
                         except Exception:
                             pass  # garbage input
-                    del self[k]
+                    dict.__delitem__(self, k)
+
+            self._parent_links = {}
+            self._nodes = set(self.keys())
+            self._nodes_tuple = None
+            self._leaves = set(k for k, v in self.items() if not v)
+            self._version = 0  # incremented on every change of the links
+            for parent, children in self.items():
+                self._link(parent, children)
+
+        def _link(self, parent, children):
+            for child in children:
+                self._parent_links.setdefault(child, []).append(parent)
+                self._nodes.add(child)
+            self._nodes_tuple = None
+
+        def _unlink(self, parent, children):
+            for child in children:
+                parents = self._parent_links[child]
+                parents.remove(parent)
+                if not parents:
+                    del self._parent_links[child]
+                    if child not in self:
+                        self._nodes.discard(child)
+            self._nodes_tuple = None
+
+        def __setitem__(self, key, value):
+            old_value = self.get(key, [])
+            super(Workflow.Links, self).__setitem__(key, value)
+            self._nodes.add(key)
+            if value:
+                self._leaves.discard(key)
+            else:
+                self._leaves.add(key)
+            self._version += 1
+            # only touch the links that changed, so that the order of parents stays stable
+            removed = Counter(old_value)
+            added = []
+            for child in value:
+                if removed[child] > 0:
+                    removed[child] -= 1
+                else:
+                    added.append(child)
+            self._unlink(key, list(removed.elements()))
+            self._link(key, added)
+
+        def __delitem__(self, key):
+            self._unlink(key, self[key])
+            super(Workflow.Links, self).__delitem__(key)
+            if key not in self._parent_links:
+                self._nodes.discard(key)
+            self._nodes_tuple = None
+            self._leaves.discard(key)
+            self._version += 1
+
+        def update(self, *args, **kwargs):
+            for k, v in dict(*args, **kwargs).items():
+                self[k] = v
+
+        def setdefault(self, key, default=None):
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+        def pop(self, key, *default):
+            if key not in self:
+                return super(Workflow.Links, self).pop(key, *default)
+            value = self[key]
+            del self[key]
+            return value
+
+        def popitem(self):
+            key = next(reversed(list(self.keys())))
+            return key, self.pop(key)
+
+        def clear(self):
+            super(Workflow.Links, self).clear()
+            self._parent_links = {}
+            self._nodes = set()
+            self._nodes_tuple = None
+            self._leaves = set()
+            self._version += 1
 
         @property
         def nodes(self):
-            """ Return list of all nodes"""
-            allnodes = list(self.keys())
-            for v in self.values():
-                allnodes.extend(v)
-            return list(set(allnodes))
+            """ Return tuple of all nodes"""
+            if self._nodes_tuple is None:
+                self._nodes_tuple = tuple(self._nodes)
+            return self._nodes_tuple
 
         @property
         def parent_links(self):
             """
-            Return a dict of child and its parents.
-
-            Note: if performance of parent_links becomes an issue, override delitem/setitem to
-            update parent_links
+            Return a read-only mapping of child and its parents. The parents are returned as a new
+            list on every lookup.
             """
-            child_parents = defaultdict(list)
-            for (parent, children) in self.items():
-                for child in children:
-                    child_parents[child].append(parent)
-            return dict(child_parents)
+            return _ParentLinksView(self._parent_links)
 
         def to_dict(self):
             """
@@ -718,7 +950,7 @@ class Workflow(FWSerializable):
             m_dict = {
                 'links': dict([(str(k), v) for (k, v) in self.items()]),
                 'parent_links': dict([(str(k), v) for (k, v) in self.parent_links.items()]),
-                'nodes': self.nodes}
+                'nodes': list(self.nodes)}
             return m_dict
 
         @classmethod
@@ -738,6 +970,92 @@ class Workflow(FWSerializable):
             state = list(self.items())
             return NestedClassGetter(), (Workflow, self.__class__.__name__,), state
 
+    class FWStates(dict):
+        """
+        An inner class for storing the states of the FireWorks in a Workflow. Keeps count of the
+        states of all FireWorks and of the leaf FireWorks, and remembers which FireWorks changed
+        state, so that the Workflow state can be derived without scanning all FireWorks.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super(Workflow.FWStates, self).__init__(*args, **kwargs)
+            self.counts = Counter(self.values())
+            self.changed = set(self.keys())  # fw_ids whose state changed since the last check
+            self.unsaved = set(self.keys())  # fw_ids whose state changed since the last save
+            self.leaf_ids = set()
+            self.leaf_counts = Counter()
+            self.links = None  # the Links the leaf_ids were taken from
+            self.links_version = None
+            self.dag = None  # the CompactDAG whose state codes are kept in sync, if any
+
+        def set_leaves(self, links):
+            """
+            Take the leaf FireWorks from the given links and recount their states.
+
+            Args:
+                links (Workflow.Links)
+            """
+            self.leaf_ids = links._leaves
+            self.leaf_counts = Counter(self.get(fw_id) for fw_id in self.leaf_ids)
+            self.links = links
+            self.links_version = links._version
+
+        def leaves_outdated(self, links):
+            """
+            Args:
+                links (Workflow.Links)
+
+            Returns:
+                bool: whether the links changed since set_leaves() was called
+            """
+            return self.links is not links or self.links_version != links._version
+
+        def __setitem__(self, key, value):
+            if key in self:
+                old_value = self[key]
+                if old_value == value:
+                    return
+                self.counts[old_value] -= 1
+                if key in self.leaf_ids:
+                    self.leaf_counts[old_value] -= 1
+            elif key in self.leaf_ids:
+                self.leaf_counts[None] -= 1
+            super(Workflow.FWStates, self).__setitem__(key, value)
+            self.counts[value] += 1
+            if key in self.leaf_ids:
+                self.leaf_counts[value] += 1
+            self.changed.add(key)
+            self.unsaved.add(key)
+            if self.dag is not None:
+                self.dag.set_state(key, value)
+
+        def __delitem__(self, key):
+            old_value = self[key]
+            super(Workflow.FWStates, self).__delitem__(key)
+            self.counts[old_value] -= 1
+            if key in self.leaf_ids:
+                self.leaf_counts[old_value] -= 1
+                self.leaf_counts[None] += 1
+            self.changed.add(key)
+            self.unsaved.add(key)
+            if self.dag is not None:
+                self.dag.set_state(key, None)
+
+        def update(self, *args, **kwargs):
+            for k, v in dict(*args, **kwargs).items():
+                self[k] = v
+
+        def __setstate__(self, state):
+            for k, v in state:
+                self[k] = v
+
+        def __reduce__(self):
+            """
+            To support Pickling of inner classes, see Links.__reduce__()
+            """
+            state = list(self.items())
+            return NestedClassGetter(), (Workflow, self.__class__.__name__,), state
+
     def __init__(self, fireworks, links_dict=None, name=None, metadata=None, created_on=None,
                  updated_on=None, fw_states=None):
         """
@@ -766,15 +1084,23 @@ class Workflow(FWSerializable):
 
         self.links = Workflow.Links(links_dict)
 
-        # add depends on
+        # add depends on, setting the children of each parent only once
+        new_children = OrderedDict()
         for fw in fireworks:
             for pfw in fw.parents:
                 if pfw.fw_id not in self.links:
                     raise ValueError(
                         "FW_id: {} defines a dependent link to FW_id: {}, but the latter was not "
                         "added to the workflow!".format(fw.fw_id, pfw.fw_id))
-                if fw.fw_id not in self.links[pfw.fw_id]:
-                    self.links[pfw.fw_id].append(fw.fw_id)
+                new_children.setdefault(pfw.fw_id, []).append(fw.fw_id)
+        for parent_id, child_ids in new_children.items():
+            children = list(self.links[parent_id])
+            known = set(children)
+            for child_id in child_ids:
+                if child_id not in known:
+                    children.append(child_id)
+                    known.add(child_id)
+            self.links[parent_id] = children
 
         self.name = name
 
@@ -797,6 +1123,10 @@ class Workflow(FWSerializable):
         else:
             self.fw_states = {key: self.id_fw[key].state for key in self.id_fw}
 
+        self._saved_links = None  # the Links and their version as stored in the database
+        self._db_version = None  # version of the Workflow document this Workflow was loaded from
+        self._topological_ranks = None  # the Links, their version, the start id and its ranks
+
     @property
     def fws(self):
         """
@@ -804,45 +1134,100 @@ class Workflow(FWSerializable):
         """
         return list(self.id_fw.values())
 
+    @property
+    def fw_states(self):
+        """
+        Returns:
+            Workflow.FWStates: mapping of an id to a firework state
+        """
+        return self._fw_states
+
+    @fw_states.setter
+    def fw_states(self, fw_states):
+        self._fw_states = Workflow.FWStates(fw_states)
+        self._blocking_fizzled_ids = set()
+
+    def _get_compact_dag(self):
+        """
+        Internal method to get the array-backed form of the DAG, which is (re)built when the links
+        changed and keeps its state codes in sync with fw_states.
+
+        Returns:
+            CompactDAG: None if the workflow is below WF_COMPACT_THRESHOLD or NumPy is missing
+        """
+        dag = self.fw_states.dag
+        if dag is not None and dag.links is self.links and dag.version == self.links._version:
+            return dag
+        if not NUMPY_INSTALLED or WF_COMPACT_THRESHOLD is None or \
+                len(self.links) < WF_COMPACT_THRESHOLD:
+            return None
+        dag = CompactDAG(self.links, self.fw_states)
+        self.fw_states.dag = dag
+        return dag
+
     @property
     def state(self):
         """
+        The state is derived from the state counts kept by fw_states. Only the FIZZLED FireWorks
+        that changed state since the last call (or all of them, if the links changed) are checked
+        for children that don't allow fizzled parents. Above WF_COMPACT_THRESHOLD FireWorks the
+        state is derived from the CompactDAG instead.
+
         Returns:
             state (str): state of workflow
         """
+        fw_states = self.fw_states
+        dag = self._get_compact_dag()
+        if dag is not None:
+            # the bookkeeping of the dict-based checks below is not kept up to date meanwhile
+            fw_states.changed.clear()
+            fw_states.links = None
+            return dag.get_state(
+                lambda fw_id: self.id_fw[fw_id].spec.get('_allow_fizzled_parents', False))
+
         m_state = 'READY'
-        # states = [fw.state for fw in self.fws]
-        states = self.fw_states.values()
-        leaf_fw_ids = self.leaf_fw_ids  # to save recalculating this
+        counts = fw_states.counts
 
-        leaf_states = (self.fw_states[fw_id] for fw_id in leaf_fw_ids)
-        if all(s == 'COMPLETED' for s in leaf_states):
+        if fw_states.leaves_outdated(self.links):
+            fw_states.set_leaves(self.links)
+            fw_states.changed.update(fw_id for fw_id, s in fw_states.items() if s == 'FIZZLED')
+            self._blocking_fizzled_ids = set()
+
+        if fw_states.leaf_counts['COMPLETED'] == len(fw_states.leaf_ids):
             m_state = 'COMPLETED'
-        elif all(s == 'ARCHIVED' for s in states):
+        elif counts['ARCHIVED'] == len(fw_states):
             m_state = 'ARCHIVED'
-        elif any(s == 'DEFUSED' for s in states):
+        elif counts['DEFUSED']:
             m_state = 'DEFUSED'
-        elif any(s == 'PAUSED' for s in states):
+        elif counts['PAUSED']:
             m_state = 'PAUSED'
-        elif any(s == 'FIZZLED' for s in states):
-            fizzled_ids = (fw_id for fw_id, state in self.fw_states.items()
-                           if state == 'FIZZLED')
-            for fizzled_id in fizzled_ids:
-                # If a fizzled fw is a leaf fw, then the workflow is fizzled
-                if (fizzled_id in leaf_fw_ids or
-                        # Otherwise all children must be ok with the fizzled parent
-                        not all(self.id_fw[child_id].spec.get('_allow_fizzled_parents', False)
-                                for child_id in self.links[fizzled_id])):
-                    m_state = 'FIZZLED'
-                    break
-            else:
-                m_state = 'RUNNING'
-        elif any(s == 'COMPLETED' for s in states) or any(s == 'RUNNING' for s in states):
+        elif counts['FIZZLED']:
+            self._update_blocking_fizzled_ids()
+            m_state = 'FIZZLED' if self._blocking_fizzled_ids else 'RUNNING'
+        elif counts['COMPLETED'] or counts['RUNNING']:
             m_state = 'RUNNING'
-        elif any(s == 'RESERVED' for s in states):
+        elif counts['RESERVED']:
             m_state = 'RESERVED'
         return m_state
 
+    def _update_blocking_fizzled_ids(self):
+        """
+        Internal method to re-check the FireWorks that changed state for being FIZZLED and
+        blocking the workflow, i.e. being a leaf or having children that don't allow fizzled
+        parents.
+        """
+        for fw_id in self.fw_states.changed:
+            if self.fw_states.get(fw_id) == 'FIZZLED' and (
+                    # If a fizzled fw is a leaf fw, then the workflow is fizzled
+                    fw_id in self.links._leaves or
+                    # Otherwise all children must be ok with the fizzled parent
+                    not all(self.id_fw[child_id].spec.get('_allow_fizzled_parents', False)
+                            for child_id in self.links.get(fw_id, []))):
+                self._blocking_fizzled_ids.add(fw_id)
+            else:
+                self._blocking_fizzled_ids.discard(fw_id)
+        self.fw_states.changed.clear()
+
     def apply_action(self, action, fw_id):
         """
         Apply a FWAction on a Firework in the Workflow.
@@ -936,6 +1321,10 @@ class Workflow(FWSerializable):
                     apply_mod(mod, self.id_fw[cfid].spec)
                 updated_ids.append(cfid)  # seems to me the indentation had been wrong here
 
+        # the new specs may change _allow_fizzled_parents, re-check the parents of the updated children
+        for cfid in updated_ids:
+            self.fw_states.changed.update(self.links.parent_links.get(cfid, []))
+
         # defuse children
         if action.defuse_children:
             for cfid in self.links[fw_id]:
@@ -1011,19 +1400,18 @@ class Workflow(FWSerializable):
             [int]: list of Firework ids that were updated
         """
 
-        updated_ids = updated_ids if updated_ids else set()
-        m_fw = self.id_fw[fw_id]
-        m_fw._rerun()
-        updated_ids.add(fw_id)
+        updated_ids = updated_ids if updated_ids is not None else set()
 
-        # refresh the states of the current fw before rerunning the children
-        # so that they get the correct state of the parent.
-        updated_ids.union(self.refresh(fw_id, updated_ids))
+        def children_to_rerun(m_fw_id):
+            return [child_id for child_id in self.links[m_fw_id]
+                    if self.id_fw[child_id].state != 'WAITING']
 
-        # re-run all the children
-        for child_id in self.links[fw_id]:
-            if self.id_fw[child_id].state != 'WAITING':
-                updated_ids = updated_ids.union(self.rerun_fw(child_id, updated_ids))
+        # rerun in topological order, so that every firework is refreshed after its parents and
+        # gets their correct state
+        for m_fw_id in self._walk_topologically(fw_id, children_to_rerun):
+            self.id_fw[m_fw_id]._rerun()
+            updated_ids.add(m_fw_id)
+            self.refresh(m_fw_id, updated_ids)
 
         return updated_ids
 
@@ -1136,7 +1524,7 @@ class Workflow(FWSerializable):
 
         for fw_id in fw_ids:
             for root_id in root_ids:
-                self.links[fw_id].append(root_id)  # add the root id as my child
+                self.links[fw_id] = self.links[fw_id] + [root_id]  # add the root id as my child
                 if pull_spec_mods:  # re-apply some actions of the parent
                     m_fw = self.id_fw[fw_id]  # get the parent FW
                     m_launch = self._get_representative_launch(m_fw)  # get Launch of parent
@@ -1169,35 +1557,59 @@ class Workflow(FWSerializable):
 
     def refresh(self, fw_id, updated_ids=None):
         """
-        Refreshes the state of a Firework and any affected children.
+        Refreshes the state of a Firework and any affected children. Every affected Firework is
+        refreshed once, after all of its parents.
 
         Args:
             fw_id (int): id of the Firework on which to perform the refresh
-            updated_ids ([int])
+            updated_ids (set(int)): set of Firework ids that were updated, extended in place
 
         Returns:
             set(int): list of Firework ids that were updated
         """
         # these are the fw_ids to re-enter into the database
-        updated_ids = updated_ids if updated_ids else set()
+        updated_ids = updated_ids if updated_ids is not None else set()
+
+        next_ids = {}  # the children to refresh after each Firework
+        for m_fw_id in self._walk_topologically(fw_id, next_ids.pop):
+            next_ids[m_fw_id] = self._refresh_fw(m_fw_id, updated_ids)
+
+        return updated_ids
 
+    def _refresh_fw(self, fw_id, updated_ids):
+        """
+        Internal method to refresh the state of a single Firework.
+
+        Args:
+            fw_id (int): id of the Firework on which to perform the refresh
+            updated_ids (set(int)): set of Firework ids that were updated, extended in place
+
+        Returns:
+            [int]: ids of the children that need to be refreshed next
+        """
         fw = self.id_fw[fw_id]
         prev_state = fw.state
+        child_ids = []
 
         # if we're paused, defused or archived, just skip altogether
         if fw.state == 'DEFUSED' or fw.state == 'ARCHIVED' or fw.state == 'PAUSED':
             self.fw_states[fw_id] = fw.state
-            return updated_ids
+            return child_ids
 
         completed_parent_states = ['COMPLETED']
         if fw.spec.get('_allow_fizzled_parents'):
             completed_parent_states.append('FIZZLED')
 
         # check parent states for any that are not completed
-        for parent in self.links.parent_links.get(fw_id, []):
-            if self.fw_states[parent] not in completed_parent_states:
-                m_state = 'WAITING'
-                break
+        dag = self._get_compact_dag()
+        if dag is not None:
+            parents_done = dag.parents_completed(fw_id, 'FIZZLED' in completed_parent_states)
+        else:
+            parents_done = all(self.fw_states[parent] in completed_parent_states
+                               for parent in self.links.parent_links.get(fw_id, []))
+
+        if not parents_done:
+            m_state = 'WAITING'
 
         else:  # not DEFUSED/ARCHIVED, and all parents are done running. Now the state depends on the launch status
             # my state depends on launch whose state has the highest 'score' in STATE_RANKS
@@ -1207,8 +1619,12 @@ class Workflow(FWSerializable):
 
             # report any FIZZLED parents if allow_fizzed allows us to handle FIZZLED jobs
             if fw.spec.get('_allow_fizzled_parents') and "_fizzled_parents" not in fw.spec:
-                parent_fws = [self.id_fw[p].to_dict() for p in self.links.parent_links.get(fw_id, [])
-                              if self.id_fw[p].state == 'FIZZLED']
+                if dag is not None:
+                    fizzled_ids = dag.parents_in_state(fw_id, 'FIZZLED')
+                else:
+                    fizzled_ids = [p for p in self.links.parent_links.get(fw_id, [])
+                                   if self.id_fw[p].state == 'FIZZLED']
+                parent_fws = [self.id_fw[p].to_dict() for p in fizzled_ids]
                 if len(parent_fws) > 0:
                     fw.spec['_fizzled_parents'] = parent_fws
                     updated_ids.add(fw_id)
@@ -1221,17 +1637,89 @@ class Workflow(FWSerializable):
             updated_ids.add(fw_id)
 
             if m_state == 'COMPLETED':
-                updated_ids = updated_ids.union(self.apply_action(m_action, fw.fw_id))
+                updated_ids.update(self.apply_action(m_action, fw.fw_id))
 
             # refresh all the children that could possibly now be READY to run
             # note that "FIZZLED" is for _allow_fizzled_parents children
             if m_state in ['COMPLETED', 'FIZZLED']:
-                for child_id in self.links[fw_id]:
-                    updated_ids = updated_ids.union(self.refresh(child_id, updated_ids))
+                dag = self._get_compact_dag()  # the links may have changed by the action
+                # the CompactDAG skips the children that stay WAITING for other parents
+                child_ids = dag.children_to_refresh(fw_id) if dag is not None else self.links[fw_id]
 
         self.updated_on = datetime.utcnow()
 
-        return updated_ids
+        return child_ids
+
+    def _walk_topologically(self, fw_id, get_children):
+        """
+        Internal generator walking from a Firework to its descendants in topological order,
+        visiting each Firework at most once. get_children(m_fw_id) is called after the caller
+        handled m_fw_id and returns the children to visit as well. The topological ranks of the
+        descendants of fw_id are only needed once there is a choice of Fireworks to visit next.
+
+        Args:
+            fw_id (int): id of the Firework to start from
+            get_children (callable): maps a visited Firework id to the ids of children to visit
+
+        Yields:
+            int: ids of the Fireworks to visit
+        """
+        heap = [(0, fw_id)]
+        queued = {fw_id}
+        ranks = None
+        while heap:
+            m_fw_id = heapq.heappop(heap)[1]
+            queued.discard(m_fw_id)
+            yield m_fw_id
+
+            child_ids = [child_id for child_id in get_children(m_fw_id) if child_id not in queued]
+            if not child_ids:
+                continue
+            if ranks is not None or heap or len(child_ids) > 1:
+                new_ranks = self._get_topological_ranks(fw_id)
+                if new_ranks is not ranks:  # the links changed, e.g. by a dynamic addition
+                    ranks = new_ranks
+                    heap = [(ranks.get(f, 0), f) for _, f in heap]
+                    heapq.heapify(heap)
+            for child_id in child_ids:
+                queued.add(child_id)
+                heapq.heappush(heap, (ranks.get(child_id, 0) if ranks else 0, child_id))
+
+    def _get_topological_ranks(self, fw_id):
+        """
+        Internal method to get the length of the longest path from a Firework to each of its
+        descendants, so that every descendant ranks higher than its parents within the affected
+        subgraph. The rest of the workflow is not ranked. Cached until the links change.
+
+        Args:
+            fw_id (int): id of the Firework to rank the descendants of
+
+        Returns:
+            dict: mapping of Firework ids to ranks
+        """
+        links = self.links
+        cached = self._topological_ranks
+        if cached is None or cached[0] is not links or cached[1] != links._version or \
+                cached[2] != fw_id:
+            n_parents = {fw_id: 0}
+            stack = [fw_id]
+            while stack:
+                for child_id in links.get(stack.pop(), []):
+                    if child_id not in n_parents:
+                        n_parents[child_id] = 0
+                        stack.append(child_id)
+                    n_parents[child_id] += 1
+            ranks = {fw_id: 0}
+            stack = [fw_id]
+            while stack:
+                m_fw_id = stack.pop()
+                for child_id in links.get(m_fw_id, []):
+                    ranks[child_id] = max(ranks.get(child_id, 0), ranks[m_fw_id] + 1)
+                    n_parents[child_id] -= 1
+                    if n_parents[child_id] == 0:
+                        stack.append(child_id)
+            self._topological_ranks = (links, links._version, fw_id, ranks)
+        return self._topological_ranks[3]
 
     @property
     def root_fw_ids(self):
@@ -1241,6 +1729,9 @@ class Workflow(FWSerializable):
         Returns:
             [int]: Firework ids of root FWs
         """
+        dag = self._get_compact_dag()
+        if dag is not None:
+            return dag.root_ids
         all_ids = set(self.links.nodes)
         child_ids = set(self.links.parent_links.keys())
         root_ids = all_ids.difference(child_ids)
@@ -1254,6 +1745,9 @@ class Workflow(FWSerializable):
         Returns:
             [int]: Firework ids of leaf FWs
         """
+        dag = self._get_compact_dag()
+        if dag is not None:
+            return dag.leaf_ids
         leaf_ids = []
         for id, children in self.links.items():
             if len(children) == 0:
@@ -1267,6 +1761,9 @@ class Workflow(FWSerializable):
         Args:
             old_new (dict)
         """
+        if not old_new:
+            return  # keep the Links, so that only the changes are saved
+
         # update id_fw
         new_id_fw = {}
         for (fwid, fws) in self.id_fw.items():
@@ -1303,6 +1800,33 @@ class Workflow(FWSerializable):
         m_dict['fw_states'] = dict([(str(k), v) for (k, v) in self.fw_states.items()])
         return m_dict
 
+    def _set_saved(self):
+        """
+        Internal method to record that the workflow matches its document in the database, so that
+        _get_db_changes() only reports later changes.
+        """
+        self._saved_links = (self.links, self.links._version)
+        self.fw_states.unsaved.clear()
+
+    def _get_db_changes(self):
+        """
+        Internal method to get the changes of the workflow since _set_saved() was called.
+
+        Returns:
+            dict: the fields to $set in the workflow document, None if the links changed and the
+                whole document needs to be replaced
+        """
+        if self._saved_links is None or self._saved_links[0] is not self.links or \
+                self._saved_links[1] != self.links._version:
+            return None
+        m_dict = {'fw_states.{}'.format(k): self.fw_states[k] for k in self.fw_states.unsaved
+                  if k in self.fw_states}
+        m_dict['metadata'] = self.metadata
+        m_dict['state'] = self.state
+        m_dict['name'] = self.name
+        m_dict['updated_on'] = self.updated_on
+        return m_dict
+
     def to_display_dict(self):
         m_dict = self.to_db_dict()
         nodes = sorted(m_dict['nodes'])
@@ -1445,7 +1969,7 @@ class Workflow(FWSerializable):
         """
         # not working with the copies, causes spurious behavior
         wf_dict = deepcopy(self.as_dict())
-        orig_parent_links = deepcopy(self.links.parent_links)
+        orig_parent_links = dict(self.links.parent_links)
         fws = wf_dict["fws"]
 
         # update the links dict: remove fw_ids and link their parents to their children (if they don't
@@ -59,27 +59,42 @@ class FWorker(FWSerializable):
     @property
     def query(self):
         """
-        Returns updated query dict.
+        Returns updated query dict. The FWorker and category are matched on the top-level _fworker
+        and _category fields of the Firework documents (see Firework.to_db_dict()), which can be
+        indexed together with the state and the checkout sort. The LaunchPad adds these fields to
+        the documents written by older versions of FireWorks before its first checkout, so do not
+        keep adding Fireworks with older versions.
+
+        The category "__none__" matches the Fireworks without a spec._category, as well as those
+        whose spec._category is None.
         """
         q = dict(self._query)
-        fworker_check = [{"spec._fworker": {"$exists": False}},
-                         {"spec._fworker": None},
-                         {"spec._fworker": self.name}]
-        if '$or' in q:
-            q['$and'] = q.get('$and', [])
-            q['$and'].extend([{'$or': q.pop('$or')}, {'$or': fworker_check}])
-        else:
-            q['$or'] = fworker_check
+        q['_fworker'] = {"$in": [None, self.name]}
         if self.category and isinstance(self.category, six.string_types):
             if self.category == "__none__":
-                q['spec._category'] = {"$exists": False}
+                q['_category'] = None
             else:
-                q['spec._category'] = self.category
+                q['_category'] = self.category
         elif self.category:  # category is list of str
-            q['spec._category'] = {"$in": self.category}
+            q['_category'] = {"$in": self.category}
 
         return q
 
+    @property
+    def ready_queue_query(self):
+        """
+        Returns the query dict on the ready queue (see READY_QUEUE in fw_config) matching the same
+        Fireworks as query, or None if the FWorker has a custom query, which only the fireworks
+        collection can answer.
+        """
+        if self._query:
+            return None
+        q = self.query
+        rq = {'fworker': q['_fworker']}
+        if '_category' in q:
+            rq['category'] = q['_category']
+        return rq
+
     @classmethod
     def auto_load(cls):
         """
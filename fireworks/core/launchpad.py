@@ -15,30 +15,37 @@ import datetime
 import json
 import os
 import random
+import socket
 import time
 import traceback
 import shutil
+import threading
+import uuid
 import gridfs
 from collections import OrderedDict, defaultdict
 from itertools import chain
 from tqdm import tqdm
 from bson import ObjectId
 
-from pymongo import MongoClient
-from pymongo import DESCENDING, ASCENDING
+from pymongo import CursorType, ReturnDocument
+from pymongo import DESCENDING, ASCENDING, ReplaceOne, UpdateOne, DeleteMany
 from pymongo.errors import DocumentTooLarge
 from monty.serialization import loadfn
 
 from fireworks.fw_config import LAUNCHPAD_LOC, SORT_FWS, \
     RESERVATION_EXPIRATION_SECS, \
     RUN_EXPIRATION_SECS, MAINTAIN_INTERVAL, WFLOCK_EXPIRATION_SECS, \
-    WFLOCK_EXPIRATION_KILL, \
-    MONGO_SOCKET_TIMEOUT_MS, GRIDFS_FALLBACK_COLLECTION
+    WFLOCK_EXPIRATION_KILL, WFLOCK_LEASE_SECS, \
+    MONGO_SOCKET_TIMEOUT_MS, GRIDFS_FALLBACK_COLLECTION, READY_EVENTS_COLLECTION, \
+    READY_EVENTS_SIZE, ID_BLOCK_SIZE, WF_OPTIMISTIC_REFRESH, WF_CHANGE_LOG_SIZE, \
+    COMPLETION_QUEUE, COMPLETION_EVENTS_COLLECTION, REDUCER_BATCH_SIZE, REDUCER_INTERVAL, \
+    REDUCER_CLAIM_SECS, READY_QUEUE, READY_QUEUE_COLLECTION, READY_QUEUE_PARTITIONS
 from fireworks.utilities.fw_serializers import FWSerializable, \
     reconstitute_dates
 from fireworks.core.firework import Firework, Launch, Workflow, FWAction, \
     Tracker
-from fireworks.utilities.fw_utilities import get_fw_logger
+from fireworks.utilities.fw_utilities import get_fw_logger, get_mongo_client
+from fireworks.core.completion_writer import replay_completion_journals
 from fireworks.utilities.fw_serializers import recursive_dict
 
 __author__ = 'Anubhav Jain'
@@ -78,6 +85,12 @@ def sort_aggregation(sort):
     return aggregation
 
 
+# workflow commits changing more fw_ids than this are logged as changing all of them
+WF_CHANGE_LOG_MAX_IDS = 1000
+# number of times a refresh is redone from scratch when its WFLock was taken over meanwhile
+WF_LOST_LOCK_RETRIES = 3
+
+
 class LockedWorkflowError(ValueError):
     """
     Error raised if the context manager WFLock can't acquire the lock on the WF within the selected
@@ -86,13 +99,102 @@ class LockedWorkflowError(ValueError):
     pass
 
 
+class LostWorkflowLockError(LockedWorkflowError):
+    """
+    Error raised if the WFLock of a Workflow was taken over by someone else while it was held, so
+    that the changes of its holder could not be written.
+    """
+    pass
+
+
+class IdAllocator(object):
+    """
+    Hand out the ids of one counter of the fw_id_assigner collection (e.g. 'next_fw_id') from
+    blocks that are leased from the database with a single $inc, instead of incrementing the
+    counter for every id. Ids are increasing within a block; blocks leased by different
+    LaunchPads interleave.
+    Thread-safe, e.g. for the LaunchPad served by a DataServer, and a process does not use the
+    block of the process it was forked from.
+    """
+
+    def __init__(self, collection, field, block_size=ID_BLOCK_SIZE):
+        """
+        Args:
+            collection (pymongo.collection): the fw_id_assigner collection
+            field (str): name of the counter, 'next_fw_id' or 'next_launch_id'
+            block_size (int): number of ids to lease at once
+        """
+        self.collection = collection
+        self.field = field
+        self.block_size = max(block_size or 1, 1)
+        self._lock = threading.Lock()
+        self._next_id, self._end_id, self._pid = None, None, None
+
+    def get(self, quantity=1):
+        """
+        Args:
+            quantity (int): number of consecutive ids
+
+        Returns:
+            int: the first id of the range
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._next_id is None or \
+                    self._next_id + quantity > self._end_id:
+                # the rest of the current block is skipped
+                size = max(quantity, self.block_size)
+                self._next_id = self.collection.find_one_and_update(
+                    {}, {'$inc': {self.field: size}})[self.field]
+                self._end_id = self._next_id + size
+                self._pid = os.getpid()
+            first_id = self._next_id
+            self._next_id += quantity
+            return first_id
+
+    def put_back(self, first_id, quantity=1):
+        """
+        Give back the ids handed out last if they were not used, so that they are handed out
+        again. Ids handed out before are not given back.
+
+        Args:
+            first_id (int): the first id of the range returned by get()
+            quantity (int): number of consecutive ids
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._next_id == first_id + quantity:
+                self._next_id = first_id
+
+    def discard(self):
+        """
+        Forget the current block, e.g. after the counter was reset.
+        """
+        with self._lock:
+            self._next_id, self._end_id, self._pid = None, None, None
+
+
 class WFLock(object):
     """
     Lock a Workflow, i.e. for performing update operations
     Raises a LockedWorkflowError if the lock couldn't be acquired withing expire_secs and kill==False.
     Calling functions are responsible for handling the error in order to avoid database inconsistencies.
+
+    The lock is a lease: the workflow document stores the owner of the lock and the expiry of the
+    lease, which a background thread of the holder renews every third of WFLOCK_LEASE_SECS while
+    the lock is held. The lock of a crashed holder can be taken over as soon as its lease expired.
+    Every acquisition also increments the lock_token of the workflow, a fencing token: renew(),
+    the writes of LaunchPad._update_wf() to the workflow and its fireworks and the release are
+    conditioned on it, so that a holder whose lock was taken over cannot overwrite the changes of
+    the new holder. Waiters retry with jittered exponential backoff.
+
+    Set WFLock.metrics_hook to a callable metrics_hook(name, value, fw_id) to record the lock
+    contention: 'acquire_secs' and 'waits' (number of failed attempts) for every acquisition,
+    'lease_takeovers' and 'forced_takeovers' (with kill) when a lock is taken from its holder.
     """
 
+    BACKOFF_BASE_SECS = 0.05
+    BACKOFF_MAX_SECS = 5.0
+    metrics_hook = None
+
     def __init__(self, lp, fw_id, expire_secs=WFLOCK_EXPIRATION_SECS,
                  kill=WFLOCK_EXPIRATION_KILL):
         """
@@ -106,24 +208,25 @@ class WFLock(object):
         self.fw_id = fw_id
         self.expire_secs = expire_secs
         self.kill = kill
+        self.lease_secs = WFLOCK_LEASE_SECS
+        self.owner = None
+        self.token = None
+        self._released = threading.Event()
+        self._renewer = None
 
     def __enter__(self):
-        ctr = 0
-        waiting_time = 0
-        # acquire lock
-        links_dict = self.lp.workflows.find_one_and_update({'nodes': self.fw_id,
-                                                            'locked': {
-                                                                "$exists": False}},
-                                                           {'$set': {
-                                                               'locked': True}})
+        start = time.time()
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        waits = 0
+        forced = False
+        # acquire lock, if free or if the lease of the holder expired
+        old_lock = self._acquire(free_only=True)
         # could not acquire lock b/c WF is already locked for writing
-        while not links_dict:
-            ctr += 1
-            time_incr = ctr / 10.0 + random.random() / 100.0
-            time.sleep(time_incr)  # wait a bit for lock to free up
-            waiting_time += time_incr
-            if waiting_time > self.expire_secs:  # too much time waiting, expire lock
-                wf = self.lp.workflows.find_one({'nodes': self.fw_id})
+        while not old_lock:
+            waits += 1
+            waiting_time = time.time() - start
+            if waiting_time >= self.expire_secs:  # too much time waiting, expire lock
+                wf = self.lp.workflows.find_one({'nodes': self.fw_id}, {'_id': 1})
                 if not wf:
                     raise ValueError(
                         "Could not find workflow in database: {}".format(
@@ -131,22 +234,94 @@ class WFLock(object):
                 if self.kill:  # force lock acquisition
                     self.lp.m_logger.warning(
                         'FORCIBLY ACQUIRING LOCK, WF: {}'.format(self.fw_id))
-                    links_dict = self.lp.workflows.find_one_and_update(
-                        {'nodes': self.fw_id},
-                        {'$set': {'locked': True}})
+                    old_lock = self._acquire(free_only=False)
+                    forced = True
+                    break
                 else:  # throw error if we don't want to force lock acquisition
+                    self._record('waits', waits)
                     raise LockedWorkflowError(
                         "Could not get workflow - LOCKED: {}".format(
                             self.fw_id))
-            else:
-                # retry lock
-                links_dict = self.lp.workflows.find_one_and_update(
-                    {'nodes': self.fw_id, 'locked': {"$exists": False}},
-                    {'$set': {'locked': True}})
+            # wait a bit for lock to free up, then retry lock
+            backoff = min(self.BACKOFF_MAX_SECS, self.BACKOFF_BASE_SECS * 2 ** min(waits, 30))
+            time.sleep(min(random.uniform(0, backoff), self.expire_secs - waiting_time))
+            old_lock = self._acquire(free_only=True)
+
+        if not old_lock:
+            raise ValueError("Could not find workflow in database: {}".format(self.fw_id))
+        if forced:
+            self._record('forced_takeovers', 1)
+        elif 'locked' in old_lock:
+            self.lp.m_logger.warning(
+                'LEASE OF LOCK EXPIRED, TAKING OVER LOCK, WF: {}'.format(self.fw_id))
+            self._record('lease_takeovers', 1)
+        self.token = old_lock.get('lock_token', 0) + 1
+        self._record('acquire_secs', time.time() - start)
+        self._record('waits', waits)
+        self._released.clear()
+        self._renewer = threading.Thread(target=self._keep_renewing, name='WFLock')
+        self._renewer.daemon = True
+        self._renewer.start()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.lp.workflows.find_one_and_update({"nodes": self.fw_id},
-                                              {"$unset": {"locked": True}})
+        self._released.set()
+        self._renewer.join()
+        self.lp.workflows.update_one({"nodes": self.fw_id, "lock_token": self.token},
+                                     {"$unset": {"locked": True}})
+
+    def _keep_renewing(self):
+        """
+        Renew the lease while the lock is held, e.g. during a long load and refresh of a large
+        workflow.
+        """
+        while not self._released.wait(self.lease_secs / 3.0):
+            try:
+                self.renew()
+            except LostWorkflowLockError:
+                return  # the writes of the holder will fail
+            except Exception:
+                self.lp.m_logger.warning('Could not renew the lock of WF: {}\n{}'.format(
+                    self.fw_id, traceback.format_exc()))
+
+    def _acquire(self, free_only):
+        """
+        Args:
+            free_only (bool): only acquire the lock if it is free or its lease expired
+
+        Returns:
+            dict: the lock and lock_token of the workflow before the acquisition, None if the
+                lock could not be acquired
+        """
+        now = datetime.datetime.utcnow()
+        query = {'nodes': self.fw_id}
+        if free_only:
+            query['$or'] = [{'locked': {'$exists': False}}, {'locked.expires_on': {'$lt': now}}]
+        return self.lp.workflows.find_one_and_update(
+            query,
+            {'$set': {'locked': {'owner': self.owner,
+                                 'expires_on': now + datetime.timedelta(
+                                     seconds=self.lease_secs)}},
+             '$inc': {'lock_token': 1}},
+            projection={'locked': 1, 'lock_token': 1})
+
+    def renew(self):
+        """
+        Extend the lease of the lock, e.g. before writing the workflow.
+
+        Raises:
+            LostWorkflowLockError: if the lock was taken over by someone else meanwhile
+        """
+        expires_on = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_secs)
+        result = self.lp.workflows.update_one({'nodes': self.fw_id, 'lock_token': self.token},
+                                              {'$set': {'locked.expires_on': expires_on}})
+        if not result.matched_count:
+            raise LostWorkflowLockError(
+                "Lost the lock of workflow - LOCKED: {}".format(self.fw_id))
+
+    def _record(self, name, value):
+        if WFLock.metrics_hook:
+            WFLock.metrics_hook(name, value, self.fw_id)
 
 
 class LaunchPad(FWSerializable):
@@ -212,33 +387,41 @@ class LaunchPad(FWSerializable):
 
         # get connection
         if uri_mode:
-            self.connection = MongoClient(host)
+            self.connection = get_mongo_client(host)
             dbname = host.split('/')[-1].split('?')[
                 0]  # parse URI to extract dbname
             self.db = self.connection[dbname]
         else:
-            self.connection = MongoClient(self.host, self.port, ssl=self.ssl,
-                                          ssl_ca_certs=self.ssl_ca_certs,
-                                          ssl_certfile=self.ssl_certfile,
-                                          ssl_keyfile=self.ssl_keyfile,
-                                          ssl_pem_passphrase=self.ssl_pem_passphrase,
-                                          socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
-                                          username=self.username,
-                                          password=self.password,
-                                          authSource=self.authsource,
-                                          **self.mongoclient_kwargs)
+            self.connection = get_mongo_client(self.host, self.port, ssl=self.ssl,
+                                               ssl_ca_certs=self.ssl_ca_certs,
+                                               ssl_certfile=self.ssl_certfile,
+                                               ssl_keyfile=self.ssl_keyfile,
+                                               ssl_pem_passphrase=self.ssl_pem_passphrase,
+                                               socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                                               username=self.username,
+                                               password=self.password,
+                                               authSource=self.authsource,
+                                               **self.mongoclient_kwargs)
             self.db = self.connection[self.name]
 
         self.fireworks = self.db.fireworks
         self.launches = self.db.launches
         self.offline_runs = self.db.offline_runs
         self.fw_id_assigner = self.db.fw_id_assigner
+        self._fw_id_allocator = IdAllocator(self.fw_id_assigner, 'next_fw_id')
+        self._launch_id_allocator = IdAllocator(self.fw_id_assigner, 'next_launch_id')
+        self._ping_trackers = {}  # launch_id -> (launch_dir, [Tracker]), see ping_launch()
+        self._fworker_fields_checked = False  # see _check_fworker_fields()
         self.workflows = self.db.workflows
         if GRIDFS_FALLBACK_COLLECTION:
             self.gridfs_fallback = gridfs.GridFS(self.db,
                                                  GRIDFS_FALLBACK_COLLECTION)
         else:
             self.gridfs_fallback = None
+        self.ready_events = self.db[READY_EVENTS_COLLECTION] if READY_EVENTS_COLLECTION else None
+        self._ready_events_capped = None
+        self.completion_events = self.db[COMPLETION_EVENTS_COLLECTION]
+        self.ready_queue = self.db[READY_QUEUE_COLLECTION]
 
         self.backup_launch_data = {}
         self.backup_fw_data = {}
@@ -287,6 +470,9 @@ class LaunchPad(FWSerializable):
         allowed_states = ["READY", "WAITING", "FIZZLED", "DEFUSED", "PAUSED"]
         self.fireworks.update_many({'fw_id': {"$in": fw_ids},
                                     'state': {"$in": allowed_states}}, mod_spec)
+        self._update_fworker_fields({'fw_id': {"$in": fw_ids}})
+        if READY_QUEUE:
+            self._requeue_fws(fw_ids)  # the priority, category or fworker might have changed
         for fw in self.fireworks.find(
                 {'fw_id': {"$in": fw_ids}, 'state': {"$nin": allowed_states}},
                 {"fw_id": 1, "state": 1}):
@@ -347,12 +533,17 @@ class LaunchPad(FWSerializable):
             self.launches.delete_many({})
             self.workflows.delete_many({})
             self.offline_runs.delete_many({})
+            self.completion_events.delete_many({})
+            self.ready_queue.delete_many({})
             self._restart_ids(1, 1)
             if self.gridfs_fallback is not None:
                 self.db.drop_collection(
                     "{}.chunks".format(GRIDFS_FALLBACK_COLLECTION))
                 self.db.drop_collection(
                     "{}.files".format(GRIDFS_FALLBACK_COLLECTION))
+            if self.ready_events is not None:
+                self.db.drop_collection(READY_EVENTS_COLLECTION)
+                self._ready_events_capped = None
             self.tuneup()
             self.m_logger.info('LaunchPad was RESET.')
         elif not require_password:
@@ -368,7 +559,8 @@ class LaunchPad(FWSerializable):
 
     def maintain(self, infinite=True, maintain_interval=None):
         """
-        Perform launchpad maintenance: detect lost runs and unreserved RESERVE launches.
+        Perform launchpad maintenance: replay the completions journaled by dead processes (see
+        ASYNC_COMPLETION in fw_config), detect lost runs and unreserved RESERVE launches.
 
         Args:
             infinite (bool)
@@ -378,6 +570,12 @@ class LaunchPad(FWSerializable):
 
         while True:
             self.m_logger.info('Performing maintenance on Launchpad...')
+            # before detecting lost runs, which would fizzle the launches of the journals
+            self.m_logger.debug('Replaying journaled completions...')
+            n_replayed = replay_completion_journals(self)
+            if n_replayed:
+                self.m_logger.info('Replayed {} journaled completions'.format(n_replayed))
+
             self.m_logger.debug('Tracking down FIZZLED jobs...')
             fl, ff, inconsistent_fw_ids = self.detect_lostruns(fizzle=True)
             if fl:
@@ -397,6 +595,18 @@ class LaunchPad(FWSerializable):
                 self.m_logger.info(
                     'Unreserved {} RESERVED launches: {}'.format(len(ur), ur))
 
+            if COMPLETION_QUEUE:
+                self.m_logger.debug('Reducing completed launches...')
+                n_events = self.run_reducer(infinite=False)
+                if n_events:
+                    self.m_logger.info('Reduced {} completion events'.format(n_events))
+
+            if READY_QUEUE:
+                self.m_logger.debug('Repairing the ready queue...')
+                n_repaired = self.repair_ready_queue()
+                if n_repaired:
+                    self.m_logger.info('Repaired {} ready queue entries'.format(n_repaired))
+
             self.m_logger.info('LaunchPad was MAINTAINED.')
 
             if not infinite:
@@ -406,6 +616,92 @@ class LaunchPad(FWSerializable):
                 'Sleeping for {} secs...'.format(maintain_interval))
             time.sleep(maintain_interval)
 
+    def run_reducer(self, infinite=True, reducer_interval=None, batch_size=None):
+        """
+        Run the reducer of the completion queue (see COMPLETION_QUEUE in fw_config): refresh the
+        workflows of completed launches in batches. Many reducers can run at once, every batch
+        of a workflow is reduced by a single one of them while holding the WFLock.
+
+        Args:
+            infinite (bool): keep waiting for completions, otherwise return once no batch is full
+            reducer_interval (seconds): sleep time when there are no completions to reduce
+            batch_size (int): max number of completion events per batch
+
+        Returns:
+            int: the number of completion events reduced (if not infinite)
+        """
+        reducer_interval = reducer_interval if reducer_interval else REDUCER_INTERVAL
+        batch_size = batch_size if batch_size else REDUCER_BATCH_SIZE
+        n_events = 0
+        while True:
+            n_reduced = self.reduce_completions(batch_size)
+            n_events += n_reduced
+            if n_reduced < batch_size:
+                if not infinite:
+                    return n_events
+                time.sleep(reducer_interval)
+
+    def reduce_completions(self, batch_size=None):
+        """
+        Reduce a batch of the completion events queued by complete_launch(): each workflow with
+        completed launches is locked, loaded, refreshed from all of its completed fireworks and
+        saved once, so that N sibling completions cost one refresh instead of N. The events of
+        workflows that are locked are left to a later batch.
+
+        Args:
+            batch_size (int): max number of completion events to reduce
+
+        Returns:
+            int: the number of completion events reduced
+        """
+        reducer = uuid.uuid4().hex
+        events = self._claim_completion_events(reducer, batch_size or REDUCER_BATCH_SIZE)
+        if not events:
+            return 0
+        fw_ids = list(OrderedDict.fromkeys(chain.from_iterable(e['fw_ids'] for e in events)))
+
+        locked_ids = set()
+        for group in self._group_by_wf(fw_ids):
+            try:
+                if not self._refresh_wf_group(group):
+                    locked_ids.update(group)
+            except RuntimeError:
+                # the broken fireworks were marked as FIZZLED, do not retry them
+                self.m_logger.error("Error reducing the completions of fw_ids {}: {}".format(
+                    group, traceback.format_exc()))
+
+        done_ids = [e['_id'] for e in events if not locked_ids.intersection(e['fw_ids'])]
+        self.completion_events.delete_many({'_id': {'$in': done_ids}})
+        if len(done_ids) < len(events):
+            self.completion_events.update_many({'reducer': reducer},
+                                               {'$set': {'claimed_until': None},
+                                                '$unset': {'reducer': ''}})
+        return len(done_ids)
+
+    def _claim_completion_events(self, reducer, n):
+        """
+        Claim the oldest completion events that are not claimed by another reducer, or whose
+        reducer did not finish them within REDUCER_CLAIM_SECS.
+
+        Args:
+            reducer (str): id of the reducer
+            n (int): max number of events to claim
+
+        Returns:
+            [dict]: the claimed events
+        """
+        now = datetime.datetime.utcnow()
+        free = {'$or': [{'claimed_until': None}, {'claimed_until': {'$lt': now}}]}
+        event_ids = [e['_id'] for e in self.completion_events.find(
+            free, {'_id': 1}, sort=[('_id', ASCENDING)], limit=n)]
+        if not event_ids:
+            return []
+        claimed_until = now + datetime.timedelta(seconds=REDUCER_CLAIM_SECS)
+        self.completion_events.update_many(
+            {'$and': [{'_id': {'$in': event_ids}}, free]},
+            {'$set': {'reducer': reducer, 'claimed_until': claimed_until}})
+        return list(self.completion_events.find({'reducer': reducer}))
+
     def add_wf(self, wf, reassign_all=True):
         """
         Add workflow(or firework) to the launchpad. The firework ids will be reassigned.
@@ -430,6 +726,9 @@ class LaunchPad(FWSerializable):
         wf._reassign_ids(old_new)
         # insert the WFLinks
         self.workflows.insert_one(wf.to_db_dict())
+        if READY_QUEUE:
+            self._queue_ready_fws([wf.id_fw[fw_id] for fw_id in wf.root_fw_ids])
+        self._notify_ready(wf.root_fw_ids)
         self.m_logger.info('Added a workflow. id_map: {}'.format(old_new))
         return old_new
 
@@ -452,8 +751,7 @@ class LaunchPad(FWSerializable):
 
         # Initialize new firework counter, starting from the next fw id
         total_num_fws = sum([len(wf.fws) for wf in wfs])
-        new_fw_counter = self.fw_id_assigner.find_one_and_update(
-            {}, {'$inc': {'next_fw_id': total_num_fws}})['next_fw_id']
+        new_fw_counter = self.get_new_fw_id(quantity=total_num_fws)
         for wf in tqdm(wfs):
             # Reassign fw_ids and increment the counter
             old_new = dict(zip(
@@ -474,6 +772,9 @@ class LaunchPad(FWSerializable):
         self.workflows.insert_many(wf.to_db_dict() for wf in wfs)
         all_fws = chain.from_iterable(wf.fws for wf in wfs)
         self.fireworks.insert_many(fw.to_db_dict() for fw in all_fws)
+        if READY_QUEUE:
+            self._queue_ready_fws([wf.id_fw[fw_id] for wf in wfs for fw_id in wf.root_fw_ids])
+        self._notify_ready(list(chain.from_iterable(wf.root_fw_ids for wf in wfs)))
         return None
 
     def append_wf(self, new_wf, fw_ids, detour=False, pull_spec_mods=True,
@@ -527,8 +828,8 @@ class LaunchPad(FWSerializable):
                                    superpose_child_on_parent_fw_spec=superpose_child_on_parent_fw_spec,
                                    parent_fw_spec_source_fw_id=parent_fw_spec_source_fw_id,
                                    )
-        with WFLock(self, fw_ids[0]):
-            self._update_wf(wf, updated_ids)
+        with WFLock(self, fw_ids[0]) as lock:
+            self._update_wf(wf, updated_ids, lock)
 
     def get_launch_by_id(self, launch_id):
         """
@@ -588,7 +889,10 @@ class LaunchPad(FWSerializable):
         Returns:
             Firework object
         """
-        return Firework.from_dict(self.get_fw_dict_by_id(fw_id))
+        fw_dict = self.get_fw_dict_by_id(fw_id)
+        fw = Firework.from_dict(fw_dict)
+        fw._set_db_dict(_get_stored_fw_dict(fw_dict))
+        return fw
 
     def get_wf_by_fw_id(self, fw_id):
         """
@@ -604,10 +908,21 @@ class LaunchPad(FWSerializable):
         if not links_dict:
             raise ValueError(
                 "Could not find a Workflow with fw_id: {}".format(fw_id))
-        fws = map(self.get_fw_by_id, links_dict["nodes"])
-        return Workflow(fws, links_dict['links'], links_dict['name'],
-                        links_dict['metadata'], links_dict['created_on'],
-                        links_dict['updated_on'])
+        # load all fireworks and their launches at once
+        id_fw = {fw.fw_id: fw for fw in
+                 self._get_fws_by_query({'fw_id': {'$in': links_dict['nodes']}})}
+        missing_ids = [i for i in links_dict['nodes'] if i not in id_fw]
+        if missing_ids:
+            raise ValueError('No Firework exists with id: {}'.format(missing_ids[0]))
+        fws = [id_fw[i] for i in links_dict['nodes']]
+        wf = Workflow(fws, links_dict['links'], links_dict['name'],
+                      links_dict['metadata'], links_dict['created_on'],
+                      links_dict['updated_on'])
+        # the states that match the workflow document need not be saved again
+        saved_states = links_dict.get('fw_states', {})
+        wf.fw_states.unsaved.difference_update([fw_id for fw_id, state in wf.fw_states.items()
+                                                if saved_states.get(str(fw_id)) == state])
+        return wf
 
     def get_wf_by_fw_id_lzyfw(self, fw_id):
         """
@@ -624,20 +939,34 @@ class LaunchPad(FWSerializable):
             raise ValueError(
                 "Could not find a Workflow with fw_id: {}".format(fw_id))
 
-        fws = []
-        for fw_id in links_dict['nodes']:
-            fws.append(LazyFirework(fw_id, self.fireworks, self.launches,
-                                    self.gridfs_fallback))
         # Check for fw_states in links_dict to conform with pre-optimized workflows
         if 'fw_states' in links_dict:
             fw_states = dict(
                 [(int(k), v) for (k, v) in links_dict['fw_states'].items()])
         else:
             fw_states = None
+        # seed the states of the lazy fireworks, loading them at once if necessary
+        states = fw_states or {
+            f['fw_id']: f['state'] for f in
+            self.fireworks.find({'fw_id': {'$in': links_dict['nodes']}},
+                                projection=['fw_id', 'state'])}
 
-        return Workflow(fws, links_dict['links'], links_dict['name'],
-                        links_dict['metadata'], links_dict['created_on'],
-                        links_dict['updated_on'], fw_states)
+        prefetcher = LazyFireworkPrefetcher(self.fireworks, self.launches, self.gridfs_fallback)
+        fws = []
+        for fw_id in links_dict['nodes']:
+            fw = LazyFirework(fw_id, self.fireworks, self.launches,
+                              self.gridfs_fallback, prefetcher=prefetcher)
+            fw._state = states.get(fw_id)
+            fws.append(fw)
+
+        wf = Workflow(fws, links_dict['links'], links_dict['name'],
+                      links_dict['metadata'], links_dict['created_on'],
+                      links_dict['updated_on'], fw_states)
+        prefetcher.wf = wf
+        if fw_states:
+            wf._set_saved()
+        wf._db_version = links_dict.get('version', 0)
+        return wf
 
     def delete_launchdirs(self, fw_id):
         """
@@ -714,6 +1043,8 @@ class LaunchPad(FWSerializable):
         self.launches.delete_many({'launch_id': {"$in": launch_ids}})
         self.offline_runs.delete_many({'launch_id': {"$in": launch_ids}})
         self.fireworks.delete_many({"fw_id": {"$in": fw_ids}})
+        if READY_QUEUE:
+            self.ready_queue.delete_many({"fw_id": {"$in": fw_ids}})
         self.workflows.delete_one({'nodes': fw_id})
 
     def get_wf_summary_dict(self, fw_id, mode="more"):
@@ -972,8 +1303,14 @@ class LaunchPad(FWSerializable):
         Returns:
             bool: True if the database contains any FireWorks that are ready to run.
         """
-        q = fworker.query if fworker else {}
-        return bool(self._get_a_fw_to_run(query=q, checkout=False))
+        ready_query = self._get_ready_queue_query(fworker)
+        if ready_query is not None:
+            return self.ready_queue.find_one(ready_query, {'fw_id': 1}) is not None
+        self._check_fworker_fields()
+        q = dict(fworker.query) if fworker else {}
+        q['state'] = 'READY'
+        # any match will do, so neither sort nor load the Firework
+        return self.fireworks.find_one(q, {'fw_id': 1}) is not None
 
     def future_run_exists(self, fworker=None):
         """Check if database has any current OR future Fireworks available
@@ -1028,13 +1365,40 @@ class LaunchPad(FWSerializable):
                 'state', 'time_start', 'time_end', 'host', 'ip',
                 'fworker.name'):
             self.launches.create_index(f, background=bkground)
+        # used to find lost runs and expired reservations
+        self.launches.create_index([('state', ASCENDING), ('state_updated_on', ASCENDING)],
+                                   background=bkground)
 
         for f in ('name', 'created_on', 'updated_on', 'nodes'):
             self.workflows.create_index(f, background=bkground)
 
+        if COMPLETION_QUEUE:
+            self.completion_events.create_index('claimed_until', background=bkground)
+            self.completion_events.create_index('reducer', background=bkground)
+
+        if READY_QUEUE:
+            self.ready_queue.create_index('fw_id', unique=True, background=bkground)
+            sortby = self._get_checkout_sort('priority')
+            self.ready_queue.create_index(sortby, background=bkground)
+            self.ready_queue.create_index([('partition', ASCENDING)] + sortby,
+                                          background=bkground)
+
         for idx in self.user_indices:
             self.fireworks.create_index(idx, background=bkground)
 
+        if self.ready_events is not None and \
+                READY_EVENTS_COLLECTION not in self.db.collection_names():
+            try:
+                self.db.create_collection(READY_EVENTS_COLLECTION, capped=True,
+                                          size=READY_EVENTS_SIZE)
+                # a tailable cursor on an empty capped collection is dead right away
+                self.ready_events.insert_one({'fw_ids': [],
+                                              'created_on': datetime.datetime.utcnow()})
+            except Exception:
+                self.m_logger.warning('Could not create the capped {} collection, launchers '
+                                      'will poll for READY FWs.'.format(READY_EVENTS_COLLECTION))
+            self._ready_events_capped = None
+
         for idx in self.wf_user_indices:
             self.workflows.create_index(idx, background=bkground)
 
@@ -1047,6 +1411,14 @@ class LaunchPad(FWSerializable):
         self.fireworks.create_index(
             [("state", DESCENDING), ("spec._priority", DESCENDING),
              ("created_on", ASCENDING)], background=bkground)
+        # for checkouts, which select on the FWorker and category, see FWorker.query
+        sortby = self._get_checkout_sort()
+        self.fireworks.create_index(
+            [("state", ASCENDING), ("_fworker", ASCENDING)] + sortby, background=bkground)
+        self.fireworks.create_index(
+            [("state", ASCENDING), ("_category", ASCENDING), ("_fworker", ASCENDING)] + sortby,
+            background=bkground)
+        self._check_fworker_fields(force=True)
         self.workflows.create_index(
             [("state", DESCENDING), ("_id", DESCENDING)], background=bkground)
 
@@ -1202,10 +1574,15 @@ class LaunchPad(FWSerializable):
             next_launch_id (int): id to give next Launch
         """
         self.fw_id_assigner.delete_many({})
+        # fireworks added from now on have the _fworker and _category fields
+        no_fws = self.fireworks.find_one({}, {'_id': 1}) is None
         self.fw_id_assigner.find_one_and_replace({'_id': -1},
                                                  {'next_fw_id': next_fw_id,
-                                                  'next_launch_id': next_launch_id},
+                                                  'next_launch_id': next_launch_id,
+                                                  'fworker_fields': no_fws},
                                                  upsert=True)
+        self._fw_id_allocator.discard()
+        self._launch_id_allocator.discard()
         self.m_logger.debug(
             'RESTARTED fw_id, launch_id to ({}, {})'.format(next_fw_id,
                                                             next_launch_id))
@@ -1229,51 +1606,200 @@ class LaunchPad(FWSerializable):
             m_fw.fw_id)  # since we updated a state, we need to refresh the WF again
         return False
 
-    def _get_a_fw_to_run(self, query=None, fw_id=None, checkout=True):
+    def _get_a_fw_to_run(self, query=None, fw_id=None, checkout=True, state='RESERVED',
+                         launch_id=None, ready_query=None):
         """
         Get the next ready firework to run.
 
+        The firework is claimed and its document returned by a single find_one_and_update. Its
+        launches are only loaded if it had any before. With a ready_query, the firework is first
+        taken from the ready queue (see _claim_from_ready_queue()); entries of fireworks that are
+        not READY anymore are dropped on the way.
+
         Args:
             query (dict)
             fw_id (int): If given the query is updated.
                 Note: We want to return None if this specific FW  doesn't exist anymore. This is
                 because our queue params might have been tailored to this FW.
-            checkout (bool): if True, check out the matching firework and set state=RESERVED
+            checkout (bool): if True, check out the matching firework and set its state
+            state (str): the state of the checked out firework
+            launch_id (int): if given, the id of the new launch, which is added to the launches of
+                the checked out firework together with the claim. The Launch itself is not
+                loaded and is left to be written by the caller.
+            ready_query (dict): the query of the FWorker on the ready queue, only used to check
+                out without a fw_id
 
         Returns:
             Firework
         """
         m_query = dict(query) if query else {}  # make a defensive copy
         m_query['state'] = 'READY'
-        sortby = [("spec._priority", DESCENDING)]
-
-        if SORT_FWS.upper() == "FIFO":
-            sortby.append(("created_on", ASCENDING))
-        elif SORT_FWS.upper() == "FILO":
-            sortby.append(("created_on", DESCENDING))
+        sortby = self._get_checkout_sort()
 
         # Override query if fw_id defined
         if fw_id:
             m_query = {"fw_id": fw_id, "state": {'$in': ['READY', 'RESERVED']}}
 
+        # updated_on is stored the way Firework.to_db_dict() writes it, see _upsert_fws()
+        update = {'$set': {'state': state,
+                           'updated_on': datetime.datetime.utcnow().isoformat()}}
+        if launch_id is not None:
+            update['$push'] = {'launches': launch_id}
+
+        use_ready_queue = checkout and not fw_id and ready_query is not None
         while True:
+            if use_ready_queue:
+                ready_fw_id = self._claim_from_ready_queue(ready_query)
+                if ready_fw_id is None:
+                    return None
+                m_query = {'fw_id': ready_fw_id, 'state': 'READY'}
             # check out the matching firework, depending on the query set by the FWorker
             if checkout:
-                m_fw = self.fireworks.find_one_and_update(m_query,
-                                                          {'$set': {
-                                                              'state': 'RESERVED',
-                                                              'updated_on': datetime.datetime.utcnow()}},
-                                                          sort=sortby)
+                fw_dict = self.fireworks.find_one_and_update(
+                    m_query, update, sort=sortby, return_document=ReturnDocument.AFTER)
             else:
-                m_fw = self.fireworks.find_one(m_query, {'fw_id': 1, 'spec': 1},
-                                               sort=sortby)
+                fw_dict = self.fireworks.find_one(m_query, sort=sortby)
 
-            if not m_fw:
+            if not fw_dict:
+                if use_ready_queue:
+                    continue  # the entry was stale
                 return None
-            m_fw = self.get_fw_by_id(m_fw['fw_id'])
+            stored_fw_dict = dict(fw_dict)
+            if launch_id is not None:
+                fw_dict['launches'] = [l for l in fw_dict['launches'] if l != launch_id]
+            m_fw = Firework.from_dict(self._load_launch_dicts([fw_dict])[0])
+            m_fw._set_db_dict(stored_fw_dict)
             if self._check_fw_for_uniqueness(m_fw):
                 return m_fw
 
+    def _get_fws_to_run(self, query=None, n=1):
+        """
+        Claim up to n ready fireworks at once and set their state to RESERVED.
+
+        The candidates are first selected with a single sorted query and then claimed with a
+        single update. A random token marks the documents claimed by this call, so that
+        fireworks grabbed by a concurrent worker in the meantime are simply skipped. The token is
+        removed again when the fireworks are written (see checkout_fws()), or right away from the
+        fireworks that turn out to be duplicates.
+
+        Args:
+            query (dict)
+            n (int): maximum number of fireworks to claim
+
+        Returns:
+            [Firework]: the claimed and unique fireworks, in checkout order
+        """
+        m_query = dict(query) if query else {}  # make a defensive copy
+        m_query['state'] = 'READY'
+
+        candidates = [f['fw_id'] for f in self.fireworks.find(
+            m_query, {'fw_id': 1}, sort=self._get_checkout_sort(), limit=n)]
+        if not candidates:
+            return []
+
+        token = str(ObjectId())
+        self.fireworks.update_many({'fw_id': {'$in': candidates}, 'state': 'READY'},
+                                   {'$set': {'state': 'RESERVED',
+                                             'updated_on': datetime.datetime.utcnow().isoformat(),
+                                             '_checkout_token': token}})
+        claimed = {fw.fw_id: fw for fw in self._get_fws_by_query(
+            {'fw_id': {'$in': candidates}, '_checkout_token': token})}
+
+        m_fws = []
+        duplicate_ids = []
+        for fw_id in candidates:
+            if fw_id in claimed:
+                if self._check_fw_for_uniqueness(claimed[fw_id]):
+                    m_fws.append(claimed[fw_id])
+                else:
+                    duplicate_ids.append(fw_id)
+        if duplicate_ids:
+            self.fireworks.update_many({'fw_id': {'$in': duplicate_ids}, '_checkout_token': token},
+                                       {'$unset': {'_checkout_token': ''}})
+        return m_fws
+
+    def _get_fws_by_query(self, query):
+        """
+        Load all fireworks matching a query together with their launches, using one query for
+        the fireworks and one for all of their launches.
+
+        Args:
+            query (dict): a Mongo query on the fireworks collection
+
+        Returns:
+            [Firework]
+        """
+        fws = []
+        for fw_dict in self._get_fw_dicts_by_query(query):
+            fw = Firework.from_dict(fw_dict)
+            fw._set_db_dict(_get_stored_fw_dict(fw_dict))
+            fws.append(fw)
+        return fws
+
+    def _get_fw_dicts_by_query(self, query):
+        """
+        Load the documents of all fireworks matching a query with their launch documents in
+        place of the launch ids, like get_fw_dict_by_id(). Uses one query for the fireworks, one
+        for all of their launches and one for all actions stored in GridFS.
+
+        Args:
+            query (dict): a Mongo query on the fireworks collection
+
+        Returns:
+            [dict]
+        """
+        return self._load_launch_dicts(list(self.fireworks.find(query)))
+
+    def _load_launch_dicts(self, fw_dicts):
+        """
+        Replace the launch ids of firework documents by the launch documents, in place. Uses one
+        query for all of their launches and one for all actions stored in GridFS, none if the
+        fireworks have no launches.
+
+        Args:
+            fw_dicts ([dict]): documents of the fireworks collection
+
+        Returns:
+            [dict]: the given documents
+        """
+        launch_ids = []
+        for fw_dict in fw_dicts:
+            launch_ids.extend(fw_dict['launches'])
+            launch_ids.extend(fw_dict['archived_launches'])
+
+        launches = {}
+        if launch_ids:
+            launch_dicts = list(self.launches.find({'launch_id': {"$in": launch_ids}}))
+            actions = get_actions_from_gridfs([l.get("action") for l in launch_dicts],
+                                              self.gridfs_fallback)
+            for l, action in zip(launch_dicts, actions):
+                l["action"] = action
+                launches[l['launch_id']] = l
+
+        for fw_dict in fw_dicts:
+            for k in ('launches', 'archived_launches'):
+                fw_dict[k] = [launches[l_id] for l_id in sorted(fw_dict[k]) if l_id in launches]
+        return fw_dicts
+
+    @staticmethod
+    def _get_checkout_sort(priority_key="spec._priority"):
+        """
+        Get the sort order in which ready fireworks are checked out.
+
+        Args:
+            priority_key (str): the field of the priority, "priority" in the ready queue
+
+        Returns:
+            [(str, int)]: sort argument in Pymongo format
+        """
+        sortby = [(priority_key, DESCENDING)]
+
+        if SORT_FWS.upper() == "FIFO":
+            sortby.append(("created_on", ASCENDING))
+        elif SORT_FWS.upper() == "FILO":
+            sortby.append(("created_on", DESCENDING))
+        return sortby
+
     def _get_active_launch_ids(self):
         """
         Get all the launch ids.
@@ -1303,6 +1829,22 @@ class LaunchPad(FWSerializable):
         return self.checkout_fw(fworker, launch_dir, host=host, ip=ip,
                                 fw_id=fw_id, state="RESERVED")
 
+    def reserve_fws(self, fworker, n, launch_dir, host=None, ip=None):
+        """
+        Checkout up to n ready fireworks at once and mark their launches reserved.
+
+        Args:
+            fworker (FWorker)
+            n (int): maximum number of fireworks to reserve
+            launch_dir (str): path to the launch directory.
+            host (str): hostname
+            ip (str): ip address
+
+        Returns:
+            [(Firework, int)]: the checked out fireworks and their launch ids
+        """
+        return self.checkout_fws(fworker, n, launch_dir, host=host, ip=ip, state="RESERVED")
+
     def get_fw_ids_from_reservation_id(self, reservation_id):
         """
         Given the reservation id, return the list of firework ids.
@@ -1362,6 +1904,55 @@ class LaunchPad(FWSerializable):
                 {'launches': launch_id, 'state': 'RESERVED'}, {'fw_id': 1}):
             self.rerun_fw(fw['fw_id'], rerun_duplicates=False)
 
+    @staticmethod
+    def _get_stale_launch_query(state, cutoff_time):
+        """
+        Query for the launches in a state that have not been updated since the cutoff time. Uses
+        the indexed state_updated_on field; launches written before that field existed (see
+        migrate_launches()) fall back to a match on the state history.
+
+        Args:
+            state (str): RUNNING or RESERVED
+            cutoff_time (datetime)
+
+        Returns:
+            dict
+        """
+        return {'$or': [
+            {'state': state, 'state_updated_on': {'$lte': cutoff_time}},
+            {'state': state, 'state_updated_on': {'$exists': False},
+             'state_history': {'$elemMatch': {'state': state,
+                                              'updated_on': {'$lte': cutoff_time.isoformat()}}}}]}
+
+    def migrate_launches(self, batch_size=1000):
+        """
+        Set the state_updated_on field of launches stored by older versions of FireWorks, so that
+        detect_lostruns() and detect_unreserved() can use its index.
+
+        Args:
+            batch_size (int): number of launches to update per bulk write
+
+        Returns:
+            int: number of launches updated
+        """
+        n_updated = 0
+        requests = []
+        for ld in self.launches.find({'state_updated_on': {'$exists': False}},
+                                     {'launch_id': 1, 'state_history': 1}):
+            history = ld.get('state_history') or [{}]
+            # same as Launch.state_updated_on, without loading the whole launch
+            updated_on = reconstitute_dates(history[-1].get('updated_on') or
+                                            history[-1].get('created_on'))
+            requests.append(UpdateOne({'_id': ld['_id']},
+                                      {'$set': {'state_updated_on': updated_on}}))
+            if len(requests) >= batch_size:
+                n_updated += self.launches.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            n_updated += self.launches.bulk_write(requests, ordered=False).modified_count
+        self.m_logger.info('Updated {} launches'.format(n_updated))
+        return n_updated
+
     def detect_unreserved(self, expiration_secs=RESERVATION_EXPIRATION_SECS,
                           rerun=False):
         """
@@ -1374,29 +1965,47 @@ class LaunchPad(FWSerializable):
         Returns:
             [int]: list of expired launch ids
         """
-        bad_launch_ids = []
         now_time = datetime.datetime.utcnow()
-        cutoff_timestr = (now_time - datetime.timedelta(
-            seconds=expiration_secs)).isoformat()
-        bad_launch_data = self.launches.find({'state': 'RESERVED',
-                                              'state_history':
-                                                  {'$elemMatch':
-                                                       {'state': 'RESERVED',
-                                                        'updated_on': {
-                                                            '$lte': cutoff_timestr}
-                                                        }
-                                                   }
-                                              },
-                                             {'launch_id': 1, 'fw_id': 1})
-        for ld in bad_launch_data:
-            if self.fireworks.find_one(
-                    {'fw_id': ld['fw_id'], 'state': 'RESERVED'}, {'fw_id': 1}):
-                bad_launch_ids.append(ld['launch_id'])
+        cutoff_time = now_time - datetime.timedelta(seconds=expiration_secs)
+        # expired reservations whose firework is still RESERVED, in one pass. The equality
+        # lookup uses the fw_id index of the fireworks, unlike a lookup with a pipeline
+        pipeline = [
+            {'$match': self._get_stale_launch_query('RESERVED', cutoff_time)},
+            {'$project': {'launch_id': 1, 'fw_id': 1}},
+            {'$lookup': {'from': self.fireworks.name, 'localField': 'fw_id',
+                         'foreignField': 'fw_id', 'as': 'fws'}},
+            {'$match': {'fws.state': 'RESERVED'}},
+            {'$project': {'launch_id': 1}}]
+        bad_launch_ids = [ld['launch_id'] for ld in self.launches.aggregate(pipeline)]
         if rerun:
             for lid in bad_launch_ids:
                 self.cancel_reservation(lid)
         return bad_launch_ids
 
+    def _fizzle_launches(self, launch_ids):
+        """
+        Mark many launches as FIZZLED like mark_fizzled(), with one bulk write for the launches,
+        then refresh each affected workflow once.
+
+        Args:
+            launch_ids ([int])
+        """
+        if not launch_ids:
+            return
+        self._forget_ping_trackers(launch_ids)
+        requests = []
+        # the action is neither needed nor modified
+        for ld in self.launches.find({'launch_id': {'$in': list(launch_ids)}}, {'action': 0}):
+            m_launch = Launch.from_dict(ld)
+            m_launch.state = 'FIZZLED'
+            m_dict = m_launch.to_db_dict()
+            requests.append(UpdateOne({'launch_id': m_launch.launch_id},
+                                      {'$set': {k: v for k, v in m_dict.items()
+                                                if k not in ('action', 'launch_id')}}))
+        if requests:
+            self.launches.bulk_write(requests, ordered=False)
+        self._refresh_wfs(self.fireworks.distinct('fw_id', {'launches': {'$in': list(launch_ids)}}))
+
     def mark_fizzled(self, launch_id):
         """
         Mark the launch corresponding to the given id as FIZZLED.
@@ -1434,34 +2043,31 @@ class LaunchPad(FWSerializable):
                 inconsistent firework ids.
         """
         lost_launch_ids = []
-        lost_fw_ids = []
         potential_lost_fw_ids = []
         now_time = datetime.datetime.utcnow()
-        cutoff_timestr = (now_time - datetime.timedelta(
-            seconds=expiration_secs)).isoformat()
+        cutoff_time = now_time - datetime.timedelta(seconds=expiration_secs)
 
-        lostruns_query = launch_query or {}
-        lostruns_query["state"] = "RUNNING"
-        lostruns_query["state_history"] = {'$elemMatch': {'state': 'RUNNING',
-                                                          'updated_on': {
-                                                              '$lte': cutoff_timestr}
-                                                          }
-                                           }
+        lostruns_query = self._get_stale_launch_query('RUNNING', cutoff_time)
+        if launch_query:
+            lostruns_query = {'$and': [launch_query, lostruns_query]}
 
         if query:
             fw_ids = [x["fw_id"] for x in self.fireworks.find(query,
                                                               {"fw_id": 1})]
             lostruns_query["fw_id"] = {"$in": fw_ids}
 
-        bad_launch_data = self.launches.find(lostruns_query,
-                                             {'launch_id': 1, 'fw_id': 1})
+        projection = {'launch_id': 1, 'fw_id': 1}
+        if max_runtime or min_runtime:
+            projection['state_history'] = 1
+        bad_launch_data = self.launches.find(lostruns_query, projection)
         for ld in bad_launch_data:
             bad_launch = True
             if max_runtime or min_runtime:
                 bad_launch = False
-                m_l = self.get_launch_by_id(ld['launch_id'])
-                utime = m_l._get_time('RUNNING', use_update_time=True)
-                ctime = m_l._get_time('RUNNING', use_update_time=False)
+                # same as Launch._get_time('RUNNING'), without loading the whole launch
+                running = next(h for h in ld['state_history'] if h['state'] == 'RUNNING')
+                utime = reconstitute_dates(running['updated_on'])
+                ctime = reconstitute_dates(running['created_on'])
                 if (not max_runtime or (
                         utime - ctime).seconds <= max_runtime) and \
                         (not min_runtime or (
@@ -1471,56 +2077,53 @@ class LaunchPad(FWSerializable):
                 lost_launch_ids.append(ld['launch_id'])
                 potential_lost_fw_ids.append(ld['fw_id'])
 
-        for fw_id in potential_lost_fw_ids:  # tricky: figure out what's actually lost
-            f = self.fireworks.find_one({"fw_id": fw_id},
-                                        {"launches": 1, "state": 1})
-            # only RUNNING FireWorks can be "lost", i.e. not defused or archived
-            if f['state'] == "RUNNING":
-                l_ids = f["launches"]
-                not_lost = [x for x in l_ids if x not in lost_launch_ids]
-                if len(not_lost) == 0:  # all launches are lost - we are lost!
-                    lost_fw_ids.append(fw_id)
-                else:
-                    for l_id in not_lost:
-                        l_state = self.launches.find_one({"launch_id": l_id},
-                                                         {"state": 1})['state']
-                        if Firework.STATE_RANKS[l_state] > Firework.STATE_RANKS['FIZZLED']:
-                            break
-                    else:
-                        lost_fw_ids.append(
-                            fw_id)  # all Launches not lost are anyway FIZZLED / ARCHIVED
+        # tricky: figure out what's actually lost. Only RUNNING FireWorks can be "lost", i.e.
+        # not defused or archived, and only if all launches that are not lost are anyway
+        # FIZZLED / ARCHIVED
+        alive_states = [state for state, rank in Firework.STATE_RANKS.items()
+                        if rank > Firework.STATE_RANKS['FIZZLED']]
+        # the equality lookups use the launch_id index of the launches, unlike lookups with a
+        # pipeline, which scan the whole collection for every firework
+        pipeline = [
+            {'$match': {'fw_id': {'$in': potential_lost_fw_ids}, 'state': 'RUNNING'}},
+            {'$project': {'fw_id': 1, 'launches': 1}},
+            {'$lookup': {'from': self.launches.name, 'localField': 'launches',
+                         'foreignField': 'launch_id', 'as': 'launches'}},
+            {'$project': {'fw_id': 1, 'alive_launches': {'$filter': {
+                'input': '$launches', 'as': 'launch',
+                'cond': {'$and': [
+                    {'$not': [{'$in': ['$$launch.launch_id', lost_launch_ids]}]},
+                    {'$in': ['$$launch.state', alive_states]}]}}}}},
+            {'$match': {'alive_launches': []}},
+            {'$project': {'fw_id': 1}}]
+        lost = set(f['fw_id'] for f in self.fireworks.aggregate(pipeline)) \
+            if potential_lost_fw_ids else set()
+        lost_fw_ids = [fw_id for fw_id in potential_lost_fw_ids if fw_id in lost]
 
         if fizzle or rerun:
-            for lid in lost_launch_ids:
-                self.mark_fizzled(lid)
-
-                # for offline runs, you want to forget about the run
-                # see: https://groups.google.com/forum/#!topic/fireworkflows/oimFmE5tZ4E
-                offline_run = self.offline_runs.find(
-                    {"launch_id": lid, "deprecated": False}).count() > 0
-                if offline_run:
-                    self.forget_offline(lid, launch_mode=True)
-
-                if rerun:
-                    fw_id = \
-                        self.launches.find_one({"launch_id": lid},
-                                               {"fw_id": 1})[
-                            'fw_id']
-                    if fw_id in lost_fw_ids:
-                        self.rerun_fw(fw_id)
-
-        inconsistent_fw_ids = []
+            self._fizzle_launches(lost_launch_ids)
+
+            # for offline runs, you want to forget about the run
+            # see: https://groups.google.com/forum/#!topic/fireworkflows/oimFmE5tZ4E
+            self.offline_runs.update_many({"launch_id": {"$in": lost_launch_ids}},
+                                          {"$set": {"deprecated": True}})
+
+            if rerun:
+                for fw_id in lost_fw_ids:
+                    self.rerun_fw(fw_id)
+
         inconsistent_query = query or {}
         inconsistent_query['state'] = 'RUNNING'
-        running_fws = self.fireworks.find(inconsistent_query,
-                                          {'fw_id': 1, 'launches': 1})
-        for fw in running_fws:
-            if self.launches.find_one({'launch_id': {'$in': fw['launches']},
-                                       'state': {
-                                           '$in': ['FIZZLED', 'COMPLETED']}}):
-                inconsistent_fw_ids.append(fw['fw_id'])
-                if refresh:
-                    self._refresh_wf(fw['fw_id'])
+        pipeline = [
+            {'$match': inconsistent_query},
+            {'$project': {'fw_id': 1, 'launches': 1}},
+            {'$lookup': {'from': self.launches.name, 'localField': 'launches',
+                         'foreignField': 'launch_id', 'as': 'launches'}},
+            {'$match': {'launches.state': {'$in': ['FIZZLED', 'COMPLETED']}}},
+            {'$project': {'fw_id': 1}}]
+        inconsistent_fw_ids = [f['fw_id'] for f in self.fireworks.aggregate(pipeline)]
+        if refresh:
+            self._refresh_wfs(inconsistent_fw_ids)
 
         return lost_launch_ids, lost_fw_ids, inconsistent_fw_ids
 
@@ -1543,6 +2146,11 @@ class LaunchPad(FWSerializable):
         Checkout the next ready firework, mark it with the given state(RESERVED or RUNNING) and
         return it to the caller. The caller is responsible for running the Firework.
 
+        Unless a specific fw_id is asked for, a new launch id is allocated before the firework is
+        claimed, so that the claim sets the state and adds the launch at once. Then the Launch is
+        written and the new state recorded in the workflow with one bulk write (see
+        _checkout_wf()).
+
         Args:
             fworker (FWorker): A FWorker instance
             launch_dir (str): the dir the FW will be run in (for creating a Launch object)
@@ -1554,8 +2162,15 @@ class LaunchPad(FWSerializable):
         Returns:
             (Firework, int): firework and the new launch id
         """
-        m_fw = self._get_a_fw_to_run(fworker.query, fw_id=fw_id)
+        self._check_fworker_fields()
+        # a specific firework is usually reserved already, with a launch to reuse
+        new_launch_id = None if fw_id else self.get_new_launch_id()
+        m_fw = self._get_a_fw_to_run(fworker.query, fw_id=fw_id, state=state,
+                                     launch_id=new_launch_id,
+                                     ready_query=self._get_ready_queue_query(fworker))
         if not m_fw:
+            if new_launch_id is not None:
+                self._launch_id_allocator.put_back(new_launch_id)
             return None, None
 
         # If this Launch was previously reserved, overwrite that reservation with this Launch
@@ -1566,7 +2181,12 @@ class LaunchPad(FWSerializable):
         state_history = reserved_launch.state_history if reserved_launch else None
 
         # get new launch
-        launch_id = reserved_launch.launch_id if reserved_launch else self.get_new_launch_id()
+        if reserved_launch:
+            launch_id = reserved_launch.launch_id
+            if new_launch_id is not None:
+                self._launch_id_allocator.put_back(new_launch_id)
+        else:
+            launch_id = new_launch_id if new_launch_id is not None else self.get_new_launch_id()
         trackers = [Tracker.from_dict(f) for f in m_fw.spec[
             '_trackers']] if '_trackers' in m_fw.spec else None
         m_launch = Launch(state, launch_dir, fworker, host, ip,
@@ -1575,8 +2195,8 @@ class LaunchPad(FWSerializable):
                           fw_id=m_fw.fw_id)
 
         # insert the launch
-        self.launches.find_one_and_replace({'launch_id': m_launch.launch_id},
-                                           m_launch.to_db_dict(), upsert=True)
+        self.launches.replace_one({'launch_id': m_launch.launch_id},
+                                  m_launch.to_db_dict(), upsert=True)
 
         self.m_logger.debug(
             'Created/updated Launch with launch_id: {}'.format(launch_id))
@@ -1591,23 +2211,14 @@ class LaunchPad(FWSerializable):
                 m_launch if l.launch_id == m_launch.launch_id else l for l in
                 m_fw.launches]
 
-        # insert the firework and refresh the workflow
-        m_fw.state = state
+        # the claim already stored the state and the new launch, if any
         self._upsert_fws([m_fw])
-        self._refresh_wf(m_fw.fw_id)
-
-        # update any duplicated runs
-        if state == "RUNNING":
-            for fw in self.fireworks.find(
-                    {'launches': launch_id,
-                     'state': {
-                         '$in': ['WAITING', 'READY', 'RESERVED', 'FIZZLED']}},
-                    {'fw_id': 1}):
-                fw_id = fw['fw_id']
-                fw = self.get_fw_by_id(fw_id)
-                fw.state = state
-                self._upsert_fws([fw])
-                self._refresh_wf(fw.fw_id)
+        if not self._checkout_wf(m_fw):
+            self._refresh_wf(m_fw.fw_id)
+
+        # update any duplicated runs, which can only share a launch that existed before
+        if state == "RUNNING" and reserved_launch:
+            fw_id = self._update_duplicate_runs(launch_id, state) or fw_id
 
         # Store backup copies of the initial data for retrieval in case of failure
         self.backup_launch_data[m_launch.launch_id] = m_launch.to_db_dict()
@@ -1617,6 +2228,149 @@ class LaunchPad(FWSerializable):
 
         return m_fw, launch_id
 
+    def _checkout_wf(self, m_fw):
+        """
+        Record the state of a checked out firework in its workflow without locking, loading and
+        refreshing the workflow. Checking out a firework does not change its children, and the
+        workflow state follows from its previous state: RESERVED and RUNNING fireworks promote
+        a workflow that is READY (or RESERVED) but leave the other states alone. Both cases are
+        written in one ordered bulk write, each conditioned on the previous workflow state.
+
+        The workflow is only written while it is not locked, and the version of the workflow is
+        incremented (see _get_version_update()), so that the change is seen by locked and
+        optimistic refreshes alike.
+
+        Args:
+            m_fw (Firework): the checked out firework, with its new launch
+
+        Returns:
+            bool: False if the workflow must be refreshed instead, e.g. because it is locked
+        """
+        m_launch = Workflow._get_representative_launch(m_fw)
+        if m_fw.state not in ('RESERVED', 'RUNNING') or not m_launch or \
+                m_launch.state != m_fw.state:
+            return False
+        promoted_states = ['READY', 'RESERVED'] + (['RUNNING'] if m_fw.state == 'RUNNING' else [])
+        m_set = {'fw_states.{}'.format(m_fw.fw_id): m_fw.state,
+                 'updated_on': datetime.datetime.utcnow()}
+        update = self._get_version_update({'fw_ids': [m_fw.fw_id]})
+        query = {'nodes': m_fw.fw_id, 'locked': {'$exists': False}}
+        result = self.workflows.bulk_write([
+            UpdateOne(dict(query, state={'$in': promoted_states}),
+                      dict(update, **{'$set': dict(m_set, state=m_fw.state)})),
+            UpdateOne(dict(query, state={'$nin': promoted_states}),
+                      dict(update, **{'$set': m_set}))])
+        return result.matched_count > 0
+
+    def checkout_fws(self, fworker, n, launch_dir, host=None, ip=None, state="RESERVED"):
+        """
+        Checkout up to n ready fireworks at once, mark them with the given state (RESERVED or
+        RUNNING) and return them to the caller. This is the batched version of checkout_fw():
+        the fireworks are claimed with a single update, new launch ids are allocated in one
+        request and launches and fireworks are written with one bulk write each, the fireworks
+        with only the fields that changed. As in checkout_fw(), the new states are recorded in
+        the workflows without refreshing them (see _checkout_wf()); only the workflows that
+        are locked are refreshed, each of them once.
+
+        Args:
+            fworker (FWorker): A FWorker instance
+            n (int): maximum number of fireworks to checkout
+            launch_dir (str): the dir the FWs will be run in (for creating the Launch objects)
+            host (str): the host making the request (for creating the Launch objects)
+            ip (str): the ip making the request (for creating the Launch objects)
+            state (str): RESERVED or RUNNING, the fetched fireworks' state will be set to this value.
+
+        Returns:
+            [(Firework, int)]: list of fireworks and their launch ids, in checkout order
+        """
+        self._check_fworker_fields()
+        m_fws = self._get_fws_to_run(fworker.query, n=n)
+        if not m_fws:
+            return []
+
+        # reuse previous reservations, as in checkout_fw()
+        reserved_launches = {}
+        for m_fw in m_fws:
+            prev_reservations = [l for l in m_fw.launches if l.state == 'RESERVED']
+            reserved_launches[m_fw.fw_id] = prev_reservations[0] if prev_reservations else None
+
+        n_new = len([l for l in reserved_launches.values() if l is None])
+        next_launch_id = self.get_new_launch_id(quantity=n_new) if n_new else None
+
+        checked_out = []
+        launch_requests = []
+        for m_fw in m_fws:
+            reserved_launch = reserved_launches[m_fw.fw_id]
+            if reserved_launch:
+                launch_id = reserved_launch.launch_id
+                state_history = reserved_launch.state_history
+            else:
+                launch_id = next_launch_id
+                next_launch_id += 1
+                state_history = None
+
+            trackers = [Tracker.from_dict(f) for f in m_fw.spec[
+                '_trackers']] if '_trackers' in m_fw.spec else None
+            m_launch = Launch(state, launch_dir, fworker, host, ip,
+                              trackers=trackers,
+                              state_history=state_history, launch_id=launch_id,
+                              fw_id=m_fw.fw_id)
+            launch_requests.append(ReplaceOne({'launch_id': launch_id},
+                                              m_launch.to_db_dict(), upsert=True))
+
+            if not reserved_launch:
+                m_fw.launches.append(m_launch)
+            else:
+                m_fw.launches = [m_launch if l.launch_id == launch_id else l
+                                 for l in m_fw.launches]
+            m_fw.state = state
+            checked_out.append((m_fw, m_launch))
+
+        self.launches.bulk_write(launch_requests, ordered=False)
+        self.m_logger.debug('Created/updated Launches with launch_ids: {}'.format(
+            [m_launch.launch_id for _, m_launch in checked_out]))
+        self._upsert_fws(list(m_fws))
+        unrecorded_ids = [m_fw.fw_id for m_fw in m_fws if not self._checkout_wf(m_fw)]
+        if unrecorded_ids:
+            self._refresh_wfs(unrecorded_ids)
+
+        for m_fw, m_launch in checked_out:
+            # update any duplicated runs
+            if state == "RUNNING":
+                self._update_duplicate_runs(m_launch.launch_id, state)
+
+            # Store backup copies of the initial data for retrieval in case of failure
+            self.backup_launch_data[m_launch.launch_id] = m_launch.to_db_dict()
+            self.backup_fw_data[m_fw.fw_id] = m_fw.to_db_dict()
+            self.m_logger.debug('{} FW with id: {}'.format(m_fw.state, m_fw.fw_id))
+
+        return [(m_fw, m_launch.launch_id) for m_fw, m_launch in checked_out]
+
+    def _update_duplicate_runs(self, launch_id, state):
+        """
+        Set the state of all other fireworks sharing the given launch (i.e. duplicates) and
+        refresh their workflows.
+
+        Args:
+            launch_id (int)
+            state (str)
+
+        Returns:
+            int: the fw_id of the last updated duplicate, None if there were none
+        """
+        fw_id = None
+        for fw in self.fireworks.find(
+                {'launches': launch_id,
+                 'state': {
+                     '$in': ['WAITING', 'READY', 'RESERVED', 'FIZZLED']}},
+                {'fw_id': 1}):
+            fw_id = fw['fw_id']
+            fw = self.get_fw_by_id(fw_id)
+            fw.state = state
+            self._upsert_fws([fw])
+            self._refresh_wf(fw.fw_id)
+        return fw_id
+
     def change_launch_dir(self, launch_id, launch_dir):
         """
         Change the launch directory corresponding to the given launch id.
@@ -1655,11 +2409,98 @@ class LaunchPad(FWSerializable):
             dict: updated launch
         """
         # update the launch data to COMPLETED, set end time, etc
+        self._forget_ping_trackers([launch_id])
         m_launch = self.get_launch_by_id(launch_id)
         m_launch.state = state
         if action:
             m_launch.action = action
+        self._replace_launch(m_launch)
+
+        # find all the fws that have this launch
+        fw_ids = [fw['fw_id'] for fw in self.fireworks.find({'launches': launch_id}, {'fw_id': 1})]
+        if COMPLETION_QUEUE:
+            # the workflows are refreshed by the reducer, see reduce_completions()
+            self.completion_events.insert_one({'fw_ids': fw_ids, 'launch_id': launch_id,
+                                               'created_on': datetime.datetime.utcnow(),
+                                               'claimed_until': None})
+        else:
+            for fw_id in fw_ids:
+                self._refresh_wf(fw_id)
+
+        # change return type to dict to make return type serializable to support job packing
+        return m_launch.to_dict()
+
+    def complete_launches(self, completions):
+        """
+        Mark many Launches as completed at once: the launches are loaded with one query and
+        stored with one bulk write, and the workflows are refreshed once each (or the
+        completions are queued for the reducer, see COMPLETION_QUEUE in fw_config). A workflow
+        that cannot be refreshed, e.g. because of a broken FWAction, is marked as FIZZLED and
+        does not hold up the others.
+
+        Args:
+            completions ([tuple]): (launch_id, action, state, completed_on) tuples with the
+                FWAction of what to do next, COMPLETED or FIZZLED and the time the launch
+                reached that state (None for now)
+
+        Returns:
+            [int]: ids of the launches that were completed, unknown launches are skipped
+        """
+        completions = OrderedDict((c[0], c) for c in completions)
+        self._forget_ping_trackers(completions)
+        launch_dicts = list(self.launches.find({'launch_id': {'$in': list(completions)}}))
+        actions = get_actions_from_gridfs([ld.get('action') for ld in launch_dicts],
+                                          self.gridfs_fallback)
+        m_launches = []
+        for ld, action_dict in zip(launch_dicts, actions):
+            ld['action'] = action_dict
+            m_launch = Launch.from_dict(ld)
+            launch_id, action, state, completed_on = completions[m_launch.launch_id]
+            n_history = len(m_launch.state_history)
+            m_launch.state = state
+            if completed_on and len(m_launch.state_history) > n_history:
+                m_launch.state_history[-1]['created_on'] = completed_on
+            if action:
+                m_launch.action = action
+            m_launches.append(m_launch)
+        if not m_launches:
+            return []
 
+        try:
+            self.launches.bulk_write([ReplaceOne({'launch_id': l.launch_id}, l.to_db_dict(),
+                                                 upsert=True) for l in m_launches],
+                                     ordered=False)
+        except DocumentTooLarge:
+            # store them one by one, moving the actions that are too large to gridfs
+            for m_launch in m_launches:
+                self._replace_launch(m_launch)
+
+        launch_ids = [l.launch_id for l in m_launches]
+        fw_dicts = list(self.fireworks.find({'launches': {'$in': launch_ids}},
+                                            {'fw_id': 1, 'launches': 1}))
+        if COMPLETION_QUEUE:
+            now = datetime.datetime.utcnow()
+            self.completion_events.insert_many(
+                [{'fw_ids': [f['fw_id'] for f in fw_dicts if launch_id in f['launches']],
+                  'launch_id': launch_id, 'created_on': now, 'claimed_until': None}
+                 for launch_id in launch_ids])
+        else:
+            for group in self._group_by_wf([f['fw_id'] for f in fw_dicts]):
+                try:
+                    self._refresh_wf_group(group)
+                except RuntimeError:
+                    # the broken fireworks were marked as FIZZLED, go on with the other workflows
+                    self.m_logger.error("Error refreshing the workflow of fw_ids {}: {}".format(
+                        group, traceback.format_exc()))
+        return launch_ids
+
+    def _replace_launch(self, m_launch):
+        """
+        Store a Launch, moving its action to gridfs if the document is too large.
+
+        Args:
+            m_launch (Launch)
+        """
         try:
             self.launches.find_one_and_replace(
                 {'launch_id': m_launch.launch_id},
@@ -1681,7 +2522,7 @@ class LaunchPad(FWSerializable):
             action_id = self.gridfs_fallback.put(json.dumps(action_dict),
                                                  encoding="utf-8",
                                                  metadata={
-                                                     "launch_id": launch_id})
+                                                     "launch_id": m_launch.launch_id})
             launch_db_dict["action"] = {"gridfs_id": str(action_id)}
             self.m_logger.warning(
                 "The size of the launch document was too large. Saving "
@@ -1691,33 +2532,98 @@ class LaunchPad(FWSerializable):
                 {'launch_id': m_launch.launch_id},
                 launch_db_dict, upsert=True)
 
-        # find all the fws that have this launch
-        for fw in self.fireworks.find({'launches': launch_id}, {'fw_id': 1}):
-            fw_id = fw['fw_id']
-            self._refresh_wf(fw_id)
-
-        # change return type to dict to make return type serializable to support job packing
-        return m_launch.to_dict()
-
     def ping_launch(self, launch_id, ptime=None, checkpoint=None):
         """
         Ping that a Launch is still alive: updates the 'update_on 'field of the state history of a
         Launch.
 
+        A ping is a single update of the last (RUNNING) entry of the state history. Only the
+        first ping of a Launch reads its launch_dir and trackers; they are kept for the next
+        pings, so that the trackers only read what was appended to their files meanwhile.
+
         Args:
             launch_id (int)
             ptime (datetime)
+            checkpoint (dict)
         """
-        m_launch = self.get_launch_by_id(launch_id)
-        for tracker in m_launch.trackers:
-            tracker.track_file(m_launch.launch_dir)
-        m_launch.touch_history(ptime, checkpoint=checkpoint)
-        self.launches.update_one({'launch_id': launch_id, 'state': 'RUNNING'},
-                                 {'$set': {
-                                     'state_history': m_launch.to_db_dict()[
-                                         'state_history'],
-                                     'trackers': [t.to_dict() for t in
-                                                  m_launch.trackers]}})
+        self._load_ping_trackers([launch_id])
+        if launch_id not in self._ping_trackers:
+            raise ValueError('No Launch exists with launch_id: {}'.format(launch_id))
+        result = self.launches.update_one(*self._get_ping_update(launch_id, ptime, checkpoint))
+        if not result.matched_count:
+            self._forget_ping_trackers([launch_id])  # the launch is not running anymore
+
+    def ping_launches(self, launch_ids, ptime=None, checkpoints=None):
+        """
+        Ping many Launches at once, like ping_launch() but with a single bulk write. Unknown
+        launch ids are ignored.
+
+        Args:
+            launch_ids ([int])
+            ptime (datetime)
+            checkpoints (dict): checkpoints of some of the Launches, by launch_id
+
+        Returns:
+            int: number of running Launches that were pinged
+        """
+        checkpoints = checkpoints or {}
+        self._load_ping_trackers(launch_ids)
+        requests = [UpdateOne(*self._get_ping_update(launch_id, ptime,
+                                                     checkpoints.get(launch_id)))
+                    for launch_id in launch_ids if launch_id in self._ping_trackers]
+        if not requests:
+            return 0
+        return self.launches.bulk_write(requests, ordered=False).matched_count
+
+    def _load_ping_trackers(self, launch_ids):
+        """
+        Load the launch_dir and trackers of the Launches that were not pinged yet, in one query.
+
+        Args:
+            launch_ids ([int])
+        """
+        missing = [launch_id for launch_id in launch_ids if launch_id not in self._ping_trackers]
+        if missing:
+            for ld in self.launches.find({'launch_id': {'$in': missing}},
+                                         {'launch_id': 1, 'launch_dir': 1, 'trackers': 1}):
+                self._ping_trackers[ld['launch_id']] = (ld['launch_dir'],
+                                                        [Tracker.from_dict(t) for t in
+                                                         ld.get('trackers') or []])
+
+    def _forget_ping_trackers(self, launch_ids):
+        """
+        Drop the trackers kept for pinging Launches that are not running anymore.
+
+        Args:
+            launch_ids ([int])
+        """
+        for launch_id in launch_ids:
+            self._ping_trackers.pop(launch_id, None)
+
+    def _get_ping_update(self, launch_id, ptime=None, checkpoint=None):
+        """
+        Args:
+            launch_id (int): a Launch whose trackers are loaded
+            ptime (datetime)
+            checkpoint (dict)
+
+        Returns:
+            (dict, dict): the filter and update that ping the Launch
+        """
+        launch_dir, trackers = self._ping_trackers[launch_id]
+        ptime = reconstitute_dates(ptime) if ptime else datetime.datetime.utcnow()
+        m_set = {'state_history.$.updated_on': recursive_dict(ptime),
+                 'state_updated_on': ptime}
+        if checkpoint:
+            m_set['state_history.$.checkpoint'] = recursive_dict(checkpoint)
+        old_contents = [t.content for t in trackers]
+        for tracker in trackers:
+            tracker.track_file(launch_dir)
+        if [t.content for t in trackers] != old_contents:
+            m_set['trackers'] = [t.to_dict() for t in trackers]
+        # the last entry of the history of a RUNNING launch is its only RUNNING entry
+        return ({'launch_id': launch_id, 'state': 'RUNNING', 'state_history.state': 'RUNNING'},
+                {'$set': m_set})
 
     def get_new_fw_id(self, quantity=1):
         """
@@ -1728,26 +2634,28 @@ class LaunchPad(FWSerializable):
                             this then returns the *first* fw_id in that range
         """
         try:
-            return self.fw_id_assigner.find_one_and_update({}, {
-                '$inc': {'next_fw_id': quantity}})['next_fw_id']
+            return self._fw_id_allocator.get(quantity)
         except Exception:
             raise ValueError(
                 "Could not get next FW id! If you have not yet initialized the database,"
                 " please do so by performing a database reset (e.g., lpad reset)")
 
-    def get_new_launch_id(self):
+    def get_new_launch_id(self, quantity=1):
         """
         Checkout the next Launch id
+
+        Args:
+            quantity (int): optionally ask for many ids, otherwise defaults to 1
+                            this then returns the *first* launch_id in that range
         """
         try:
-            return self.fw_id_assigner.find_one_and_update({}, {
-                '$inc': {'next_launch_id': 1}})['next_launch_id']
+            return self._launch_id_allocator.get(quantity)
         except Exception:
             raise ValueError(
                 "Could not get next launch id! If you have not yet initialized the "
                 "database, please do so by performing a database reset (e.g., lpad reset)")
 
-    def _upsert_fws(self, fws, reassign_all=False):
+    def _upsert_fws(self, fws, reassign_all=False, lock=None):
         """
         Insert the fireworks to the 'fireworks' collection.
 
@@ -1755,9 +2663,14 @@ class LaunchPad(FWSerializable):
             fws ([Firework]): list of fireworks
             reassign_all (bool): if True, reassign the firework ids. The ids are also reassigned
                 if the current firework ids are negative.
+            lock (WFLock): the lock of the workflow of the fireworks. Its token is stored with
+                the fireworks, and fireworks stored with a later token are not overwritten.
 
         Returns:
             dict: mapping between old and new Firework ids
+
+        Raises:
+            LostWorkflowLockError: if a firework was stored with a later token of the lock
         """
         old_new = {}
         # sort the FWs by id, then the new FW_ids will match the order of the old ones...
@@ -1777,18 +2690,68 @@ class LaunchPad(FWSerializable):
             self.fireworks.delete_many({'fw_id': {'$in': used_ids}})
             self.fireworks.insert_many((fw.to_db_dict() for fw in fws))
         else:
-            for fw in fws:
-                if fw.fw_id < 0:
-                    new_id = self.get_new_fw_id()
+            # allocate the ids of all new fireworks at once
+            new_fws = [fw for fw in fws if fw.fw_id < 0]
+            if new_fws:
+                first_new_id = self.get_new_fw_id(quantity=len(new_fws))
+                for new_id, fw in enumerate(new_fws, start=first_new_id):
                     old_new[fw.fw_id] = new_id
                     fw.fw_id = new_id
+                    fw._set_db_dict(None)  # not stored yet
 
-                self.fireworks.find_one_and_replace({'fw_id': fw.fw_id},
-                                                    fw.to_db_dict(),
-                                                    upsert=True)
+            token = lock.token if lock else None
+            new_ids = set(old_new.values())
+            requests = []
+            for fw in fws:
+                request = self._get_fw_write_request(fw, token, fw.fw_id in new_ids)
+                if request:
+                    requests.append(request)
+            if requests:
+                result = self.fireworks.bulk_write(requests, ordered=True)
+                n_existing = sum(1 for fw in fws if fw.fw_id not in new_ids)
+                if token is not None and result.matched_count < n_existing:
+                    raise LostWorkflowLockError(
+                        "Lost the lock of workflow - LOCKED: {}".format(lock.fw_id))
 
         return old_new
 
+    @staticmethod
+    def _get_fw_write_request(fw, token=None, new=False):
+        """
+        Get the write operation that stores a firework. Fireworks whose stored document is known
+        are updated with only the fields that changed, others are replaced (or inserted) as a
+        whole.
+
+        Args:
+            fw (Firework/LazyFirework)
+            token (int): the token of the WFLock held by the writer, see WFLock
+            new (bool): whether the firework is not stored yet
+
+        Returns:
+            ReplaceOne/UpdateOne: None if nothing changed and no token is given
+        """
+        query = {'fw_id': fw.fw_id}
+        if token is not None and not new:
+            # fencing: do not overwrite the changes of a later holder of the lock
+            query['wf_lock_token'] = {'$not': {'$gt': token}}
+        changes = fw._get_db_changes()
+        if changes is None:
+            m_dict = fw.to_db_dict()
+            if token is not None:
+                m_dict['wf_lock_token'] = token
+            # a firework that is not new, but whose stored document is unknown, exists already
+            return ReplaceOne(query, m_dict, upsert=new or token is None)
+        to_set, to_unset = changes
+        to_unset = [k for k in to_unset if k != 'wf_lock_token']
+        if token is not None:
+            to_set['wf_lock_token'] = token
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = {k: "" for k in to_unset}
+        return UpdateOne(query, update) if update else None
+
     def rerun_fw(self, fw_id, rerun_duplicates=True, recover_launch=None,
                  recover_mode=None):
         """
@@ -1806,7 +2769,7 @@ class LaunchPad(FWSerializable):
         Returns:
             [int]: list of firework ids that were rerun
         """
-        m_fw = self.fireworks.find_one({"fw_id": fw_id}, {"state": 1})
+        m_fw = self.fireworks.find_one({"fw_id": fw_id}, {"state": 1, "launches": 1})
 
         if not m_fw:
             raise ValueError("FW with id: {} not found!".format(fw_id))
@@ -1851,11 +2814,12 @@ class LaunchPad(FWSerializable):
                 "Skipping rerun fw_id: {}: it is already WAITING.".format(
                     fw_id))
         else:
-            with WFLock(self, fw_id):
+            with WFLock(self, fw_id) as lock:
                 wf = self.get_wf_by_fw_id_lzyfw(fw_id)
                 updated_ids = wf.rerun_fw(fw_id)
-                self._update_wf(wf, updated_ids)
+                self._update_wf(wf, updated_ids, lock)
                 reruns.append(fw_id)
+            self._forget_ping_trackers(m_fw.get('launches', []))
 
         # rerun duplicated FWs
         for f in duplicates:
@@ -1892,16 +2856,22 @@ class LaunchPad(FWSerializable):
 
         Args:
             fw_id (int): the parent fw_id - children will be refreshed
+
+        Returns:
+            bool: False if the workflow was locked and could not be refreshed
+
+        Raises:
+            LostWorkflowLockError: if the lock was taken over during every attempt to refresh
         """
         # TODO: time how long it took to refresh the WF!
         # TODO: need a try-except here, high probability of failure if incorrect action supplied
         try:
-            with WFLock(self, fw_id):
-                wf = self.get_wf_by_fw_id_lzyfw(fw_id)
-                updated_ids = wf.refresh(fw_id)
-                self._update_wf(wf, updated_ids)
+            self._refresh_wf_locked([fw_id])
+        except LostWorkflowLockError:
+            raise
         except LockedWorkflowError:
-            self.m_logger.info("fw_id {} locked. Can't refresh!".format(fw_id))
+            self.m_logger.warning("fw_id {} locked. Can't refresh!".format(fw_id))
+            return False
         except Exception:
             # some kind of internal error - an example is that fws serialization changed due to
             # code updates and thus the Firework object can no longer be loaded from db description
@@ -1917,8 +2887,204 @@ class LaunchPad(FWSerializable):
             err_message = "Error refreshing workflow. The full stack trace is: {}".format(
                 traceback.format_exc())
             raise RuntimeError(err_message)
+        return True
+
+    def _refresh_wfs(self, fw_ids):
+        """
+        Refresh the workflows of many fireworks, locking, loading and saving each workflow only
+        once regardless of how many of the given fireworks belong to it.
 
-    def _update_wf(self, wf, updated_ids):
+        Args:
+            fw_ids ([int]): the parent fw_ids - children will be refreshed
+
+        Returns:
+            [int]: the fw_ids whose workflow was locked and could not be refreshed
+        """
+        locked_ids = []
+        for group in self._group_by_wf(fw_ids):
+            if not self._refresh_wf_group(group):
+                locked_ids.extend(group)
+        return locked_ids
+
+    def _group_by_wf(self, fw_ids):
+        """
+        Group fireworks by workflow.
+
+        Args:
+            fw_ids ([int])
+
+        Returns:
+            [[int]]: the fw_ids of each workflow, in the given order
+        """
+        wf_groups = OrderedDict()
+        for wf in self.workflows.find({'nodes': {'$in': list(fw_ids)}}, {'nodes': 1}):
+            nodes = set(wf['nodes'])
+            wf_groups[wf['_id']] = [f for f in fw_ids if f in nodes]
+        return list(wf_groups.values())
+
+    def _refresh_wf_group(self, group):
+        """
+        Refresh a workflow from many of its fireworks, locking, loading and saving it once.
+
+        Args:
+            group ([int]): the parent fw_ids, all of the same workflow - children will be refreshed
+
+        Returns:
+            bool: False if the workflow was locked and could not be refreshed
+        """
+        if len(group) == 1:
+            return self._refresh_wf(group[0])
+        try:
+            self._refresh_wf_locked(group)
+        except LostWorkflowLockError:
+            raise
+        except LockedWorkflowError:
+            self.m_logger.warning("fw_ids {} locked. Can't refresh!".format(group))
+            return False
+        except Exception:
+            # fall back to refreshing one by one, which takes care of marking broken fws
+            self.m_logger.warning("Could not refresh fw_ids {} at once, refreshing them one by "
+                                  "one: {}".format(group, traceback.format_exc()))
+            return all([self._refresh_wf(fw_id) for fw_id in group])
+        return True
+
+    def _refresh_wf_locked(self, fw_ids):
+        """
+        Refresh the workflow of the given fireworks under its WFLock. If the lock is taken over
+        before the changes are written, e.g. because the refresh stalled for longer than the
+        lease, the refresh is redone from scratch.
+
+        Args:
+            fw_ids ([int]): the parent fw_ids, all of the same workflow - children will be
+                refreshed
+
+        Raises:
+            LockedWorkflowError: if the lock could not be acquired
+            LostWorkflowLockError: if the lock was taken over during every attempt
+        """
+        for attempt in range(WF_LOST_LOCK_RETRIES + 1):
+            try:
+                if WF_OPTIMISTIC_REFRESH:
+                    self._refresh_wf_optimistically(fw_ids)
+                else:
+                    with WFLock(self, fw_ids[0]) as lock:
+                        wf = self.get_wf_by_fw_id_lzyfw(fw_ids[0])
+                        self._update_wf(wf, self._refresh_fws(wf, fw_ids), lock)
+                return
+            except LostWorkflowLockError:
+                if attempt == WF_LOST_LOCK_RETRIES:
+                    raise
+                self.m_logger.warning("Lost the lock of fw_ids {}, refreshing again".format(
+                    fw_ids))
+
+    @staticmethod
+    def _refresh_fws(wf, fw_ids):
+        """
+        Refresh a workflow from many of its fireworks.
+
+        The refreshed fireworks were usually changed in the database just before (e.g. paused,
+        completed or rerun), so the states their LazyFireworks were seeded with from the
+        fw_states of the workflow are not trusted and loaded again.
+
+        Args:
+            wf (Workflow)
+            fw_ids ([int]): the parent fw_ids - children will be refreshed
+
+        Returns:
+            set(int): the updated firework ids
+        """
+        for fw_id in fw_ids:
+            fw = wf.id_fw[fw_id]
+            if isinstance(fw, LazyFirework) and fw._fw is None and fw._updated_on is None:
+                fw._state = None
+        updated_ids = set()
+        for fw_id in fw_ids:
+            updated_ids = updated_ids.union(wf.refresh(fw_id, updated_ids))
+        return updated_ids
+
+    def _refresh_wf_optimistically(self, fw_ids):
+        """
+        Refresh the workflow of the given fireworks with optimistic concurrency control: the
+        workflow is loaded and refreshed without its lock, which is only held to commit the
+        changes (see _rebase_wf()). Refreshes of disjoint parts of a workflow, e.g. of many
+        siblings completing at once, thus only serialize on their short commits.
+
+        Args:
+            fw_ids ([int]): the parent fw_ids, all of the same workflow - children will be
+                refreshed
+        """
+        wf = self.get_wf_by_fw_id_lzyfw(fw_ids[0])
+        updated_ids = self._refresh_fws(wf, fw_ids)
+        with WFLock(self, fw_ids[0]) as lock:
+            rebased_ids = self._rebase_wf(wf, fw_ids, updated_ids)
+            if rebased_ids is None:
+                # redo the refresh from scratch while holding the lock
+                wf = self.get_wf_by_fw_id_lzyfw(fw_ids[0])
+                rebased_ids = self._refresh_fws(wf, fw_ids)
+            self._update_wf(wf, rebased_ids, lock)
+
+    def _rebase_wf(self, wf, fw_ids, updated_ids):
+        """
+        Bring a workflow refreshed without its lock up to date with the changes committed since
+        it was loaded. Must be called within an enclosing WFLock.
+
+        The changes are known from the version of the workflow document and the log of the
+        fw_ids changed by each commit. The states of the fireworks changed by others are merged
+        in; if the refresh read any of them, these fireworks and the ones updated by the refresh
+        are reloaded and the refresh is redone.
+
+        Args:
+            wf (Workflow): the refreshed workflow
+            fw_ids ([int]): the fw_ids the refresh started from
+            updated_ids (set(int)): the fw_ids updated by the refresh
+
+        Returns:
+            set(int): the fw_ids to update, None if the workflow must be reloaded completely,
+                e.g. because its links changed
+        """
+        if wf._get_db_changes() is None:
+            return None
+        wf_doc = self.workflows.find_one({'nodes': fw_ids[0]}, {'version': 1, 'changes': 1})
+        version = wf_doc.get('version', 0)
+        if version == wf._db_version:
+            return updated_ids
+        # every increment of the version pushes one entry to the log, see _update_wf() and
+        # _checkout_wf(), so the last entries are the changes since the workflow was loaded
+        n_changes = version - wf._db_version
+        changes = wf_doc.get('changes', [])[-n_changes:]
+        if len(changes) != n_changes or any(c.get('all') for c in changes):
+            return None
+        changed_ids = set(chain.from_iterable(c['fw_ids'] for c in changes))
+
+        # the fireworks the refresh read: the refreshed ones and their parents
+        refreshed_ids = set(fw_ids) | updated_ids
+        for fw_id in list(refreshed_ids):
+            refreshed_ids.update(wf.links.get(fw_id, []))
+        read_ids = set(refreshed_ids)
+        for fw_id in refreshed_ids:
+            read_ids.update(wf.links.parent_links.get(fw_id, []))
+        conflict = bool(changed_ids & read_ids)
+
+        reload_ids = changed_ids | updated_ids if conflict else changed_ids
+        fw_states = self.workflows.find_one(
+            {'nodes': fw_ids[0]},
+            {'fw_states.{}'.format(fw_id): 1 for fw_id in reload_ids}).get('fw_states', {})
+        prefetcher = getattr(wf.id_fw[fw_ids[0]], '_prefetcher', None)
+        for fw_id in reload_ids:
+            state = fw_states.get(str(fw_id))
+            fw = LazyFirework(fw_id, self.fireworks, self.launches, self.gridfs_fallback,
+                              prefetcher=prefetcher)
+            fw._state = state
+            wf.id_fw[fw_id] = fw
+            wf.fw_states[fw_id] = state
+            wf.fw_states.unsaved.discard(fw_id)  # same as in the database
+        if prefetcher:
+            prefetcher.discard(reload_ids)
+        wf._db_version = version
+
+        return self._refresh_fws(wf, fw_ids) if conflict else updated_ids
+
+    def _update_wf(self, wf, updated_ids, lock=None):
         """
         Update the workflow with the update firework ids.
         Note: must be called within an enclosing WFLock
@@ -1926,10 +3092,20 @@ class LaunchPad(FWSerializable):
         Args:
             wf (Workflow)
             updated_ids ([int]): list of firework ids
+            lock (WFLock): the enclosing lock, renewed before and fencing the writes
+
+        Raises:
+            LostWorkflowLockError: if the lock was taken over by someone else
         """
+        if lock:
+            lock.renew()
         updated_fws = [wf.id_fw[fid] for fid in updated_ids]
-        old_new = self._upsert_fws(updated_fws)
+        unsaved_ids = set(wf.fw_states.unsaved)
+        old_new = self._upsert_fws(updated_fws, lock=lock)
         wf._reassign_ids(old_new)
+        # the fireworks whose state changed, plus the updated and the added ones
+        changed_ids = set(old_new.get(fw_id, fw_id) for fw_id in unsaved_ids)
+        changed_ids.update(fw.fw_id for fw in updated_fws)
 
         # find a node for which the id did not change, so we can query on it to get WF
         query_node = None
@@ -1939,12 +3115,279 @@ class LaunchPad(FWSerializable):
                 break
 
         assert query_node is not None
-        if not self.workflows.find_one({'nodes': query_node}):
+        wf_lock = self.workflows.find_one({'nodes': query_node},
+                                          {'locked': 1, 'lock_token': 1, 'version': 1})
+        if not wf_lock:
             raise ValueError("BAD QUERY_NODE! {}".format(query_node))
+        version = wf_lock.get('version', 0) + 1
+        wf_query = {'nodes': query_node}
+        if lock:
+            wf_query['lock_token'] = lock.token
         # redo the links and fw_states
-        wf = wf.to_db_dict()
-        wf['locked'] = True  # preserve the lock!
-        self.workflows.find_one_and_replace({'nodes': query_node}, wf)
+        ready_ids = [fw.fw_id for fw in updated_fws if fw.state == 'READY']
+        # only replace the whole document if the links changed, e.g. for additions and detours
+        wf_changes = None if old_new else wf._get_db_changes()
+        if wf_changes is not None:
+            # log the changed fw_ids for the optimistic refreshes, see _rebase_wf()
+            if len(changed_ids) <= WF_CHANGE_LOG_MAX_IDS:
+                change = {'version': version, 'fw_ids': sorted(changed_ids)}
+            else:
+                change = {'version': version, 'all': True}
+            update = self._get_version_update(change)
+            update['$set'] = wf_changes
+            result = self.workflows.update_one(wf_query, update)
+        else:
+            wf_dict = wf.to_db_dict()
+            # preserve the lock!
+            for k in ('locked', 'lock_token'):
+                if k in wf_lock:
+                    wf_dict[k] = wf_lock[k]
+            wf_dict['version'] = version
+            if WF_OPTIMISTIC_REFRESH:
+                wf_dict['changes'] = [{'version': version, 'all': True}]
+            result = self.workflows.replace_one(wf_query, wf_dict)
+        if not result.matched_count:
+            raise LostWorkflowLockError(
+                "Lost the lock of workflow - LOCKED: {}".format(query_node))
+        wf._set_saved()
+        wf._db_version = version
+        if READY_QUEUE:
+            self._queue_ready_fws([wf.id_fw[fw_id] for fw_id in changed_ids])
+        self._notify_ready(ready_ids)
+
+    @staticmethod
+    def _get_version_update(change):
+        """
+        Get the update that increments the version of a workflow document and logs the change
+        for the optimistic refreshes, see _rebase_wf(). Without WF_OPTIMISTIC_REFRESH, the log is
+        dropped instead of pushed to, which saves rewriting the array on every write; the
+        optimistic refreshes of other LaunchPads then reload the whole workflow.
+
+        Args:
+            change (dict): the entry of the change log
+
+        Returns:
+            dict
+        """
+        if WF_OPTIMISTIC_REFRESH:
+            return {'$inc': {'version': 1},
+                    '$push': {'changes': {'$each': [change], '$slice': -WF_CHANGE_LOG_SIZE}}}
+        return {'$inc': {'version': 1}, '$unset': {'changes': ''}}
+
+    def _notify_ready(self, fw_ids):
+        """
+        Record in the ready events collection that the given fireworks became READY, which wakes
+        up launchers blocked in wait_for_ready().
+
+        Args:
+            fw_ids ([int])
+        """
+        if not fw_ids or not self._has_ready_events():
+            return
+        try:
+            self.ready_events.insert_one({'fw_ids': list(fw_ids),
+                                          'created_on': datetime.datetime.utcnow()})
+        except Exception:
+            # notifications are only an optimization, launchers still poll
+            self.m_logger.debug('Could not write ready event for fw_ids: {}'.format(fw_ids))
+
+    @staticmethod
+    def _get_ready_queue_query(fworker):
+        """
+        Get the query of a FWorker on the ready queue.
+
+        Args:
+            fworker (FWorker)
+
+        Returns:
+            dict: None if the ready queue is disabled or cannot answer the query of the FWorker
+        """
+        if not READY_QUEUE:
+            return None
+        return fworker.ready_queue_query if fworker else {}
+
+    @staticmethod
+    def _get_ready_queue_entry(fw_id, spec, created_on):
+        """
+        Get the ready queue document of a firework, which holds the fields FWorkers select and
+        sort on.
+
+        Args:
+            fw_id (int)
+            spec (dict): the spec of the firework
+            created_on (datetime or str)
+
+        Returns:
+            dict
+        """
+        return {'fw_id': fw_id, 'priority': spec.get('_priority'),
+                'fworker': spec.get('_fworker'), 'category': spec.get('_category'),
+                'created_on': reconstitute_dates(created_on),
+                'partition': fw_id % max(READY_QUEUE_PARTITIONS, 1)}
+
+    def _queue_ready_fws(self, fws):
+        """
+        Add the READY fireworks to the ready queue and remove the others from it.
+
+        Args:
+            fws ([Firework])
+        """
+        requests = []
+        other_ids = []
+        for fw in fws:
+            if fw.state == 'READY':
+                requests.append(ReplaceOne(
+                    {'fw_id': fw.fw_id},
+                    self._get_ready_queue_entry(fw.fw_id, fw.spec, fw.created_on), upsert=True))
+            else:
+                other_ids.append(fw.fw_id)
+        if other_ids:
+            requests.append(DeleteMany({'fw_id': {'$in': other_ids}}))
+        if requests:
+            self.ready_queue.bulk_write(requests, ordered=False)
+
+    def _requeue_fws(self, fw_ids):
+        """
+        Update the ready queue entries of fireworks from the database, e.g. after their spec
+        changed.
+
+        Args:
+            fw_ids ([int])
+
+        Returns:
+            int: the number of READY fireworks
+        """
+        requests = []
+        ready_ids = set()
+        for fw in self.fireworks.find({'fw_id': {'$in': list(fw_ids)}, 'state': 'READY'},
+                                      {'fw_id': 1, 'created_on': 1, 'spec._priority': 1,
+                                       'spec._category': 1, 'spec._fworker': 1}):
+            requests.append(ReplaceOne(
+                {'fw_id': fw['fw_id']},
+                self._get_ready_queue_entry(fw['fw_id'], fw.get('spec', {}), fw['created_on']),
+                upsert=True))
+            ready_ids.add(fw['fw_id'])
+        other_ids = list(set(fw_ids) - ready_ids)
+        if other_ids:
+            requests.append(DeleteMany({'fw_id': {'$in': other_ids}}))
+        if requests:
+            self.ready_queue.bulk_write(requests, ordered=False)
+        return len(ready_ids)
+
+    def _claim_from_ready_queue(self, ready_query):
+        """
+        Take the first matching entry off the ready queue. With READY_QUEUE_PARTITIONS > 1, a
+        random partition is tried first, so that concurrent workers mostly take different
+        entries, and any partition after.
+
+        Args:
+            ready_query (dict): the query of the FWorker on the ready queue
+
+        Returns:
+            int: the fw_id of the entry, None if there is no matching entry
+        """
+        sortby = self._get_checkout_sort('priority')
+        if READY_QUEUE_PARTITIONS > 1:
+            q = dict(ready_query)
+            q['partition'] = random.randrange(READY_QUEUE_PARTITIONS)
+            entry = self.ready_queue.find_one_and_delete(q, {'fw_id': 1}, sort=sortby)
+            if entry:
+                return entry['fw_id']
+        entry = self.ready_queue.find_one_and_delete(ready_query, {'fw_id': 1}, sort=sortby)
+        return entry['fw_id'] if entry else None
+
+    def repair_ready_queue(self):
+        """
+        Add the READY fireworks missing from the ready queue, e.g. those of a worker that died
+        between taking an entry and claiming its firework, and remove the entries of fireworks
+        that are not READY anymore.
+
+        Returns:
+            int: the number of entries added or removed
+        """
+        ready_ids = set(f['fw_id'] for f in self.fireworks.find({'state': 'READY'}, {'fw_id': 1}))
+        queued_ids = set(e['fw_id'] for e in self.ready_queue.find({}, {'fw_id': 1}))
+        missing_ids = ready_ids - queued_ids
+        if missing_ids:
+            self._requeue_fws(missing_ids)
+        stale_ids = queued_ids - ready_ids
+        if stale_ids:
+            self.ready_queue.delete_many({'fw_id': {'$in': list(stale_ids)}})
+        return len(missing_ids) + len(stale_ids)
+
+    def _has_ready_events(self):
+        """
+        Check (once) whether the capped ready events collection was set up, e.g. by tuneup(). We
+        never write to it otherwise, as an implicitly created collection would not be capped.
+
+        Returns:
+            bool
+        """
+        if self._ready_events_capped is None:
+            try:
+                self._ready_events_capped = self.ready_events is not None and \
+                    bool(self.ready_events.options().get('capped'))
+            except Exception:
+                self._ready_events_capped = False
+        return self._ready_events_capped
+
+    def get_ready_marker(self):
+        """
+        Get a marker of the latest ready event, to be passed to wait_for_ready(). Taking the
+        marker *before* checking for READY fireworks ensures that no notification is lost.
+
+        Returns:
+            ObjectId: id of the latest ready event (None if notifications are disabled)
+        """
+        if not self._has_ready_events():
+            return None
+        last = self.ready_events.find_one({}, {'_id': 1}, sort=[('$natural', DESCENDING)])
+        return last['_id'] if last else None
+
+    def wait_for_ready(self, timeout, marker=None):
+        """
+        Block until a firework becomes READY or the timeout is reached. Uses a tailable cursor on
+        the ready events collection, and simply sleeps if that is not available.
+
+        Args:
+            timeout (float): max waiting time in seconds
+            marker (ObjectId): only events after this marker (see get_ready_marker()) count,
+                defaults to the latest event
+
+        Returns:
+            bool: True if woken up by a ready event, False if the timeout was reached
+        """
+        deadline = time.time() + timeout
+        marker = marker or self.get_ready_marker()
+        if marker is not None:
+            try:
+                # ObjectIds are generated client side and aren't ordered across processes, so
+                # walk the events in insertion order instead of querying for _id > marker
+                cursor = self.ready_events.find({}, {'_id': 1},
+                                                cursor_type=CursorType.TAILABLE_AWAIT)
+                cursor.max_await_time_ms(max(1, min(int(timeout * 1000), 1000)))
+                seen_marker = woken = False
+                while cursor.alive and time.time() < deadline:
+                    try:
+                        event = next(cursor)
+                    except StopIteration:
+                        if not seen_marker:
+                            woken = True  # marker was overwritten: lots of events since
+                            break
+                        continue  # no event within max_await_time_ms, cursor is still alive
+                    if seen_marker:
+                        woken = True
+                        break
+                    seen_marker = event['_id'] == marker
+                cursor.close()
+                if woken:
+                    return True
+            except Exception:
+                self.m_logger.debug('Could not wait for ready events, sleeping instead.')
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return False
 
     def _steal_launches(self, thief_fw):
         """
@@ -2001,6 +3444,51 @@ class LaunchPad(FWSerializable):
                                 thief_fw.fw_id, potential_match['fw_id']))
         return stolen
 
+    def _check_fworker_fields(self, force=False):
+        """
+        Add the top-level _fworker and _category fields to the fireworks written by versions of
+        FireWorks that did not store them, as FWorker.query matches on them: without them, a
+        firework pinned to an FWorker or of a category would match any FWorker. The database
+        records in the fw_id_assigner collection that this was done, so that every LaunchPad
+        only checks that once, before its first checkout.
+
+        Args:
+            force (bool): look for such fireworks even if the database records they were updated
+        """
+        if self._fworker_fields_checked and not force:
+            return
+        if force or not self.fw_id_assigner.find_one({'fworker_fields': True}, {'_id': 1}):
+            n_updated = self._update_fworker_fields(
+                {'$or': [{'_fworker': {'$exists': False}}, {'_category': {'$exists': False}}]})
+            if n_updated:
+                self.m_logger.info('Added the _fworker and _category fields to {} FWs'.format(
+                    n_updated))
+            self.fw_id_assigner.update_many({}, {'$set': {'fworker_fields': True}})
+        self._fworker_fields_checked = True
+
+    def _update_fworker_fields(self, query):
+        """
+        Copy spec._fworker and spec._category to the top-level _fworker and _category fields that
+        FWorkers query on (see Firework.to_db_dict()), e.g. after the spec was updated in place
+        or for documents written by older versions of FireWorks.
+
+        Args:
+            query (dict): a Mongo query on the fireworks collection
+
+        Returns:
+            int: the number of updated fireworks
+        """
+        requests = []
+        for fw in self.fireworks.find(query, {'fw_id': 1, '_fworker': 1, '_category': 1,
+                                              'spec._fworker': 1, 'spec._category': 1}):
+            spec = fw.get('spec', {})
+            fields = {k: spec.get(k) for k in ('_fworker', '_category')}
+            if any(k not in fw or fw[k] != v for k, v in fields.items()):
+                requests.append(UpdateOne({'fw_id': fw['fw_id']}, {'$set': fields}))
+        if requests:
+            self.fireworks.bulk_write(requests, ordered=False)
+        return len(requests)
+
     def set_priority(self, fw_id, priority):
         """
         Set priority to the firework with the given id.
@@ -2011,6 +3499,8 @@ class LaunchPad(FWSerializable):
         """
         self.fireworks.find_one_and_update({"fw_id": fw_id}, {
             '$set': {'spec._priority': priority}})
+        if READY_QUEUE:
+            self._requeue_fws([fw_id])
 
     def get_logdir(self):
         """
@@ -2105,7 +3595,8 @@ class LaunchPad(FWSerializable):
                                 offline_data['completed_on'])
                     self.launches.find_one_and_update(
                         {'launch_id': m_launch.launch_id},
-                        {'$set': {'state_history': m_launch.state_history}})
+                        {'$set': {'state_history': m_launch.state_history,
+                                  'state_updated_on': m_launch.state_updated_on}})
 
                     self.offline_runs.update_one({"launch_id": launch_id},
                                                  {"$set": {"completed": True}})
@@ -2356,21 +3847,27 @@ class LazyFirework(object):
     """
 
     # Get these fields from DB when creating new FireWork object
-    db_fields = ('name', 'fw_id', 'spec', 'created_on', 'state')
+    db_fields = ('name', 'fw_id', 'spec', 'created_on', 'updated_on', 'state', '_fworker',
+                 '_category')
     db_launch_fields = ('launches', 'archived_launches')
 
-    def __init__(self, fw_id, fw_coll, launch_coll, fallback_fs):
+    def __init__(self, fw_id, fw_coll, launch_coll, fallback_fs, prefetcher=None):
         """
         Args:
             fw_id (int): firework id
             fw_coll (pymongo.collection): fireworks collection
             launch_coll (pymongo.collection): launches collection
+            fallback_fs (GridFS): the GridFS with the actions exceeding the 16MB limit
+            prefetcher (LazyFireworkPrefetcher): loads the data of this and related
+                LazyFireworks in batches (optional)
         """
         # This is the only attribute known w/o a DB query
         self.fw_id = fw_id
         self._fwc, self._lc, self._ffs = fw_coll, launch_coll, fallback_fs
+        self._prefetcher = prefetcher
         self._launches = {k: False for k in self.db_launch_fields}
         self._fw, self._lids, self._state = None, None, None
+        self._updated_on = None  # set if the state was changed before loading the partial fw
 
     # FireWork methods
 
@@ -2388,8 +3885,13 @@ class LazyFirework(object):
 
     @state.setter
     def state(self, state):
-        self.partial_fw._state = state
-        self.partial_fw.updated_on = datetime.datetime.utcnow()
+        if self._fw is None:
+            # no need to load the Firework just to change its state
+            self._state = state
+            self._updated_on = datetime.datetime.utcnow()
+        else:
+            self._fw._state = state
+            self._fw.updated_on = datetime.datetime.utcnow()
 
     def to_dict(self):
         return self.full_fw.to_dict()
@@ -2400,6 +3902,26 @@ class LazyFirework(object):
     def to_db_dict(self):
         return self.full_fw.to_db_dict()
 
+    def _set_db_dict(self, db_dict):
+        self.partial_fw._set_db_dict(db_dict)
+
+    def _get_db_changes(self):
+        """
+        Compare the loaded parts of the Firework with its document in the database.
+
+        Returns:
+            (dict, [str]): fields to $set and fields to $unset, see Firework._get_db_changes()
+        """
+        if self._fw is None:
+            if self._updated_on is None:
+                return {}, []
+            return {'state': self._state, 'updated_on': self._updated_on.isoformat()}, []
+        m_dict = self._fw.to_db_dict()
+        for launch_field in self.db_launch_fields:
+            if not self._launches[launch_field]:
+                m_dict[launch_field] = self._lids[launch_field]  # not loaded, so unchanged
+        return self._fw._get_db_changes(m_dict)
+
     def __str__(self):
         return 'LazyFireWork object: (id: {})'.format(self.fw_id)
 
@@ -2477,9 +3999,45 @@ class LazyFirework(object):
         self._launches['archived_launches'] = True
         self.partial_fw.archived_launches = value
 
+    def prime(self, fw_dict):
+        """
+        Set the data of the Firework from a document that was loaded in bulk, instead of loading
+        it on first access.
+
+        Args:
+            fw_dict (dict): the document of the Firework, either as stored in the database
+                (at least with the db_fields and the launch ids) or as returned by
+                LaunchPad._get_fw_dicts_by_query() (with launch documents instead of ids)
+        """
+        if self._fw is not None:
+            return
+        data = dict(fw_dict)
+        launch_data = {}  # move some data to separate launch dict
+        launch_dicts = {}
+        for key in self.db_launch_fields:
+            launches = data.pop(key)
+            if launches and isinstance(launches[0], dict):
+                launch_dicts[key] = launches
+                launches = [l['launch_id'] for l in launches]
+            launch_data[key] = launches
+        self._set_partial_data(data, launch_data)
+        for key, launches in launch_dicts.items():
+            setattr(self._fw, key, [Launch.from_dict(l) for l in launches])
+            self._launches[key] = True
+
+    def _set_partial_data(self, data, launch_data):
+        self._lids = launch_data
+        self._fw = Firework.from_dict(data)
+        self._fw._set_db_dict(dict(data, **launch_data))
+        if self._updated_on is not None:
+            self._fw._state = self._state
+            self._fw.updated_on = self._updated_on
+
     # Lazy properties that idempotently instantiate a FireWork object
     @property
     def partial_fw(self):
+        if not self._fw and self._prefetcher is not None:
+            self._prefetcher.load_partial(self.fw_id)
         if not self._fw:
             fields = list(self.db_fields) + list(self.db_launch_fields)
             data = self._fwc.find_one({'fw_id': self.fw_id}, projection=fields)
@@ -2487,8 +4045,7 @@ class LazyFirework(object):
             for key in self.db_launch_fields:
                 launch_data[key] = data[key]
                 del data[key]
-            self._lids = launch_data
-            self._fw = Firework.from_dict(data)
+            self._set_partial_data(data, launch_data)
         return self._fw
 
     @property
@@ -2511,6 +4068,8 @@ class LazyFirework(object):
             Launch obj (also propagated to self._fw)
         """
         fw = self.partial_fw  # assure stage 1
+        if not self._launches[name] and self._prefetcher is not None:
+            self._prefetcher.load_launches(self, name)
         if not self._launches[name]:
             launch_ids = self._lids[name]
             result = []
@@ -2526,6 +4085,104 @@ class LazyFirework(object):
         return getattr(fw, name)
 
 
+class LazyFireworkPrefetcher(object):
+    """
+    Loads the data of the LazyFireworks of one Workflow in batches. Refreshing a Firework touches
+    its parents and children next, so the partial data of all of them is loaded with a single
+    query, and the launches of all Fireworks loaded together are fetched together as well.
+    """
+
+    def __init__(self, fw_coll, launch_coll, fallback_fs):
+        """
+        Args:
+            fw_coll (pymongo.collection): fireworks collection
+            launch_coll (pymongo.collection): launches collection
+            fallback_fs (GridFS): the GridFS with the actions exceeding the 16MB limit
+        """
+        self._fwc, self._lc, self._ffs = fw_coll, launch_coll, fallback_fs
+        self.wf = None  # the Workflow of the LazyFireworks, set once it was created
+        self._batches = {}  # fw_id -> LazyFireworks whose partial data was loaded together
+
+    def _get_lazy_fw(self, fw_id):
+        fw = self.wf.id_fw.get(fw_id)
+        return fw if isinstance(fw, LazyFirework) else None
+
+    def load_partial(self, fw_id):
+        """
+        Load the partial data of a LazyFirework together with that of its parents and children.
+
+        Args:
+            fw_id (int)
+        """
+        if self.wf is None:
+            return
+        links = self.wf.links
+        frontier = [fw_id] + links.get(fw_id, []) + links.parent_links.get(fw_id, [])
+        batch = {}
+        for f_id in frontier:
+            fw = self._get_lazy_fw(f_id)
+            if fw is not None and fw._fw is None:
+                batch[f_id] = fw
+        if not batch:
+            return
+
+        fields = list(LazyFirework.db_fields) + list(LazyFirework.db_launch_fields)
+        for data in self._fwc.find({'fw_id': {'$in': list(batch)}}, projection=fields):
+            fw = batch[data['fw_id']]
+            fw.prime(data)
+            self._batches[fw.fw_id] = list(batch.values())
+
+    def discard(self, fw_ids):
+        """
+        Forget the batches of Fireworks whose LazyFireworks were replaced in the Workflow.
+
+        Args:
+            fw_ids ([int])
+        """
+        for fw_id in fw_ids:
+            self._batches.pop(fw_id, None)
+
+    def load_launches(self, lazy_fw, name):
+        """
+        Load the launches of a LazyFirework together with those of the LazyFireworks whose
+        partial data was loaded in the same batch.
+
+        Args:
+            lazy_fw (LazyFirework)
+            name (str): Name of field, e.g. 'archived_launches'.
+        """
+        batch = [fw for fw in self._batches.get(lazy_fw.fw_id, [lazy_fw])
+                 if fw._fw is not None and not fw._launches[name]]
+        launch_ids = list(chain.from_iterable(fw._lids[name] for fw in batch))
+        launches = {}
+        if launch_ids:
+            launch_dicts = list(self._lc.find({'launch_id': {"$in": launch_ids}}))
+            actions = get_actions_from_gridfs([ld.get("action") for ld in launch_dicts],
+                                              self._ffs)
+            for ld, action in zip(launch_dicts, actions):
+                ld["action"] = action
+                launches[ld['launch_id']] = Launch.from_dict(ld)
+
+        for fw in batch:
+            setattr(fw._fw, name, [launches[l_id] for l_id in fw._lids[name] if l_id in launches])
+            fw._launches[name] = True
+
+
+def _get_stored_fw_dict(fw_dict):
+    """
+    Helper function to get back the stored document of a firework from the dict returned by
+    LaunchPad.get_fw_dict_by_id(), i.e. with launch ids instead of launch documents.
+
+    Args:
+        fw_dict (dict)
+
+    Returns:
+        dict
+    """
+    return dict(fw_dict, **{k: [l['launch_id'] for l in fw_dict[k]]
+                            for k in ('launches', 'archived_launches')})
+
+
 def get_action_from_gridfs(action_dict, fallback_fs):
     """
     Helper function to obtain the correct dictionary of the FWAction associated
@@ -2549,3 +4206,26 @@ def get_action_from_gridfs(action_dict, fallback_fs):
 
     action_data = fallback_fs.get(ObjectId(action_gridfs_id))
     return json.loads(action_data.read())
+
+
+def get_actions_from_gridfs(action_dicts, fallback_fs):
+    """
+    Helper function like get_action_from_gridfs() for many launches, which looks up all actions
+    stored in gridfs with a single query.
+
+    Args:
+        action_dicts ([dict]): the dictionaries contained in the "action" key of the launch
+            documents.
+        fallback_fs (GridFS): the GridFS with the actions exceeding the 16MB limit.
+    Returns:
+        [dict]: the dictionaries of the actions, in the same order.
+    """
+    gridfs_ids = [ObjectId(a["gridfs_id"]) for a in action_dicts if a and "gridfs_id" in a]
+    if not gridfs_ids:
+        return list(action_dicts)
+
+    actions = {}
+    for action_data in fallback_fs.find({'_id': {'$in': gridfs_ids}}):
+        actions[action_data._id] = json.loads(action_data.read())
+    return [actions[ObjectId(a["gridfs_id"])] if a and "gridfs_id" in a else a
+            for a in action_dicts]
@@ -27,9 +27,10 @@ from monty.serialization import loadfn, dumpfn
 from fireworks.core.firework import FWAction, Firework
 from fireworks.fw_config import FWData, PING_TIME_SECS, REMOVE_USELESS_DIRS, \
     PRINT_FW_JSON, \
-    PRINT_FW_YAML, STORE_PACKING_INFO, ROCKET_STREAM_LOGLEVEL
+    PRINT_FW_YAML, STORE_PACKING_INFO, ROCKET_STREAM_LOGLEVEL, ASYNC_COMPLETION
 from fireworks.utilities.dict_mods import apply_mod
 from fireworks.core.launchpad import LockedWorkflowError, LaunchPad
+from fireworks.core.completion_writer import get_completion_writer
 from fireworks.utilities.fw_utilities import get_fw_logger
 
 __author__ = 'Anubhav Jain'
@@ -42,7 +43,12 @@ __date__ = 'Feb 7, 2013'
 
 def do_ping(launchpad, launch_id):
     if launchpad:
-        launchpad.ping_launch(launch_id)
+        checkpoint = None
+        fd = FWData()
+        if fd.MULTIPROCESSING and fd.Checkpoints is not None:
+            # send the checkpoint that the heartbeat service has not flushed yet
+            checkpoint = fd.Checkpoints.pop(launch_id, None)
+        launchpad.ping_launch(launch_id, checkpoint=checkpoint)
     else:
         with open('FW_ping.json', 'w') as f:
             f.write('{"ping_time": "%s"}' % datetime.utcnow().isoformat())
@@ -54,6 +60,14 @@ def ping_launch(launchpad, launch_id, stop_event, master_thread):
         stop_event.wait(PING_TIME_SECS)
 
 
+def complete_launch(launchpad, launch_id, action, state):
+    if ASYNC_COMPLETION and not FWData().MULTIPROCESSING:
+        # written in the background, see CompletionWriter
+        get_completion_writer(launchpad).submit(launch_id, action, state)
+    else:
+        launchpad.complete_launch(launch_id, action, state)
+
+
 def start_ping_launch(launchpad, launch_id):
     fd = FWData()
     if fd.MULTIPROCESSING:
@@ -294,7 +308,7 @@ class Rocket:
 
                     if lp:
                         final_state = 'FIZZLED'
-                        lp.complete_launch(launch_id, m_action, final_state)
+                        complete_launch(lp, launch_id, m_action, final_state)
                     else:
                         fpath = zpath("FW_offline.json")
                         with zopen(fpath) as f_in:
@@ -356,7 +370,7 @@ class Rocket:
 
             if lp:
                 final_state = 'COMPLETED'
-                lp.complete_launch(launch_id, m_action, final_state)
+                complete_launch(lp, launch_id, m_action, final_state)
             else:
 
                 fpath = zpath("FW_offline.json")
@@ -401,7 +415,7 @@ class Rocket:
 
             if lp:
                 try:
-                    lp.complete_launch(launch_id, m_action, 'FIZZLED')
+                    complete_launch(lp, launch_id, m_action, 'FIZZLED')
                 except LockedWorkflowError as e:
                     l_logger.log(logging.DEBUG, traceback.format_exc())
                     l_logger.log(logging.WARNING,
@@ -434,7 +448,12 @@ class Rocket:
             checkpoint (dict): checkpoint data
         """
         if launchpad:
-            launchpad.ping_launch(launch_id, checkpoint=checkpoint)
+            fd = FWData()
+            if fd.MULTIPROCESSING and fd.Checkpoints is not None:
+                # flushed within CHECKPOINT_FLUSH_SECS by the job packing ping service
+                fd.Checkpoints[launch_id] = checkpoint
+            else:
+                launchpad.ping_launch(launch_id, checkpoint=checkpoint)
         else:
             fpath = zpath(os.path.join(launch_dir, "FW_offline.json"))
             with zopen(fpath) as f_in:
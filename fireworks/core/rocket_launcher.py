@@ -8,11 +8,14 @@ This module contains methods for launching Rockets, both singly and in rapid-fir
 
 import os
 import time
+import threading
+from collections import deque
 from datetime import datetime
 
-from fireworks.fw_config import RAPIDFIRE_SLEEP_SECS, FWORKER_LOC
+from fireworks.fw_config import RAPIDFIRE_SLEEP_SECS, FWORKER_LOC, FWData
 from fireworks.core.fworker import FWorker
 from fireworks.core.rocket import Rocket
+from fireworks.core.completion_writer import flush_completions
 from fireworks.utilities.fw_utilities import get_fw_logger, create_datestamp_dir, log_multi, redirect_local
 
 __author__ = 'Anubhav Jain'
@@ -60,8 +63,232 @@ def launch_rocket(launchpad, fworker=None, fw_id=None, strm_lvl='INFO',
     return rocket_ran
 
 
+class _RocketCheckout(object):
+    """
+    The default way rapidfire() fetches Fireworks: each Rocket checks out its own Firework.
+    """
+
+    def __init__(self, launchpad, fworker):
+        """
+        Args:
+            launchpad (LaunchPad)
+            fworker (FWorker)
+        """
+        self.launchpad = launchpad
+        self.fworker = fworker
+
+    def has_next(self, remaining=None):
+        """
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            bool: whether there is a Firework to run
+        """
+        return self.launchpad.run_exists(self.fworker)
+
+    def next(self, remaining=None):
+        """
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            int: the fw_id to pass to the next Rocket, None to let it check out a Firework
+        """
+        return None
+
+    def cancel(self):
+        pass
+
+
+class _ReservationPrefetcher(object):
+    """
+    Keeps up to a given number of reserved Fireworks queued locally. Reservations are made in
+    batches with LaunchPad.reserve_fws(), optionally in a background thread so that they overlap
+    with running the current Rocket. Reservations that are never run (e.g. because the process
+    was killed) expire like any other reservation and are recovered by detect_unreserved().
+
+    Used by rapidfire() in place of _RocketCheckout.
+    """
+
+    def __init__(self, launchpad, fworker, launch_dir, logger, size):
+        """
+        Args:
+            launchpad (LaunchPad)
+            fworker (FWorker)
+            launch_dir (str): launch directory recorded in the reservations
+            logger (logging.Logger)
+            size (int): max number of queued reservations
+        """
+        self.launchpad = launchpad
+        self.fworker = fworker
+        self.launch_dir = launch_dir
+        self.logger = logger
+        self.size = size
+        self.reserved = deque()  # (fw_id, launch_id) tuples in checkout order
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self.reserved)
+
+    def has_next(self, remaining=None):
+        """
+        Reserve new Fireworks if none are queued.
+
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            bool: whether there is a reserved Firework to run
+        """
+        self.wait()
+        if not len(self):
+            self.fill(self._get_size(remaining))
+        return len(self) > 0
+
+    def next(self, remaining=None):
+        """
+        Take the next reserved Firework and reserve the following ones in the background, while
+        it is running.
+
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            int: the fw_id of the next reserved Firework, None if there is none
+        """
+        fw_id = self.pop()
+        self.fill_async(self._get_size(remaining - 1 if remaining is not None else None))
+        return fw_id
+
+    def pop(self):
+        """
+        Returns:
+            int: the fw_id of the next reserved Firework, None if there is none
+        """
+        with self._lock:
+            return self.reserved.popleft()[0] if self.reserved else None
+
+    def _get_size(self, remaining):
+        # don't reserve more Fireworks than we are going to run
+        return self.size if remaining is None else min(self.size, remaining)
+
+    def fill(self, size):
+        """
+        Reserve new Fireworks until size of them are queued.
+
+        Args:
+            size (int): desired number of queued reservations
+        """
+        n = size - len(self)
+        if n <= 0:
+            return
+        try:
+            m_fws = self.launchpad.reserve_fws(self.fworker, n, self.launch_dir)
+        except Exception:
+            self.logger.exception('Could not prefetch Fireworks!')
+            return
+        with self._lock:
+            self.reserved.extend((m_fw.fw_id, launch_id) for m_fw, launch_id in m_fws)
+
+    def fill_async(self, size):
+        """
+        Same as fill(), but run in a background thread. Call wait() before relying on the result.
+
+        Args:
+            size (int): desired number of queued reservations
+        """
+        self.wait()
+        self._thread = threading.Thread(target=self.fill, args=(size,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def cancel(self):
+        """
+        Give back all queued reservations so that other workers can run them.
+        """
+        self.wait()
+        while self.reserved:
+            fw_id, launch_id = self.reserved.popleft()
+            try:
+                self.launchpad.cancel_reservation(launch_id)
+            except Exception:
+                self.logger.exception('Could not cancel reservation of fw_id: {}'.format(fw_id))
+
+
+class _SharedReservations(object):
+    """
+    The way the sub jobs of launch_multiprocess() fetch Fireworks: the first sub job that finds
+    the shared pool empty reserves a batch of Fireworks with a single LaunchPad.reserve_fws(),
+    and every sub job takes its next Firework from the pool. The reservations left when the sub
+    jobs end are given back by launch_multiprocess().
+    """
+
+    def __init__(self, launchpad, fworker, launch_dir, logger, reserved, lock, size):
+        """
+        Args:
+            launchpad (LaunchPad)
+            fworker (FWorker)
+            launch_dir (str): launch directory recorded in the reservations
+            logger (logging.Logger)
+            reserved (list): list of (fw_id, launch_id) tuples shared by the sub jobs
+            lock (Lock): lock shared by the sub jobs, guarding reserved
+            size (int): number of Fireworks to reserve at once
+        """
+        self.launchpad = launchpad
+        self.fworker = fworker
+        self.launch_dir = launch_dir
+        self.logger = logger
+        self.reserved = reserved
+        self.lock = lock
+        self.size = size
+
+    def has_next(self, remaining=None):
+        """
+        Reserve a new batch of Fireworks if the pool is empty.
+
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            bool: whether there is a reserved Firework to run
+        """
+        with self.lock:
+            if not len(self.reserved):
+                try:
+                    m_fws = self.launchpad.reserve_fws(self.fworker, self.size, self.launch_dir)
+                except Exception:
+                    self.logger.exception('Could not reserve Fireworks!')
+                    return False
+                self.reserved.extend([(m_fw.fw_id, launch_id) for m_fw, launch_id in m_fws])
+            return len(self.reserved) > 0
+
+    def next(self, remaining=None):
+        """
+        Args:
+            remaining (int): number of Fireworks still to run, None if unlimited
+
+        Returns:
+            int: the fw_id of the next reserved Firework, None if another sub job took the last
+                one, in which case the Rocket checks out a Firework itself
+        """
+        with self.lock:
+            return self.reserved.pop(0)[0] if len(self.reserved) else None
+
+    def cancel(self):
+        pass
+
+
 def rapidfire(launchpad, fworker=None, m_dir=None, nlaunches=0, max_loops=-1, sleep_time=None,
-              strm_lvl='INFO', timeout=None, local_redirect=False, pdb_on_exception=False):
+              strm_lvl='INFO', timeout=None, local_redirect=False, pdb_on_exception=False,
+              prefetch=0):
     """
     Keeps running Rockets in m_dir until we reach an error. Automatically creates subdirectories
     for each Rocket. Usually stops when we run out of FireWorks from the LaunchPad.
@@ -72,10 +299,14 @@ def rapidfire(launchpad, fworker=None, m_dir=None, nlaunches=0, max_loops=-1, sl
         m_dir (str): the directory in which to loop Rocket running
         nlaunches (int): 0 means 'until completion', -1 or "infinite" means to loop until max_loops
         max_loops (int): maximum number of loops (default -1 is infinite)
-        sleep_time (int): secs to sleep between rapidfire loop iterations
+        sleep_time (int): secs to sleep between rapidfire loop iterations. The sleep ends early
+            when the LaunchPad signals that new Fireworks became READY.
         strm_lvl (str): level at which to output logs to stdout
         timeout (int): of seconds after which to stop the rapidfire process
         local_redirect (bool): redirect standard input and output to local file
+        prefetch (int): if > 0, keep up to this many Fireworks reserved locally and reserve the
+            next ones while the current Rocket is running. In the sub jobs of
+            launch_multiprocess(), the number of Fireworks reserved at once for all sub jobs.
     """
 
     sleep_time = sleep_time if sleep_time else RAPIDFIRE_SLEEP_SECS
@@ -93,41 +324,63 @@ def rapidfire(launchpad, fworker=None, m_dir=None, nlaunches=0, max_loops=-1, sl
         return (timeout is None or
                 (datetime.now() - start_time).total_seconds() < timeout)
 
-    while num_loops != max_loops and time_ok():
-        skip_check = False  # this is used to speed operation
-        while (skip_check or launchpad.run_exists(fworker)) and time_ok():
-            os.chdir(curdir)
-            launcher_dir = create_datestamp_dir(curdir, l_logger, prefix='launcher_')
-            os.chdir(launcher_dir)
-            if local_redirect:
-                with redirect_local():
-                    rocket_ran = launch_rocket(launchpad, fworker, strm_lvl=strm_lvl,
-                                               pdb_on_exception=pdb_on_exception)
-            else:
-                rocket_ran = launch_rocket(launchpad, fworker, strm_lvl=strm_lvl,
-                                           pdb_on_exception=pdb_on_exception)
-
-            if rocket_ran:
-                num_launched += 1
-            elif not os.listdir(launcher_dir):
-                # remove the empty shell of a directory
+    fd = FWData()
+    if prefetch > 0 and fd.MULTIPROCESSING and fd.Reservations is not None:
+        fetcher = _SharedReservations(launchpad, fworker, curdir, l_logger, fd.Reservations,
+                                      fd.Reservations_Lock, prefetch)
+    elif prefetch > 0:
+        fetcher = _ReservationPrefetcher(launchpad, fworker, curdir, l_logger, prefetch)
+    else:
+        fetcher = _RocketCheckout(launchpad, fworker)
+
+    def remaining():
+        return nlaunches - num_launched if nlaunches > 0 else None
+
+    try:
+        while num_loops != max_loops and time_ok():
+            ready_marker = launchpad.get_ready_marker()
+            skip_check = False  # this is used to speed operation
+            while (skip_check or fetcher.has_next(remaining())) and time_ok():
+                fw_id = fetcher.next(remaining())
                 os.chdir(curdir)
-                os.rmdir(launcher_dir)
-            if nlaunches > 0 and num_launched == nlaunches:
-                break
-            if launchpad.run_exists(fworker):
-                skip_check = True  # don't wait, pull the next FW right away
-            else:
-                # add a small amount of buffer breathing time for DB to refresh in case we have a dynamic WF
-                time.sleep(0.15)
-                skip_check = False
-        if nlaunches == 0:
-            if not launchpad.future_run_exists(fworker):
+                launcher_dir = create_datestamp_dir(curdir, l_logger, prefix='launcher_')
+                os.chdir(launcher_dir)
+                if local_redirect:
+                    with redirect_local():
+                        rocket_ran = launch_rocket(launchpad, fworker, fw_id=fw_id,
+                                                   strm_lvl=strm_lvl,
+                                                   pdb_on_exception=pdb_on_exception)
+                else:
+                    rocket_ran = launch_rocket(launchpad, fworker, fw_id=fw_id, strm_lvl=strm_lvl,
+                                               pdb_on_exception=pdb_on_exception)
+
+                if rocket_ran:
+                    num_launched += 1
+                elif not os.listdir(launcher_dir):
+                    # remove the empty shell of a directory
+                    os.chdir(curdir)
+                    os.rmdir(launcher_dir)
+                if nlaunches > 0 and num_launched == nlaunches:
+                    break
+                if fetcher.has_next(remaining()):
+                    skip_check = True  # don't wait, pull the next FW right away
+                else:
+                    # add a small amount of buffer breathing time for DB to refresh in case we have a dynamic WF
+                    time.sleep(0.15)
+                    skip_check = False
+            # the children of the completions not written yet may become READY
+            flush_completions(launchpad)
+            if nlaunches == 0:
+                if not launchpad.future_run_exists(fworker):
+                    break
+            elif num_launched == nlaunches:
                 break
-        elif num_launched == nlaunches:
-            break
-        log_multi(l_logger, 'Sleeping for {} secs'.format(sleep_time))
-        time.sleep(sleep_time)
-        num_loops += 1
-        log_multi(l_logger, 'Checking for FWs to run...')
-    os.chdir(curdir)
+            log_multi(l_logger, 'Sleeping for {} secs'.format(sleep_time))
+            launchpad.wait_for_ready(sleep_time, ready_marker)
+            num_loops += 1
+            log_multi(l_logger, 'Checking for FWs to run...')
+    finally:
+        # give back the Fireworks reserved but not run
+        fetcher.cancel()
+        flush_completions(launchpad)
+        os.chdir(curdir)
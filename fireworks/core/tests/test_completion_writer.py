@@ -0,0 +1,155 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+from fireworks.core.completion_writer import CompletionWriter, replay_completion_journals
+from fireworks.core.firework import FWAction
+from fireworks.fw_config import COMPLETION_JOURNAL_EXPIRATION_SECS
+
+__author__ = 'Anubhav Jain <ajain@lbl.gov>'
+
+
+class CompletionRecorder(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def complete_launches(self, completions):
+        self.batches.append([(c[0], c[1].stored_data if c[1] else None, c[2])
+                             for c in completions])
+        return [c[0] for c in completions]
+
+    def get_logdir(self):
+        return None
+
+
+class CompletionWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.lp = CompletionRecorder()
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    def test_batches(self):
+        writer = CompletionWriter(self.lp, batch_size=2, flush_secs=60,
+                                  journal_dir=self.journal_dir)
+        writer.submit(1, FWAction(stored_data={'a': 1}), 'COMPLETED')
+        writer.submit(2, None, 'FIZZLED')
+        writer.submit(3, FWAction(), 'COMPLETED')
+        self.assertEqual(writer.pending(), 3)
+        with open(writer.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(self.lp.batches, [[(1, {'a': 1}, 'COMPLETED'), (2, None, 'FIZZLED')],
+                                           [(3, {}, 'COMPLETED')]])
+        # the journal is emptied once everything is written
+        self.assertEqual(os.path.getsize(writer.journal_path), 0)
+        self.assertEqual(writer.metrics['batches'], 2)
+
+        writer.close()
+        self.assertFalse(os.path.exists(writer.journal_path))
+        with self.assertRaises(ValueError):
+            writer.submit(4, None, 'COMPLETED')
+
+    def test_write_errors(self):
+        errors = [ConnectionFailure('down'), ValueError('broken')]
+
+        def complete_launches(completions):
+            if errors:
+                raise errors.pop(0)
+            return CompletionRecorder.complete_launches(self.lp, completions)
+
+        self.lp.complete_launches = complete_launches
+        writer = CompletionWriter(self.lp, batch_size=1, flush_secs=60,
+                                  journal_dir=self.journal_dir)
+        writer.submit(1, FWAction(), 'COMPLETED')
+        writer.submit(2, FWAction(), 'COMPLETED')
+        # the database cannot be reached: the batch is kept to be retried
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.pending(), 2)
+        # the batch cannot be written at all: it is dropped and does not hold up the others
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(self.lp.batches, [[(2, {}, 'COMPLETED')]])
+        self.assertEqual(writer.metrics['errors'], 2)
+        self.assertEqual(writer.metrics['dropped'], 1)
+        self.assertEqual(writer.metrics['completions'], 1)
+        self.assertEqual(os.path.getsize(writer.journal_path), 0)
+
+    def test_background_write(self):
+        writer = CompletionWriter(self.lp, batch_size=10, flush_secs=0.01,
+                                  journal_dir=self.journal_dir)
+        writer.start()
+        writer.submit(1, FWAction(), 'COMPLETED')
+        writer.close()
+        self.assertEqual(self.lp.batches, [[(1, {}, 'COMPLETED')]])
+        self.assertEqual(writer.pending(), 0)
+
+    def test_replay(self):
+        dead_pid = 2 ** 22 + 1  # above the default pid_max
+        path = os.path.join(self.journal_dir,
+                            'completions_{}_{}.json'.format(socket.gethostname(), dead_pid))
+        with open(path, 'w') as f:
+            for launch_id in (1, 2, 3):
+                f.write(json.dumps({'launch_id': launch_id, 'state': 'COMPLETED',
+                                    'action': FWAction(stored_data={'i': launch_id}).to_dict(),
+                                    'completed_on': '2026-10-16T10:00:0{}'.format(launch_id)}))
+                f.write('\n')
+            f.write(json.dumps({'done': [2]}) + '\n')
+            f.write('{"launch_id": 4, "sta')  # the process died while writing
+
+        writer = CompletionWriter(self.lp, journal_dir=self.journal_dir)
+        writer.start()
+        writer.close()
+        self.assertEqual(self.lp.batches, [[(1, {'i': 1}, 'COMPLETED'),
+                                            (3, {'i': 3}, 'COMPLETED')]])
+        self.assertEqual(writer.metrics['replayed'], 2)
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+
+    def test_replay_other_host(self):
+        name = 'completions_othernode_123'
+        with open(os.path.join(self.journal_dir, name + '.json'), 'w') as f:
+            f.write(json.dumps({'launch_id': 1, 'state': 'COMPLETED', 'action': None,
+                                'completed_on': '2026-10-16T10:00:00'}) + '\n')
+        lock_path = os.path.join(self.journal_dir, name + '.lock')
+        with open(lock_path, 'w') as f:
+            json.dump({'host': 'othernode', 'pid': 123}, f)
+
+        # the process may still be alive on the other host
+        self.assertEqual(replay_completion_journals(self.lp, self.journal_dir), 0)
+        self.assertEqual(self.lp.batches, [])
+
+        # the lock was not touched for too long, e.g. the job was killed at its walltime
+        expired = time.time() - COMPLETION_JOURNAL_EXPIRATION_SECS - 1
+        os.utime(lock_path, (expired, expired))
+        self.assertEqual(replay_completion_journals(self.lp, self.journal_dir), 1)
+        self.assertEqual(self.lp.batches, [[(1, None, 'COMPLETED')]])
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+    def test_lock(self):
+        writer = CompletionWriter(self.lp, journal_dir=self.journal_dir)
+        writer.submit(1, FWAction(), 'COMPLETED')
+        with open(writer.lock_path) as f:
+            self.assertEqual(json.load(f), {'host': socket.gethostname(), 'pid': os.getpid()})
+        other = CompletionWriter(self.lp, journal_dir=self.journal_dir)
+        self.assertFalse(other._is_abandoned(writer.journal_name))
+        writer.close()
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
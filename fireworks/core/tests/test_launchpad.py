@@ -18,11 +18,20 @@ import datetime
 from multiprocessing import Process
 import filecmp
 
-from pymongo import MongoClient
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from pymongo import MongoClient, monitoring
 from pymongo.errors import OperationFailure
 
-from fireworks import Firework, Workflow, LaunchPad, FWorker
+from fireworks import Firework, Workflow, LaunchPad, FWorker, FWAction
+from fireworks.core.launchpad import LazyFirework, IdAllocator, WFLock, LockedWorkflowError, \
+    LostWorkflowLockError
 from fireworks.core.rocket_launcher import rapidfire, launch_rocket
+from fireworks.core.completion_writer import close_completion_writers
+from fireworks.utilities.filepad import FilePad
 from fireworks.queue.queue_launcher import setup_offline_job
 from fireworks.user_objects.firetasks.script_task import ScriptTask, PyTask
 from fireworks.core.tests.tasks import ExceptionTestTask, ExecutionCounterTask, SlowAdditionTask, WaitWFLockTask
@@ -34,6 +43,24 @@ TESTDB_NAME = 'fireworks_unittest'
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+class CommandCounter(monitoring.CommandListener):
+    """
+    Records the names of the commands sent to MongoDB, i.e. the round-trips.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
 class AuthenticationTest(unittest.TestCase):
     """Tests whether users are authenticating agains the correct mongo dbs.
     """
@@ -115,6 +142,12 @@ class LaunchPadTest(unittest.TestCase):
         new_lp = LaunchPad.from_dict(lp_dict)
         self.assertIsInstance(new_lp, LaunchPad)
 
+    def test_shared_client(self):
+        lp = LaunchPad.from_dict(self.lp.to_dict())
+        self.assertIs(lp.connection, self.lp.connection)
+        fp = FilePad(database=TESTDB_NAME)
+        self.assertIs(fp.connection, self.lp.connection)
+
     def test_reset(self):
         # Store some test fireworks
         # Atempt couple of ways to reset the lp and check
@@ -174,6 +207,311 @@ class LaunchPadTest(unittest.TestCase):
         num_wfs_in_db = len(self.lp.get_wf_ids({"name": "lorem wf"}))
         self.assertEqual(num_wfs_in_db, len(wfs))
 
+    def test_checkout_fws(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        fw_p = Firework(ftask, name='parent', fw_id=-1, spec={'_priority': 2})
+        fw_c = Firework(ftask, name='child', fw_id=-2, parents=[fw_p])
+        fws = [Firework(ftask, name='lorem', fw_id=-3 - i, spec={'_priority': 1})
+               for i in range(4)]
+        self.lp.add_wf(Workflow([fw_p, fw_c] + fws[:2]))
+        self.lp.add_wf(Workflow(fws[2:]))
+
+        # the unlocked workflows get the new states without being refreshed
+        with mock.patch.object(self.lp, '_refresh_wfs') as refresh_wfs:
+            checked_out = self.lp.reserve_fws(self.fworker, 3, MODULE_DIR)
+        refresh_wfs.assert_not_called()
+        self.assertEqual(len(checked_out), 3)
+        self.assertEqual(checked_out[0][0].name, 'parent')
+        launch_ids = [l_id for _, l_id in checked_out]
+        self.assertEqual(len(set(launch_ids)), 3)
+        for fw, launch_id in checked_out:
+            self.assertEqual(self.lp.get_fw_by_id(fw.fw_id).state, 'RESERVED')
+            self.assertEqual(self.lp.get_launch_by_id(launch_id).state, 'RESERVED')
+            wf = self.lp.get_wf_by_fw_id(fw.fw_id)
+            self.assertEqual(wf.fw_states[fw.fw_id], 'RESERVED')
+
+        # the remaining ready fws are handed out, reserved fws are reused when running
+        checked_out = self.lp.checkout_fws(self.fworker, 5, MODULE_DIR, state="RUNNING")
+        self.assertEqual(len(checked_out), 2)
+        for fw, launch_id in checked_out:
+            self.assertNotIn(launch_id, launch_ids)
+            self.assertEqual(self.lp.get_fw_by_id(fw.fw_id).state, 'RUNNING')
+        self.assertEqual(self.lp.checkout_fws(self.fworker, 5, MODULE_DIR), [])
+
+        fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR,
+                                            fw_id=self.lp.get_fw_ids({'name': 'parent'})[0])
+        self.assertIn(launch_id, launch_ids)
+        self.assertEqual(self.lp.fireworks.count({'_checkout_token': {'$exists': True}}), 0)
+
+    def test_checkout_fws_duplicates(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        self.lp.add_wf(Workflow([Firework(ftask, name='unique'), Firework(ftask, name='dupe')]))
+
+        # a duplicate steals the launches of another firework instead of being checked out
+        with mock.patch.object(self.lp, '_check_fw_for_uniqueness',
+                               side_effect=lambda m_fw: m_fw.name != 'dupe'):
+            checked_out = self.lp.checkout_fws(self.fworker, 2, MODULE_DIR)
+        self.assertEqual([fw.name for fw, _ in checked_out], ['unique'])
+        self.assertEqual(self.lp.fireworks.count({'_checkout_token': {'$exists': True}}), 0)
+
+    def test_checkout_round_trips(self):
+        counter = CommandCounter()
+        lp = LaunchPad(name=TESTDB_NAME, strm_lvl='ERROR',
+                       mongoclient_kwargs={'event_listeners': [counter]})
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        fw_p = Firework(ftask, name='parent', fw_id=-1)
+        fw_c = Firework(ftask, name='child', fw_id=-2, parents=[fw_p])
+        lp.add_wf(Workflow([fw_p, fw_c]))
+        lp._check_fworker_fields()  # once per LaunchPad
+
+        counter.commands = []
+        self.assertTrue(lp.run_exists(self.fworker))
+        self.assertEqual(counter.commands, ['find'])
+
+        # allocate the launch id, claim, write the launch and update the workflow
+        counter.commands = []
+        fw, launch_id = lp.checkout_fw(self.fworker, MODULE_DIR)
+        self.assertEqual(counter.commands, ['findAndModify', 'findAndModify', 'update', 'update'])
+        self.assertEqual(fw.name, 'parent')
+        self.assertEqual(self.lp.get_fw_by_id(fw.fw_id).launches[0].launch_id, launch_id)
+        wf = self.lp.workflows.find_one({'nodes': fw.fw_id})
+        self.assertEqual(wf['state'], 'RUNNING')
+        self.assertEqual(wf['fw_states'][str(fw.fw_id)], 'RUNNING')
+
+        # with nothing to claim, the launch id is given back
+        counter.commands = []
+        self.assertEqual(lp.checkout_fw(self.fworker, MODULE_DIR), (None, None))
+        self.assertEqual(counter.commands, ['findAndModify', 'findAndModify'])
+        self.lp.add_wf(Firework(ftask, name='other'))
+        counter.commands = []
+        self.assertEqual(lp.checkout_fw(self.fworker, MODULE_DIR)[1], launch_id + 1)
+        self.assertEqual(len(counter.commands), 3)
+        lp.connection.close()
+
+    def test_ready_queue(self):
+        with mock.patch('fireworks.core.launchpad.READY_QUEUE', True), \
+                mock.patch('fireworks.core.launchpad.READY_QUEUE_PARTITIONS', 2):
+            ftask = ScriptTask.from_str('echo "lorem ipsum"')
+            fw_p = Firework(ftask, name='parent', fw_id=-1, spec={'_category': 'a'})
+            fw_c = Firework(ftask, name='child', fw_id=-2, parents=[fw_p])
+            self.lp.add_wf(Workflow([fw_p, fw_c]))
+            self.lp.add_wf(Firework(ftask, name='other', spec={'_fworker': 'someone'}))
+            p_id, c_id, o_id = [self.lp.get_fw_ids({'name': n})[0]
+                                for n in ('parent', 'child', 'other')]
+
+            entry = self.lp.ready_queue.find_one({'fw_id': p_id})
+            self.assertEqual(entry['category'], 'a')
+            self.assertEqual(entry['partition'], p_id % 2)
+            self.assertTrue(self.lp.run_exists(FWorker(category='a')))
+            self.assertFalse(self.lp.run_exists(FWorker(category='b')))
+            self.lp.set_priority(o_id, 10)
+            self.assertEqual(self.lp.ready_queue.find_one({'fw_id': o_id})['priority'], 10)
+
+            # the other firework is reserved for another fworker
+            fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR)
+            self.assertEqual(fw.fw_id, p_id)
+            self.lp.complete_launch(launch_id, FWAction())
+            self.assertEqual(sorted(e['fw_id'] for e in self.lp.ready_queue.find()),
+                             sorted([c_id, o_id]))
+            self.lp.pause_fw(o_id)
+            self.assertIsNone(self.lp.ready_queue.find_one({'fw_id': o_id}))
+
+            # stale entries are skipped and dropped
+            self.lp.ready_queue.insert_one({'fw_id': p_id, 'priority': 100, 'fworker': None,
+                                            'partition': c_id % 2})
+            fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR)
+            self.assertEqual(fw.fw_id, c_id)
+            self.assertEqual(self.lp.ready_queue.count(), 0)
+            self.assertEqual(self.lp.checkout_fw(self.fworker, MODULE_DIR), (None, None))
+
+            # fireworks missing from the queue are added back
+            self.lp.resume_fw(o_id)
+            self.lp.ready_queue.delete_many({})
+            self.assertEqual(self.lp.repair_ready_queue(), 1)
+            self.assertTrue(self.lp.run_exists(FWorker('someone')))
+
+    def test_ready_queue_replaced_wf(self):
+        with mock.patch('fireworks.core.launchpad.READY_QUEUE', True):
+            ftask = ScriptTask.from_str('echo "lorem ipsum"')
+            fw_a = Firework(ftask, name='a')
+            fw_b = Firework(ftask, name='b')
+            self.lp.add_wf(Workflow([fw_a, fw_b]))
+
+            # an addition replaces the whole workflow document, but only the fireworks that
+            # were added or changed state go through the ready queue
+            with mock.patch.object(self.lp, '_queue_ready_fws',
+                                   wraps=self.lp._queue_ready_fws) as queue_ready_fws:
+                self.lp.append_wf(Workflow([Firework(ftask, name='c')]), [fw_a.fw_id])
+            queued_ids = [fw.fw_id for fw in queue_ready_fws.call_args[0][0]]
+            c_id = self.lp.get_fw_ids({'name': 'c'})[0]
+            self.assertEqual(queued_ids, [c_id])
+            self.assertEqual(sorted(e['fw_id'] for e in self.lp.ready_queue.find()),
+                             sorted([fw_a.fw_id, fw_b.fw_id]))
+
+    def test_checkout_query_uses_index(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        self.lp.bulk_add_wfs([Workflow([Firework(ftask, spec={'_category': c, '_priority': i})])
+                              for i, c in enumerate(['a', 'b'] * 10)])
+        # documents of older versions are completed by the tuneup
+        self.lp.fireworks.update_many({}, {'$unset': {'_fworker': '', '_category': ''}})
+        self.lp.tuneup()
+        self.assertEqual(self.lp.fireworks.count({'_category': 'a', '_fworker': None}), 10)
+
+        for fworker in (self.fworker, FWorker(category='a'), FWorker(category=['a', 'b'])):
+            q = dict(fworker.query)
+            q['state'] = 'READY'
+            explained = self.lp.fireworks.find(q).sort(self.lp._get_checkout_sort()).explain()
+            stages = []
+            plans = [explained['queryPlanner']['winningPlan']]
+            while plans:
+                plan = plans.pop()
+                stages.append(plan['stage'])
+                plans.extend(plan.get('inputStages', []))
+                if 'inputStage' in plan:
+                    plans.append(plan['inputStage'])
+            self.assertIn('IXSCAN', stages)
+            self.assertNotIn('COLLSCAN', stages)
+            self.assertNotIn('SORT', stages)
+
+    def test_fworker_fields_of_older_versions(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        self.lp.add_wf(Firework(ftask, name='pinned', spec={'_fworker': 'someone'}))
+        self.lp.add_wf(Firework(ftask, name='categorized', spec={'_category': 'a'}))
+        # as written by an older version of FireWorks
+        self.lp.fireworks.update_many({}, {'$unset': {'_fworker': '', '_category': ''}})
+        self.lp.fw_id_assigner.update_many({}, {'$unset': {'fworker_fields': ''}})
+
+        # the fields are added before the first checkout
+        lp = LaunchPad(name=TESTDB_NAME, strm_lvl='ERROR')
+        self.assertFalse(lp.run_exists(FWorker('other', category='__none__')))
+        self.assertEqual(self.lp.fireworks.count({'_fworker': {'$exists': False}}), 0)
+        fw, launch_id = lp.checkout_fw(FWorker('other', category='a'), MODULE_DIR)
+        self.assertEqual(fw.name, 'categorized')
+        self.assertIsNone(lp.checkout_fw(FWorker('other'), MODULE_DIR)[0])
+        self.assertEqual(lp.checkout_fw(FWorker('someone'), MODULE_DIR)[0].name, 'pinned')
+
+    def test_wait_for_ready(self):
+        # nothing happens: wait until the timeout
+        self.assertFalse(self.lp.wait_for_ready(0.5))
+
+        # an event written after the marker wakes us up right away
+        marker = self.lp.get_ready_marker()
+        self.lp.add_wf(Firework(ScriptTask.from_str('echo "hello"'), name="hello"))
+        start = time.time()
+        self.assertTrue(self.lp.wait_for_ready(30, marker))
+        self.assertLess(time.time() - start, 10)
+
+        # the event is the latest one, and nothing happened since
+        new_marker = self.lp.get_ready_marker()
+        self.assertNotEqual(new_marker, marker)
+        event = self.lp.ready_events.find_one({'_id': new_marker})
+        self.assertEqual(event['fw_ids'], self.lp.get_fw_ids())
+        self.assertFalse(self.lp.wait_for_ready(0.5, new_marker))
+
+    def test_id_allocator(self):
+        allocator = IdAllocator(self.lp.fw_id_assigner, 'next_launch_id', block_size=10)
+        next_launch_id = self.lp.fw_id_assigner.find_one()['next_launch_id']
+        self.assertEqual(allocator.get(), next_launch_id)
+        self.assertEqual(allocator.get(3), next_launch_id + 1)
+        self.assertEqual(self.lp.fw_id_assigner.find_one()['next_launch_id'],
+                         next_launch_id + 10)
+        # ranges that don't fit into the block skip its rest
+        self.assertEqual(allocator.get(20), next_launch_id + 10)
+        self.assertEqual(allocator.get(), next_launch_id + 30)
+        # only the ids handed out last can be given back
+        allocator.put_back(next_launch_id + 10, 20)
+        allocator.put_back(next_launch_id + 30)
+        self.assertEqual(allocator.get(), next_launch_id + 30)
+        self.assertEqual(self.lp.get_new_launch_id(), next_launch_id + 40)
+
+        self.lp._launch_id_allocator = allocator
+        self.lp.reset(password=None, require_password=False)
+        self.assertEqual(self.lp.get_new_launch_id(), 1)
+        self.assertEqual(self.lp.get_new_launch_id(), 2)
+        self.assertEqual(self.lp.fw_id_assigner.find_one()['next_launch_id'], 11)
+
+    def test_get_wf_by_fw_id(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        fw_p = Firework(ftask, name='parent', fw_id=-1)
+        fw_c = Firework(ftask, name='child', fw_id=-2, parents=[fw_p])
+        self.lp.add_wf(Workflow([fw_p, fw_c]))
+        rapidfire(self.lp, self.fworker, m_dir=MODULE_DIR, nlaunches=1)
+
+        parent_id = self.lp.get_fw_ids({'name': 'parent'})[0]
+        wf = self.lp.get_wf_by_fw_id(parent_id)
+        self.assertEqual([fw.fw_id for fw in wf.fws], self.lp.workflows.find_one()['nodes'])
+        for fw in wf.fws:
+            fw_db = self.lp.get_fw_by_id(fw.fw_id)
+            self.assertEqual(fw.to_db_dict(), fw_db.to_db_dict())
+            self.assertEqual([l.launch_id for l in fw.launches],
+                             [l.launch_id for l in fw_db.launches])
+        self.assertEqual(wf.id_fw[parent_id].state, 'COMPLETED')
+
+        # lazy fireworks can be primed from the same documents
+        fw_dict = self.lp._get_fw_dicts_by_query({'fw_id': parent_id})[0]
+        lazy_fw = LazyFirework(parent_id, None, None, None)
+        lazy_fw.prime(fw_dict)
+        self.assertEqual(lazy_fw.state, 'COMPLETED')
+        self.assertEqual(lazy_fw.launches[0].launch_id, wf.id_fw[parent_id].launches[0].launch_id)
+        self.assertEqual(lazy_fw.to_db_dict(), wf.id_fw[parent_id].to_db_dict())
+
+    def test_get_wf_by_fw_id_lzyfw_prefetch(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        fw_p = Firework(ftask, name='parent', fw_id=-1)
+        fw_cs = [Firework(ftask, name='child', fw_id=-2 - i, parents=[fw_p]) for i in range(3)]
+        fw_gc = Firework(ftask, name='grandchild', fw_id=-5, parents=fw_cs[0])
+        self.lp.add_wf(Workflow([fw_p, fw_gc] + fw_cs))
+        rapidfire(self.lp, self.fworker, m_dir=MODULE_DIR, nlaunches=1)
+
+        parent_id = self.lp.get_fw_ids({'name': 'parent'})[0]
+        wf = self.lp.get_wf_by_fw_id_lzyfw(parent_id)
+        # the states are seeded from the workflow document
+        self.assertTrue(all(fw._fw is None for fw in wf.fws))
+        self.assertEqual(wf.id_fw[parent_id].state, 'COMPLETED')
+        self.assertTrue(all(fw._fw is None for fw in wf.fws))
+
+        # the parent is loaded together with its children, but not the grandchild
+        self.assertEqual(wf.id_fw[parent_id].spec, fw_p.spec)
+        loaded = {fw.name for fw in wf.fws if fw._fw is not None}
+        self.assertEqual(loaded, {'parent', 'child'})
+        self.assertEqual(len(wf.id_fw[parent_id].launches), 1)
+        self.assertTrue(all(fw._launches['launches'] for fw in wf.fws if fw.name == 'child'))
+        self.assertEqual(wf.id_fw[parent_id].to_db_dict(),
+                         self.lp.get_fw_by_id(parent_id).to_db_dict())
+
+    def test_append_many_fws(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        self.lp.add_wf(Firework(ftask, name='parent'))
+        parent_id = self.lp.get_fw_ids()[0]
+        next_fw_id = self.lp.fw_id_assigner.find_one()['next_fw_id']
+
+        new_wf = Workflow([Firework(ftask, name='child', fw_id=-1 - i) for i in range(1000)])
+        self.lp.append_wf(new_wf, [parent_id])
+        child_ids = sorted(self.lp.get_fw_ids({'name': 'child'}))
+        # the ids of all new fireworks are allocated at once, in the order of the old ids
+        self.assertEqual(child_ids, list(range(next_fw_id, next_fw_id + 1000)))
+        self.assertEqual(self.lp.fw_id_assigner.find_one()['next_fw_id'], next_fw_id + 1000)
+        wf = self.lp.get_wf_by_fw_id(parent_id)
+        self.assertEqual(sorted(wf.links[parent_id]), child_ids)
+        self.assertEqual(wf.fw_states[child_ids[0]], 'WAITING')
+
+
+    def test_rapidfire_prefetch(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        parent = Firework(ftask, name='parent')
+        children = [Firework(ftask, name='child', parents=[parent]) for _ in range(4)]
+        self.lp.add_wf(Workflow([parent] + children))
+        self.lp.add_wf(Firework(ftask, name='other'))
+
+        # unused reservations are given back when stopping early
+        rapidfire(self.lp, self.fworker, m_dir=MODULE_DIR, nlaunches=2, prefetch=3)
+        self.assertEqual(len(self.lp.get_fw_ids({'state': 'COMPLETED'})), 2)
+        self.assertFalse(self.lp.get_fw_ids({'state': 'RESERVED'}))
+
+        # the children that become READY are reserved as well
+        rapidfire(self.lp, self.fworker, m_dir=MODULE_DIR, prefetch=3)
+        self.assertEqual(len(self.lp.get_fw_ids({'state': 'COMPLETED'})), 6)
+
 
 class LaunchPadDefuseReigniteRerunArchiveDeleteTest(unittest.TestCase):
 
@@ -425,6 +763,35 @@ class LaunchPadDefuseReigniteRerunArchiveDeleteTest(unittest.TestCase):
         fws_completed = set(self.lp.get_fw_ids({'state':'COMPLETED'}))
         self.assertEqual(fws_completed, self.all_ids)
 
+    def test_rapidfire_async_completion(self):
+        with mock.patch('fireworks.core.rocket.ASYNC_COMPLETION', True), \
+                mock.patch('fireworks.core.completion_writer.COMPLETION_JOURNAL_DIR', MODULE_DIR):
+            try:
+                rapidfire(self.lp, self.fworker, m_dir=MODULE_DIR)
+            finally:
+                close_completion_writers()
+        fws_completed = set(self.lp.get_fw_ids({'state': 'COMPLETED'}))
+        self.assertEqual(fws_completed, self.all_ids)
+        self.assertFalse(glob.glob(os.path.join(MODULE_DIR, 'completions_*')))
+
+    def test_update_wf_delta(self):
+        # state changes only update the changed fields of the stored documents
+        wf_dict = self.lp.workflows.find_one({'nodes': self.zeus_fw_id})
+        zeus_dict = self.lp.fireworks.find_one({'fw_id': self.zeus_fw_id})
+        self.lp.pause_fw(self.zeus_fw_id)
+        new_wf_dict = self.lp.workflows.find_one({'nodes': self.zeus_fw_id})
+        self.assertEqual(new_wf_dict['_id'], wf_dict['_id'])
+        self.assertEqual(new_wf_dict['fw_states'][str(self.zeus_fw_id)], 'PAUSED')
+        self.assertEqual(new_wf_dict['links'], wf_dict['links'])
+        new_zeus_dict = self.lp.fireworks.find_one({'fw_id': self.zeus_fw_id})
+        self.assertEqual(new_zeus_dict['state'], 'PAUSED')
+        self.assertEqual(new_zeus_dict['spec'], zeus_dict['spec'])
+
+        self.lp.resume_fw(self.zeus_fw_id)
+        wf = self.lp.get_wf_by_fw_id(self.zeus_fw_id)
+        self.assertEqual(wf.fw_states[self.zeus_fw_id], 'WAITING')
+        self.assertEqual(wf.id_fw[self.zeus_fw_id].state, 'WAITING')
+
     def test_archive_wf(self):
         # Run a firework before archiving Zeus
         launch_rocket(self.lp, self.fworker)
@@ -635,6 +1002,70 @@ class LaunchPadLostRunsDetectTest(unittest.TestCase):
         self.assertEqual(self.lp.get_fw_by_id(1).state, 'DEFUSED')
 
 
+    def test_detect_unreserved(self):
+        fw, launch_id = self.lp.reserve_fw(self.fworker, MODULE_DIR)
+        self.assertEqual(self.lp.detect_unreserved(3600), [])
+        time.sleep(0.1)
+        self.assertEqual(self.lp.detect_unreserved(0.01), [launch_id])
+
+        # a reservation whose firework moved on is not stale
+        self.lp.fireworks.update_one({'fw_id': fw.fw_id}, {'$set': {'state': 'RUNNING'}})
+        self.assertEqual(self.lp.detect_unreserved(0.01), [])
+        self.lp.fireworks.update_one({'fw_id': fw.fw_id}, {'$set': {'state': 'RESERVED'}})
+
+        self.assertEqual(self.lp.detect_unreserved(0.01, rerun=True), [launch_id])
+        self.assertEqual(self.lp.get_fw_by_id(fw.fw_id).state, 'READY')
+        self.assertEqual(self.lp.detect_unreserved(0.01), [])
+
+    def test_migrate_launches(self):
+        fw, launch_id = self.lp.reserve_fw(self.fworker, MODULE_DIR)
+        ld = self.lp.launches.find_one({'launch_id': launch_id})
+        self.assertIsInstance(ld['state_updated_on'], datetime.datetime)
+
+        # launches stored without the field are still detected, and migrated
+        self.lp.launches.update_one({'launch_id': launch_id},
+                                    {'$unset': {'state_updated_on': ''}})
+        time.sleep(0.1)
+        self.assertEqual(self.lp.detect_unreserved(0.01), [launch_id])
+        self.assertEqual(self.lp.migrate_launches(), 1)
+        ld = self.lp.launches.find_one({'launch_id': launch_id})
+        # MongoDB stores datetimes with millisecond precision
+        self.assertAlmostEqual(ld['state_updated_on'],
+                               self.lp.get_launch_by_id(launch_id).state_updated_on,
+                               delta=datetime.timedelta(milliseconds=1))
+        self.assertEqual(self.lp.detect_unreserved(0.01), [launch_id])
+        self.assertEqual(self.lp.migrate_launches(), 0)
+
+    def test_ping_launch(self):
+        fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR)
+        ptime = datetime.datetime(2030, 1, 1)
+        self.lp.ping_launch(launch_id, ptime=ptime, checkpoint={'step': 1})
+        m_launch = self.lp.get_launch_by_id(launch_id)
+        self.assertEqual(m_launch.state_history[-1]['state'], 'RUNNING')
+        self.assertEqual(m_launch.state_history[-1]['updated_on'], ptime)
+        self.assertEqual(m_launch.state_history[-1]['checkpoint'], {'step': 1})
+        self.assertEqual(self.lp.launches.find_one({'launch_id': launch_id})['state_updated_on'],
+                         ptime)
+
+        # only running launches are pinged
+        self.lp.complete_launch(launch_id, FWAction())
+        self.assertNotIn(launch_id, self.lp._ping_trackers)
+        self.lp.ping_launch(launch_id, ptime=datetime.datetime(2031, 1, 1))
+        self.assertNotIn(launch_id, self.lp._ping_trackers)
+        self.assertEqual(self.lp.get_launch_by_id(launch_id).state, 'COMPLETED')
+        self.assertNotEqual(self.lp.get_launch_by_id(launch_id).state_updated_on,
+                            datetime.datetime(2031, 1, 1))
+
+    def test_ping_launches(self):
+        fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR)
+        ptime = datetime.datetime(2030, 1, 1)
+        self.assertEqual(self.lp.ping_launches([launch_id, 10000], ptime=ptime,
+                                               checkpoints={launch_id: {'step': 2}}), 1)
+        m_launch = self.lp.get_launch_by_id(launch_id)
+        self.assertEqual(m_launch.state_history[-1]['updated_on'], ptime)
+        self.assertEqual(m_launch.state_history[-1]['checkpoint'], {'step': 2})
+        self.assertEqual(self.lp.ping_launches([]), 0)
+
     def test_state_after_run_start(self):
         # Launch the timed firework in a separate process
         class RocketProcess(Process):
@@ -1165,6 +1596,178 @@ class WFLockTest(unittest.TestCase):
 
         self.assertEqual(fast_fw.state, 'FIZZLED')
 
+    def test_lease_lock(self):
+        events = []
+        WFLock.metrics_hook = lambda name, value, fw_id: events.append((name, value, fw_id))
+        try:
+            holder = WFLock(self.lp, 1).__enter__()
+            self.assertEqual(holder.token, 1)
+            holder.renew()
+
+            # the lock is not free, and its lease did not expire
+            with self.assertRaises(LockedWorkflowError):
+                with WFLock(self.lp, 2, expire_secs=0.2):
+                    pass
+
+            # the holder crashed, its lease expired
+            self.lp.workflows.update_one({'nodes': 1}, {'$set': {
+                'locked.expires_on': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+            with WFLock(self.lp, 3, expire_secs=0.2) as new_holder:
+                self.assertEqual(new_holder.token, 2)
+                # fencing: the old holder cannot renew, write or release the lock anymore
+                with self.assertRaises(LockedWorkflowError):
+                    holder.renew()
+                wf = self.lp.get_wf_by_fw_id_lzyfw(1)
+                with self.assertRaises(LockedWorkflowError):
+                    self.lp._update_wf(wf, [], holder)
+                holder.__exit__(None, None, None)
+                self.assertTrue(self.lp.workflows.find_one({'nodes': 1, 'locked.owner':
+                                                            new_holder.owner}))
+                self.lp._update_wf(wf, [], new_holder)
+            self.assertNotIn('locked', self.lp.workflows.find_one({'nodes': 1}))
+
+            with WFLock(self.lp, 1):
+                with WFLock(self.lp, 1, expire_secs=0, kill=True):
+                    pass
+        finally:
+            WFLock.metrics_hook = None
+
+        names = [e[0] for e in events]
+        self.assertEqual(names.count('lease_takeovers'), 1)
+        self.assertEqual(names.count('forced_takeovers'), 1)
+        self.assertEqual(names.count('acquire_secs'), 4)
+        self.assertIn(('waits', 0, 1), events)
+
+    def test_lease_renewal(self):
+        with mock.patch('fireworks.core.launchpad.WFLOCK_LEASE_SECS', 0.3):
+            with WFLock(self.lp, 1) as holder:
+                time.sleep(0.6)
+                # the lease was renewed meanwhile, so the lock cannot be taken over
+                with self.assertRaises(LockedWorkflowError):
+                    with WFLock(self.lp, 1, expire_secs=0.2):
+                        pass
+                wf = self.lp.get_wf_by_fw_id_lzyfw(1)
+                self.lp._update_wf(wf, [1], holder)
+
+            # fencing: a stale holder cannot overwrite the fireworks written by a later one
+            stale = WFLock(self.lp, 1).__enter__()
+            stale_wf = self.lp.get_wf_by_fw_id(1)
+            stale.__exit__(None, None, None)
+            with WFLock(self.lp, 1) as new_holder:
+                wf = self.lp.get_wf_by_fw_id_lzyfw(1)
+                wf.id_fw[3].state = 'READY'
+                self.lp._update_wf(wf, [3], new_holder)
+            stale_wf.id_fw[3].spec['stale'] = True
+            with self.assertRaises(LostWorkflowLockError):
+                self.lp._upsert_fws([stale_wf.id_fw[3]], lock=stale)
+            self.assertNotIn('stale', self.lp.get_fw_by_id(3).spec)
+
+    @mock.patch('fireworks.core.launchpad.WF_OPTIMISTIC_REFRESH', True)
+    def test_optimistic_refresh(self):
+        for fw_id in (1, 2):
+            fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR, fw_id=fw_id)
+            self.lp.launches.update_one({'launch_id': launch_id}, {'$set': {
+                'state': 'COMPLETED', 'action': FWAction().to_db_dict()}})
+        version = self.lp.workflows.find_one({'nodes': 1})['version']
+
+        # both parents of fw 3 complete concurrently, each refresh sees the other still running
+        wf_a = self.lp.get_wf_by_fw_id_lzyfw(1)
+        wf_b = self.lp.get_wf_by_fw_id_lzyfw(2)
+        updated_a = self.lp._refresh_fws(wf_a, [1])
+        updated_b = self.lp._refresh_fws(wf_b, [2])
+        self.assertEqual(wf_a.fw_states[3], 'WAITING')
+        self.assertEqual(wf_b.fw_states[3], 'WAITING')
+
+        with WFLock(self.lp, 2) as lock:
+            self.assertEqual(self.lp._rebase_wf(wf_b, [2], updated_b), updated_b)
+            self.lp._update_wf(wf_b, updated_b, lock)
+        with WFLock(self.lp, 1) as lock:
+            # fw 2 changed since wf_a was loaded: it is merged in and fw 3 refreshed again
+            updated_a = self.lp._rebase_wf(wf_a, [1], updated_a)
+            self.assertIn(3, updated_a)
+            self.lp._update_wf(wf_a, updated_a, lock)
+
+        wf_doc = self.lp.workflows.find_one({'nodes': 1})
+        self.assertEqual(wf_doc['version'], version + 2)
+        self.assertEqual(wf_doc['fw_states'], {'1': 'COMPLETED', '2': 'COMPLETED', '3': 'READY'})
+        self.assertEqual(wf_doc['changes'][-1]['fw_ids'], [1, 3])
+        self.assertEqual(self.lp.get_fw_by_id(3).state, 'READY')
+
+        # the links changed: the refresh must be redone from scratch
+        wf_c = self.lp.get_wf_by_fw_id_lzyfw(1)
+        wf_c.links[3] = []
+        self.assertIsNone(self.lp._rebase_wf(wf_c, [1], set()))
+
+        self.lp._refresh_wf(1)
+        self.assertEqual(self.lp.workflows.find_one({'nodes': 1})['version'], version + 3)
+        self.assertEqual(self.lp.get_fw_by_id(3).state, 'READY')
+
+        # without optimistic refreshes the log is dropped, so that the optimistic refreshes of
+        # other LaunchPads reload the whole workflow
+        wf_d = self.lp.get_wf_by_fw_id_lzyfw(1)
+        with mock.patch('fireworks.core.launchpad.WF_OPTIMISTIC_REFRESH', False):
+            self.lp._refresh_wf(1)
+        wf_doc = self.lp.workflows.find_one({'nodes': 1})
+        self.assertEqual(wf_doc['version'], version + 4)
+        self.assertNotIn('changes', wf_doc)
+        self.assertIsNone(self.lp._rebase_wf(wf_d, [1], set()))
+
+    def test_complete_launches(self):
+        launch_ids = [self.lp.checkout_fw(self.fworker, MODULE_DIR, fw_id=fw_id)[1]
+                      for fw_id in (1, 2)]
+        completed_on = datetime.datetime(2026, 1, 1)
+        with mock.patch.object(self.lp, '_update_wf', wraps=self.lp._update_wf) as update_wf:
+            completed_ids = self.lp.complete_launches([
+                (launch_ids[0], FWAction(stored_data={'x': 1}), 'COMPLETED', completed_on),
+                (launch_ids[1], None, 'FIZZLED', None),
+                (999, None, 'COMPLETED', None)])
+        self.assertEqual(sorted(completed_ids), launch_ids)
+        # both fireworks are refreshed at once
+        self.assertEqual(update_wf.call_count, 1)
+        launch = self.lp.get_launch_by_id(launch_ids[0])
+        self.assertEqual(launch.action.stored_data, {'x': 1})
+        self.assertEqual(launch.time_end, completed_on)
+        fw_states = self.lp.workflows.find_one({'nodes': 1})['fw_states']
+        self.assertEqual(fw_states, {'1': 'COMPLETED', '2': 'FIZZLED', '3': 'WAITING'})
+
+    def test_complete_launches_broken_action(self):
+        fw_a = Firework(ScriptTask.from_str('echo "a"'))
+        fw_b = Firework(ScriptTask.from_str('echo "b"'))
+        self.lp.add_wf(Workflow([fw_a, fw_b], {fw_a: fw_b}))
+        id_a, id_b = fw_a.fw_id, fw_b.fw_id
+        launch_ids = [self.lp.checkout_fw(self.fworker, MODULE_DIR, fw_id=fw_id)[1]
+                      for fw_id in (1, id_a)]
+        completed_ids = self.lp.complete_launches([
+            (launch_ids[0], FWAction(mod_spec=[{'_nonsense_op': {'x': 1}}]), 'COMPLETED', None),
+            (launch_ids[1], FWAction(), 'COMPLETED', None)])
+        self.assertEqual(sorted(completed_ids), launch_ids)
+        # the broken workflow is fizzled, the other one is refreshed anyway
+        self.assertEqual(self.lp.get_fw_by_id(1).state, 'FIZZLED')
+        self.assertEqual(self.lp.get_fw_by_id(id_a).state, 'COMPLETED')
+        self.assertEqual(self.lp.get_fw_by_id(id_b).state, 'READY')
+
+    def test_completion_queue(self):
+        with mock.patch('fireworks.core.launchpad.COMPLETION_QUEUE', True):
+            for fw_id in (1, 2):
+                fw, launch_id = self.lp.checkout_fw(self.fworker, MODULE_DIR, fw_id=fw_id)
+                self.lp.complete_launch(launch_id, FWAction())
+        # only the launches were completed, the workflow is refreshed by the reducer
+        self.assertEqual(self.lp.get_fw_by_id(1).state, 'RUNNING')
+        self.assertEqual(self.lp.completion_events.count(), 2)
+
+        # the events of locked workflows are left for later
+        with WFLock(self.lp, 1):
+            self.assertEqual(self.lp.reduce_completions(), 0)
+        self.assertEqual(self.lp.completion_events.find({'claimed_until': None}).count(), 2)
+
+        with mock.patch.object(self.lp, '_update_wf', wraps=self.lp._update_wf) as update_wf:
+            self.assertEqual(self.lp.run_reducer(infinite=False), 2)
+        self.assertEqual(update_wf.call_count, 1)
+        self.assertEqual(self.lp.completion_events.count(), 0)
+        fw_states = self.lp.workflows.find_one({'nodes': 1})['fw_states']
+        self.assertEqual(fw_states, {'1': 'COMPLETED', '2': 'COMPLETED', '3': 'READY'})
+        self.assertEqual(self.lp.get_fw_by_id(3).state, 'READY')
+
 
 class LaunchPadOfflineTest(unittest.TestCase):
 
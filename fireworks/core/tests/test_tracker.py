@@ -92,6 +92,32 @@ class TrackerTest(unittest.TestCase):
         finally:
             self._teardown([self.dest1])
 
+    def test_tracker_appended(self):
+        """
+        Track a file that grows between calls
+        """
+        self._teardown([self.dest1])
+        try:
+            with open(self.dest1, 'w') as f:
+                f.write(''.join('{}\n'.format(i) for i in range(5000)))
+            self.assertEqual('4998\n4999', self.tracker1.track_file())
+            # only the tail of the file was read
+            self.assertGreater(self.tracker1._offset, 0)
+
+            with open(self.dest1, 'a') as f:
+                f.write('5000\n50')
+            self.assertEqual('5000\n50', self.tracker1.track_file())
+            with open(self.dest1, 'a') as f:
+                f.write('01\n')
+            self.assertEqual('5000\n5001', self.tracker1.track_file())
+
+            # truncated file
+            with open(self.dest1, 'w') as f:
+                f.write('1\n2\n3\n')
+            self.assertEqual('2\n3', self.tracker1.track_file())
+        finally:
+            self._teardown([self.dest1])
+
     def test_tracker_failed_fw(self):
         """
         Add a bad firetask to workflow and test the tracking
@@ -11,7 +11,8 @@ import os
 import threading
 import time
 
-from fireworks.fw_config import FWData, PING_TIME_SECS, DS_PASSWORD, RAPIDFIRE_SLEEP_SECS
+from fireworks.fw_config import FWData, PING_TIME_SECS, DS_PASSWORD, RAPIDFIRE_SLEEP_SECS, \
+    CHECKPOINT_FLUSH_SECS
 from fireworks.core.rocket_launcher import rapidfire
 from fireworks.utilities.fw_utilities import DataServer, get_fw_logger, log_multi, get_my_host
 
@@ -23,33 +24,140 @@ __email__ = 'xqu@lbl.gov'
 __date__ = 'Aug 19, 2013'
 
 
-def ping_multilaunch(port, stop_event):
+class HeartbeatAggregator(object):
     """
-    A single manager to ping all launches during multiprocess launches
+    Collects the liveness and the checkpoints of all the sub jobs of a multiprocess launch and
+    sends them to the LaunchPad with a single bulk write per interval, instead of one ping per
+    running Launch. Checkpoints are sent on their own, shorter interval, so that they don't wait
+    for the next heartbeat.
+
+    The size and latency of the flushes are recorded in metrics.
+    """
+
+    def __init__(self, launchpad, running_ids, checkpoints):
+        """
+        Args:
+            launchpad (LaunchPad): LaunchPad (or its DataServer proxy) to send the pings to
+            running_ids (dict): shared dict of the Launch run by each sub job, by pid
+            checkpoints (dict): shared dict of the checkpoints not sent yet, by launch_id
+        """
+        self.launchpad = launchpad
+        self.running_ids = running_ids
+        self.checkpoints = checkpoints
+        self.metrics = {'flushes': 0, 'pings': 0, 'checkpoints': 0, 'last_batch_size': 0,
+                        'max_batch_size': 0, 'last_latency_secs': 0.0,
+                        'max_latency_secs': 0.0, 'total_latency_secs': 0.0}
+
+    def collect(self, checkpoints_only=False):
+        """
+        Args:
+            checkpoints_only (bool): only collect the Launches with a pending checkpoint
+
+        Returns:
+            ([int], dict): ids of the Launches to ping, and the pending checkpoints by launch_id
+        """
+        launch_ids = []
+        for pid, lid in self.running_ids.items():
+            if lid and not checkpoints_only:
+                try:
+                    os.kill(pid, 0)  # throws OSError if the process is dead
+                    launch_ids.append(lid)
+                except OSError:  # means this process is dead!
+                    self.running_ids[pid] = None
+        checkpoints = {}
+        if self.checkpoints is not None:
+            for lid in list(self.checkpoints.keys()):
+                checkpoint = self.checkpoints.pop(lid, None)
+                if checkpoint is not None:
+                    checkpoints[lid] = checkpoint
+        launch_ids.extend(lid for lid in checkpoints if lid not in launch_ids)
+        return launch_ids, checkpoints
+
+    def flush(self, checkpoints_only=False):
+        """
+        Ping all the running Launches, with their pending checkpoints, in one bulk write.
+
+        Args:
+            checkpoints_only (bool): only ping the Launches with a pending checkpoint
+
+        Returns:
+            int: number of Launches pinged
+        """
+        launch_ids, checkpoints = self.collect(checkpoints_only)
+        if not launch_ids:
+            return 0
+        start = time.time()
+        self.launchpad.ping_launches(launch_ids, checkpoints=checkpoints)
+        latency = time.time() - start
+
+        m = self.metrics
+        m['flushes'] += 1
+        m['pings'] += len(launch_ids)
+        m['checkpoints'] += len(checkpoints)
+        m['last_batch_size'] = len(launch_ids)
+        m['max_batch_size'] = max(m['max_batch_size'], len(launch_ids))
+        m['last_latency_secs'] = latency
+        m['max_latency_secs'] = max(m['max_latency_secs'], latency)
+        m['total_latency_secs'] += latency
+        return len(launch_ids)
+
+    def run(self, stop_event, interval=PING_TIME_SECS, checkpoint_interval=CHECKPOINT_FLUSH_SECS):
+        """
+        Flush the heartbeats every interval, and the pending checkpoints every
+        checkpoint_interval, until the stop event is set.
+
+        Args:
+            stop_event (Thread.Event): stop event
+            interval (int): seconds between two flushes of all the heartbeats
+            checkpoint_interval (int): seconds between two flushes of the pending checkpoints
+        """
+        next_flush = time.time()
+        while not stop_event.is_set():
+            if time.time() >= next_flush:
+                self.flush()
+                next_flush = time.time() + interval
+            else:
+                self.flush(checkpoints_only=True)
+            stop_event.wait(max(min(checkpoint_interval, next_flush - time.time()), 0))
+
+    def get_summary(self):
+        """
+        Returns:
+            str: a one-line summary of the metrics
+        """
+        m = self.metrics
+        mean_batch = m['pings'] / float(m['flushes']) if m['flushes'] else 0
+        mean_latency = m['total_latency_secs'] / m['flushes'] if m['flushes'] else 0
+        return ('Heartbeats: {} flushes, {} pings, {} checkpoints, batch size mean {:.1f} / '
+                'max {}, latency mean {:.3f}s / max {:.3f}s'.format(
+                    m['flushes'], m['pings'], m['checkpoints'], mean_batch,
+                    m['max_batch_size'], mean_latency, m['max_latency_secs']))
+
+
+def ping_multilaunch(port, stop_event, loglvl='INFO'):
+    """
+    A single manager to ping all launches during multiprocess launches, see
+    HeartbeatAggregator. Logs a summary of the heartbeats when stopped.
 
     Args:
         port (int): Listening port number of the DataServer
         stop_event (Thread.Event): stop event
+        loglvl (str): level at which to output logs
     """
     ds = DataServer(address=('127.0.0.1', port), authkey=DS_PASSWORD)
     ds.connect()
     fd = FWData()
-
-    lp = ds.LaunchPad()
-    while not stop_event.is_set():
-        for pid, lid in fd.Running_IDs.items():
-            if lid:
-                try:
-                    os.kill(pid, 0)  # throws OSError if the process is dead
-                    lp.ping_launch(lid)
-                except OSError:  # means this process is dead!
-                    fd.Running_IDs[pid] = None
-
-        stop_event.wait(PING_TIME_SECS)
+    launchpad = ds.LaunchPad()
+    heartbeat = HeartbeatAggregator(launchpad, fd.Running_IDs, fd.Checkpoints)
+    heartbeat.run(stop_event)
+    l_dir = launchpad.get_logdir() if launchpad else None
+    l_logger = get_fw_logger('rocket.launcher', l_dir=l_dir, stream_level=loglvl)
+    log_multi(l_logger, heartbeat.get_summary())
 
 
 def rapidfire_process(fworker, nlaunches, sleep, loglvl, port, node_list, sub_nproc, timeout,
-                      running_ids_dict, local_redirect):
+                      running_ids_dict, local_redirect, checkpoints_dict=None, reservations=None,
+                      reservations_lock=None, batch_size=0):
     """
     Initializes shared data with multiprocessing parameters and starts a rapidfire.
 
@@ -64,6 +172,11 @@ def rapidfire_process(fworker, nlaunches, sleep, loglvl, port, node_list, sub_np
         sub_nproc (int): number of processors of the sub job
         timeout (int): # of seconds after which to stop the rapidfire process
         local_redirect (bool): redirect standard input and output to local file
+        checkpoints_dict (dict): Shared dict between process to collect checkpoints
+        reservations (list): Shared list of the Fireworks reserved for the sub jobs
+        reservations_lock (Lock): Shared lock guarding reservations
+        batch_size (int): number of Fireworks to reserve at once for all sub jobs, 0 to let each
+            Rocket check out its own Firework
     """
     ds = DataServer(address=('127.0.0.1', port), authkey=DS_PASSWORD)
     ds.connect()
@@ -73,12 +186,15 @@ def rapidfire_process(fworker, nlaunches, sleep, loglvl, port, node_list, sub_np
     FWData().NODE_LIST = node_list
     FWData().SUB_NPROCS = sub_nproc
     FWData().Running_IDs = running_ids_dict
+    FWData().Checkpoints = checkpoints_dict
+    FWData().Reservations = reservations
+    FWData().Reservations_Lock = reservations_lock
     sleep_time = sleep if sleep else RAPIDFIRE_SLEEP_SECS
     l_dir = launchpad.get_logdir() if launchpad else None
     l_logger = get_fw_logger('rocket.launcher', l_dir=l_dir, stream_level=loglvl)
     rapidfire(launchpad, fworker=fworker, m_dir=None, nlaunches=nlaunches,
               max_loops=-1, sleep_time=sleep, strm_lvl=loglvl, timeout=timeout,
-              local_redirect=local_redirect)
+              local_redirect=local_redirect, prefetch=batch_size)
     while nlaunches == 0:
         time.sleep(1.5)  # wait for LaunchPad to be initialized
         launch_ids = FWData().Running_IDs.values()
@@ -90,14 +206,15 @@ def rapidfire_process(fworker, nlaunches, sleep, loglvl, port, node_list, sub_np
             log_multi(l_logger, 'Resubmit sub job')
             rapidfire(launchpad, fworker=fworker, m_dir=None, nlaunches=nlaunches,
                       max_loops=-1, sleep_time=sleep, strm_lvl=loglvl, timeout=timeout,
-                      local_redirect=local_redirect)
+                      local_redirect=local_redirect, prefetch=batch_size)
         else:
             break
     log_multi(l_logger, 'Sub job finished')
 
 
 def start_rockets(fworker, nlaunches, sleep, loglvl, port, node_lists, sub_nproc_list, timeout=None,
-                  running_ids_dict=None, local_redirect=False):
+                  running_ids_dict=None, local_redirect=False, checkpoints_dict=None,
+                  reservations=None, reservations_lock=None, batch_size=0):
     """
     Create each sub job and start a rocket launch in each one
 
@@ -112,12 +229,18 @@ def start_rockets(fworker, nlaunches, sleep, loglvl, port, node_lists, sub_nproc
         timeout (int): # of seconds after which to stop the rapidfire process
         running_ids_dict (dict): Shared dict between process to record IDs
         local_redirect (bool): redirect standard input and output to local file
+        checkpoints_dict (dict): Shared dict between process to collect checkpoints
+        reservations (list): Shared list of the Fireworks reserved for the sub jobs
+        reservations_lock (Lock): Shared lock guarding reservations
+        batch_size (int): number of Fireworks to reserve at once for all sub jobs, 0 to let each
+            Rocket check out its own Firework
     Returns:
         ([multiprocessing.Process]) all the created processes
     """
     processes = [Process(target=rapidfire_process,
                          args=(fworker, nlaunches, sleep, loglvl, port, nl, sub_nproc, timeout,
-                               running_ids_dict, local_redirect))
+                               running_ids_dict, local_redirect, checkpoints_dict, reservations,
+                               reservations_lock, batch_size))
                  for nl, sub_nproc in zip(node_lists, sub_nproc_list)]
     for p in processes:
         p.start()
@@ -155,7 +278,7 @@ def split_node_lists(num_jobs, total_node_list=None, ppn=24):
 # TODO: why is loglvl a required parameter??? Also nlaunches and sleep_time could have a sensible default??
 def launch_multiprocess(launchpad, fworker, loglvl, nlaunches, num_jobs, sleep_time,
                         total_node_list=None, ppn=1, timeout=None, exclude_current_node=False,
-                        local_redirect=False):
+                        local_redirect=False, batch_size=0):
     """
     Launch the jobs in the job packing mode.
 
@@ -171,6 +294,9 @@ def launch_multiprocess(launchpad, fworker, loglvl, nlaunches, num_jobs, sleep_t
         timeout (int): # of seconds after which to stop the rapidfire process
         exclude_current_node: Don't use the script launching node as a compute node
         local_redirect (bool): redirect standard input and output to local file
+        batch_size (int): number of Fireworks the sub jobs reserve at once with
+            LaunchPad.reserve_fws() and share, 0 (default) to let each sub job check out its own
+            Firework. Fireworks reserved but not run are given back at the end.
     """
     # parse node file contents
     if exclude_current_node:
@@ -190,15 +316,22 @@ def launch_multiprocess(launchpad, fworker, loglvl, nlaunches, num_jobs, sleep_t
 
     manager = Manager()
     running_ids_dict = manager.dict()
+    checkpoints_dict = manager.dict()
+    # the sub jobs may check out their Fireworks in batches, see LaunchPad.checkout_fws()
+    reservations = manager.list() if batch_size > 0 else None
+    reservations_lock = manager.Lock() if batch_size > 0 else None
     # launch rapidfire processes
     processes = start_rockets(fworker, nlaunches, sleep_time, loglvl, port, node_lists,
                               sub_nproc_list, timeout=timeout, running_ids_dict=running_ids_dict,
-                              local_redirect=local_redirect)
+                              local_redirect=local_redirect, checkpoints_dict=checkpoints_dict,
+                              reservations=reservations, reservations_lock=reservations_lock,
+                              batch_size=batch_size)
     FWData().Running_IDs = running_ids_dict
+    FWData().Checkpoints = checkpoints_dict
 
     # start pinging service
     ping_stop = threading.Event()
-    ping_thread = threading.Thread(target=ping_multilaunch, args=(port, ping_stop))
+    ping_thread = threading.Thread(target=ping_multilaunch, args=(port, ping_stop, loglvl))
     ping_thread.start()
 
     # wait for completion
@@ -206,4 +339,7 @@ def launch_multiprocess(launchpad, fworker, loglvl, nlaunches, num_jobs, sleep_t
         p.join()
     ping_stop.set()
     ping_thread.join()
+    # give back the Fireworks reserved but not run
+    for _, launch_id in list(reservations or []):
+        launchpad.cancel_reservation(launch_id)
     ds.shutdown()
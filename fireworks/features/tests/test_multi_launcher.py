@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from fireworks.core.rocket_launcher import _SharedReservations
+from fireworks.features.multi_launcher import HeartbeatAggregator, ping_multilaunch, \
+    start_rockets
+
+__author__ = 'Anubhav Jain <ajain@lbl.gov>'
+
+
+class PingRecorder(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def ping_launches(self, launch_ids, ptime=None, checkpoints=None):
+        self.calls.append((sorted(launch_ids), checkpoints))
+        return len(launch_ids)
+
+
+class HeartbeatAggregatorTest(unittest.TestCase):
+
+    def test_flush(self):
+        lp = PingRecorder()
+        dead_pid = 2 ** 22 + 1  # above the default pid_max
+        running_ids = {os.getpid(): 1, dead_pid: 2, os.getppid(): None}
+        checkpoints = {1: {'_task_n': 3}, 5: {'_task_n': 1}}
+        heartbeat = HeartbeatAggregator(lp, running_ids, checkpoints)
+
+        self.assertEqual(heartbeat.flush(), 2)
+        self.assertEqual(lp.calls, [([1, 5], {1: {'_task_n': 3}, 5: {'_task_n': 1}})])
+        self.assertEqual(running_ids[dead_pid], None)
+        self.assertEqual(checkpoints, {})
+
+        self.assertEqual(heartbeat.flush(), 1)
+        self.assertEqual(lp.calls[-1], ([1], {}))
+
+        running_ids[os.getpid()] = None
+        self.assertEqual(heartbeat.flush(), 0)
+        self.assertEqual(len(lp.calls), 2)
+
+        self.assertEqual(heartbeat.metrics['flushes'], 2)
+        self.assertEqual(heartbeat.metrics['pings'], 3)
+        self.assertEqual(heartbeat.metrics['checkpoints'], 2)
+        self.assertEqual(heartbeat.metrics['max_batch_size'], 2)
+        self.assertEqual(heartbeat.metrics['last_batch_size'], 1)
+        self.assertIn('2 flushes', heartbeat.get_summary())
+
+    def test_flush_checkpoints(self):
+        lp = PingRecorder()
+        running_ids = {os.getpid(): 1}
+        checkpoints = {}
+        heartbeat = HeartbeatAggregator(lp, running_ids, checkpoints)
+        self.assertEqual(heartbeat.flush(checkpoints_only=True), 0)
+
+        checkpoints[1] = {'_task_n': 2}
+        self.assertEqual(heartbeat.flush(checkpoints_only=True), 1)
+        self.assertEqual(lp.calls, [([1], {1: {'_task_n': 2}})])
+
+    def test_run(self):
+        lp = PingRecorder()
+        checkpoints = {}
+        heartbeat = HeartbeatAggregator(lp, {os.getpid(): 1}, checkpoints)
+        stop = threading.Event()
+        thread = threading.Thread(target=heartbeat.run, args=(stop, 3600, 0.05))
+        thread.start()
+        def wait_for_calls(n_calls):
+            for _ in range(100):
+                if len(lp.calls) >= n_calls:
+                    break
+                time.sleep(0.05)
+
+        try:
+            wait_for_calls(1)
+            # the checkpoint does not wait for the next heartbeat
+            checkpoints[1] = {'_task_n': 2}
+            wait_for_calls(2)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(lp.calls[0], ([1], {}))
+        self.assertEqual(lp.calls[1], ([1], {1: {'_task_n': 2}}))
+
+    @mock.patch('fireworks.features.multi_launcher.log_multi')
+    @mock.patch('fireworks.features.multi_launcher.FWData')
+    @mock.patch('fireworks.features.multi_launcher.DataServer')
+    def test_ping_multilaunch(self, data_server, fw_data, log_multi):
+        lp = PingRecorder()
+        lp.get_logdir = lambda: None
+        data_server.return_value.LaunchPad.return_value = lp
+        fw_data.return_value.Running_IDs = {os.getpid(): 1}
+        fw_data.return_value.Checkpoints = {}
+        stop = threading.Event()
+        stop.set()
+        ping_multilaunch(0, stop)
+        self.assertEqual(lp.calls, [])
+        self.assertTrue(log_multi.call_args[0][1].startswith('Heartbeats: 0 flushes'))
+
+
+
+class ReservationRecorder(object):
+
+    def __init__(self, fw_ids):
+        self.fw_ids = list(fw_ids)
+        self.calls = []
+
+    def reserve_fws(self, fworker, n, launch_dir):
+        self.calls.append(n)
+        reserved, self.fw_ids = self.fw_ids[:n], self.fw_ids[n:]
+        return [(mock.Mock(fw_id=fw_id), fw_id * 10) for fw_id in reserved]
+
+
+class SharedReservationsTest(unittest.TestCase):
+
+    def test_batches(self):
+        lp = ReservationRecorder(range(1, 6))
+        reserved = []
+        jobs = [_SharedReservations(lp, None, '.', logging.getLogger(), reserved,
+                                    threading.Lock(), 2) for _ in range(2)]
+
+        # one batch is reserved for both sub jobs
+        self.assertTrue(jobs[0].has_next())
+        self.assertTrue(jobs[1].has_next())
+        self.assertEqual((jobs[0].next(), jobs[1].next()), (1, 2))
+        self.assertEqual(lp.calls, [2])
+
+        self.assertTrue(jobs[1].has_next())
+        self.assertEqual(jobs[1].next(), 3)
+        self.assertEqual(reserved, [(4, 40)])
+        self.assertEqual(jobs[0].next(), 4)
+        self.assertIsNone(jobs[1].next())
+
+        self.assertTrue(jobs[0].has_next())
+        self.assertEqual(jobs[0].next(), 5)
+        self.assertFalse(jobs[1].has_next())
+        self.assertEqual(lp.calls, [2, 2, 2, 2])
+
+    @mock.patch('fireworks.features.multi_launcher.time.sleep')
+    @mock.patch('fireworks.features.multi_launcher.Process')
+    def test_opt_in(self, process, sleep):
+        # by default every sub job checks out its own Fireworks
+        start_rockets(None, 0, None, 'INFO', 0, [None, None], [1, 1])
+        self.assertEqual([c[1]['args'][-3:] for c in process.call_args_list],
+                         [(None, None, 0)] * 2)
+
+        process.reset_mock()
+        reserved, lock = [], threading.Lock()
+        start_rockets(None, 0, None, 'INFO', 0, [None, None], [1, 1], reservations=reserved,
+                      reservations_lock=lock, batch_size=4)
+        self.assertEqual([c[1]['args'][-3:] for c in process.call_args_list],
+                         [(reserved, lock, 4)] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -46,6 +46,7 @@ PRINT_FW_YAML = False
 
 PING_TIME_SECS = 3600  # while Running a job, how often to ping back the server that we're still alive
 RUN_EXPIRATION_SECS = PING_TIME_SECS * 4  # mark job as FIZZLED if not pinged in this time
+CHECKPOINT_FLUSH_SECS = 10  # how often the multiprocess ping service sends pending checkpoints
 
 MAINTAIN_INTERVAL = 120  # seconds between maintenance intervals when running infinite maintenance
 
@@ -54,6 +55,7 @@ RESERVATION_EXPIRATION_SECS = 60 * 60 * 24 * 14  # a job can stay in a queue thi
 
 WFLOCK_EXPIRATION_SECS = 60 * 5  # wait this long for a WFLock before expiring
 WFLOCK_EXPIRATION_KILL = False  # kill WFLock on expiration (or give a warning)
+WFLOCK_LEASE_SECS = 60 * 2  # a WFLock whose holder did not renew it for this long can be taken over
 
 RAPIDFIRE_SLEEP_SECS = 60  # seconds to sleep between rapidfire loops
 
@@ -99,10 +101,66 @@ WEBSERVER_PERFWARNINGS = False  # enable performance-related warnings
 # documentation http://api.mongodb.org/python/current/api/pymongo/mongo_client.html
 MONGO_SOCKET_TIMEOUT_MS = 5 * 60 * 1000
 
+# if True, LaunchPads and FilePads connecting with the same parameters share one MongoClient (and
+# its connection pool) per process, instead of opening new connections for every instance
+MONGO_SHARE_CLIENTS = True
+
 # name of the collection that will be used to store information in case the size of
 # a dynamically generated document exceeds the 16MB limit. Functionality disabled if None.
 GRIDFS_FALLBACK_COLLECTION = "fw_gridfs"
 
+# name of the capped collection used to notify waiting launchers that new Fireworks became READY.
+# Launchers fall back to plain sleeping if None.
+READY_EVENTS_COLLECTION = "ready_events"
+READY_EVENTS_SIZE = 1024 * 1024  # max size (bytes) of the capped ready events collection
+
+# number of fw_ids and launch_ids a LaunchPad leases from the database at once and hands out
+# locally, which avoids contention on the id counter. 1 takes every id from the database.
+ID_BLOCK_SIZE = 1
+
+# refresh Workflows with optimistic concurrency control: the Workflow is loaded and refreshed
+# without its WFLock, which is only held to commit the changes. Commits are checked against the
+# version of the Workflow document and the fw_ids changed by the last WF_CHANGE_LOG_SIZE commits.
+# The log of the changed fw_ids is only kept while this is enabled.
+WF_OPTIMISTIC_REFRESH = False
+WF_CHANGE_LOG_SIZE = 100
+
+# if True, completing Rockets only store their Launch and queue a completion event in the
+# COMPLETION_EVENTS_COLLECTION. The Workflows are refreshed in batches by a reducer, run by
+# "lpad reducer" or "lpad admin maintain". Otherwise every Rocket refreshes its Workflow itself.
+COMPLETION_QUEUE = False
+COMPLETION_EVENTS_COLLECTION = "completion_events"
+REDUCER_BATCH_SIZE = 1000  # max number of completion events reduced at once
+REDUCER_INTERVAL = 1  # secs the reducer sleeps when there are no completion events
+REDUCER_CLAIM_SECS = 60 * 5  # completion events claimed by a reducer that died are redone after
+
+# if True, Rockets hand their final FWAction to a background thread which completes the Launches
+# in batches, so that rapidfire can start the next Rocket right away. Pending completions are
+# journaled in COMPLETION_JOURNAL_DIR (~/.fireworks/journal if None), written when the process
+# exits and replayed by the next process or "lpad admin maintain" if it died before. Use a
+# directory shared by all nodes, so that the journals of killed jobs are replayed from any node.
+ASYNC_COMPLETION = False
+COMPLETION_BATCH_SIZE = 100  # max number of Launches completed with one bulk write
+COMPLETION_FLUSH_SECS = 1  # max time a completion waits for its batch to fill up
+COMPLETION_JOURNAL_DIR = None
+# the journal of a process on another host is replayed once its lock was not touched this long
+COMPLETION_JOURNAL_EXPIRATION_SECS = 600
+
+# if True, READY Fireworks are also listed with small documents in the READY_QUEUE_COLLECTION, from
+# which FWorkers without a custom query claim their Fireworks. Run "lpad admin maintain" after
+# enabling it on an existing database to list the Fireworks that are READY already.
+READY_QUEUE = False
+READY_QUEUE_COLLECTION = "ready_queue"
+# with more than 1 partition, a claim first tries a random partition of the ready queue, so that
+# concurrent workers do not all race for the same document. The order of priority then only holds
+# within a partition.
+READY_QUEUE_PARTITIONS = 1
+
+# Workflows with at least this many FireWorks keep an array-backed form of their DAG (requires
+# NumPy) to find roots, leaves and children to refresh and to aggregate the Workflow state.
+# Disabled if None.
+WF_COMPACT_THRESHOLD = 10000
+
 
 def override_user_settings():
     module_dir = os.path.dirname(os.path.abspath(__file__))
@@ -188,3 +246,6 @@ class FWData(object):
         self.SUB_NPROCS = None  # the number of process of the sub job
         self.DATASERVER = None  # the shared object manager
         self.Running_IDs = None
+        self.Checkpoints = None  # checkpoints of the sub jobs not sent to the LaunchPad yet
+        self.Reservations = None  # (fw_id, launch_id) of the Fireworks reserved for the sub jobs
+        self.Reservations_Lock = None
@@ -203,6 +203,7 @@ def rapidfire(launchpad, fworker, qadapter, launch_dir='.', nlaunches=0, njobs_q
             block_dir = create_datestamp_dir(launch_dir, l_logger)
 
         while True:
+            ready_marker = launchpad.get_ready_marker()
             # get number of jobs in queue if a maximum has been set.
             jobs_in_queue = 0
             if njobs_queue:
@@ -257,7 +258,10 @@ def rapidfire(launchpad, fworker, qadapter, launch_dir='.', nlaunches=0, njobs_q
                 break
 
             l_logger.info('Finished a round of launches, sleeping for {} secs'.format(sleep_time))
-            time.sleep(sleep_time)
+            if njobs_queue and jobs_in_queue >= njobs_queue:
+                time.sleep(sleep_time)  # new READY jobs don't help while the queue is full
+            else:
+                launchpad.wait_for_ready(sleep_time, ready_marker)
             l_logger.info('Checking for Rockets to run...')
 
     except Exception:
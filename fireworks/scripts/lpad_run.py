@@ -26,7 +26,7 @@ import ruamel.yaml as yaml
 
 from fireworks.fw_config import RESERVATION_EXPIRATION_SECS, \
     RUN_EXPIRATION_SECS, PW_CHECK_NUM, MAINTAIN_INTERVAL, CONFIG_FILE_DIR, \
-    LAUNCHPAD_LOC, FWORKER_LOC, WEBSERVER_PORT, WEBSERVER_HOST
+    LAUNCHPAD_LOC, FWORKER_LOC, WEBSERVER_PORT, WEBSERVER_HOST, REDUCER_INTERVAL
 from fireworks.features.fw_report import FWReport
 from fireworks.features.introspect import Introspector
 from fireworks.core.launchpad import LaunchPad, WFLock
@@ -36,6 +36,7 @@ from fireworks import __version__ as FW_VERSION
 from fireworks import FW_INSTALL_DIR
 from fireworks.user_objects.firetasks.script_task import ScriptTask
 from fireworks.utilities.fw_serializers import DATETIME_HANDLER, recursive_dict
+from fireworks.utilities.index_advisor import IndexAdvisor, PLAN_PROBLEMS
 
 __author__ = 'Anubhav Jain'
 __credits__ = 'Shyue Ping Ong'
@@ -536,7 +537,32 @@ def detect_unreserved(args):
 
 def tuneup(args):
     lp = get_lp(args)
-    lp.tuneup(bkground=not args.full)
+    if not args.advise:
+        lp.tuneup(bkground=not args.full)
+        return
+
+    fworker = FWorker.from_file(args.fworker_file) if args.fworker_file else FWorker.auto_load()
+    advisor = IndexAdvisor(lp, fworker)
+    advice = advisor.advise(n_samples=args.profile_samples)
+    problem_names = dict(PLAN_PROBLEMS)
+    for a in advice:
+        print("{} query on {}: {}".format(a['source'], a['collection'], ", ".join(
+            problem_names[p] for p in a['problems'])))
+        print("    query: {}".format(json.dumps(a['query'], default=DATETIME_HANDLER)))
+        if a['sort']:
+            print("    sort: {}".format(a['sort']))
+        for keys in a['indexes']:
+            print("    proposed index: {}".format(keys))
+    if not advice:
+        print("No collection scans or in-memory sorts found.")
+    elif args.create_indexes:
+        for collection, keys in advisor.create_indexes(advice, background=not args.full):
+            print("Created index {} on {}".format(keys, collection))
+
+
+def migrate_launches(args):
+    lp = get_lp(args)
+    lp.migrate_launches()
 
 
 def defuse_wfs(args):
@@ -857,6 +883,11 @@ def maintain(args):
     lp.maintain(args.infinite, args.maintain_interval)
 
 
+def reducer(args):
+    lp = get_lp(args)
+    lp.run_reducer(not args.once, args.reducer_interval)
+
+
 def orphaned(args):
     # get_fws
     lp = get_lp(args)
@@ -1444,6 +1475,16 @@ def lpad():
     fizzled_parser.add_argument(*enh_disp_args, **enh_disp_kwargs)
     fizzled_parser.set_defaults(func=detect_lostruns)
 
+    reducer_parser = subparsers.add_parser('reducer', help='refresh the workflows of completed '
+                                                           'launches in batches (requires '
+                                                           'COMPLETION_QUEUE in FW_config)')
+    reducer_parser.add_argument('--once', help='exit once all completions are reduced',
+                                action='store_true')
+    reducer_parser.add_argument('--reducer_interval', help='sleep time when there are no '
+                                                           'completions to reduce (seconds)',
+                                default=REDUCER_INTERVAL, type=float)
+    reducer_parser.set_defaults(func=reducer)
+
     priority_parser = subparsers.add_parser('set_priority', help='modify the priority of one or more FireWorks')
     priority_parser.add_argument('priority', help='get FW with this fw_id', default=None, type=int)
     priority_parser.add_argument(*fw_id_args, **fw_id_kwargs)
@@ -1543,8 +1584,27 @@ def lpad():
                                                     'scheduled downtime)')
     tuneup_parser.add_argument('--full', help='Run full tuneup and compaction (should be run during '
                                               'DB downtime only)', action='store_true')
+    tuneup_parser.add_argument('--advise', help='Instead of the tuneup, explain the queries of '
+                                                'FireWorks and of the database profiler and '
+                                                'report collection scans and in-memory sorts, '
+                                                'with the indexes that would avoid them',
+                               action='store_true')
+    tuneup_parser.add_argument('--create_indexes', help='With --advise, create the proposed '
+                                                        'indexes', action='store_true')
+    tuneup_parser.add_argument('--profile_samples', help='With --advise, the number of latest '
+                                                         'database profiler entries to explain '
+                                                         '(profiling must be enabled)',
+                               default=100, type=int)
+    tuneup_parser.add_argument('-w', '--fworker_file', help='With --advise, the FWorker file '
+                                                            'whose checkout query is explained')
     tuneup_parser.set_defaults(func=tuneup)
 
+    migrate_parser = admin_subparser.add_parser('migrate_launches',
+                                                help='Add the indexed state_updated_on field to '
+                                                     'launches stored by older versions of '
+                                                     'FireWorks (run once after upgrading)')
+    migrate_parser.set_defaults(func=migrate_launches)
+
     refresh_parser = admin_subparser.add_parser('refresh', help='manually force a workflow refresh '
                                                                 '(not usually needed)')
     refresh_parser.add_argument(*fw_id_args, **fw_id_kwargs)
@@ -60,6 +60,10 @@ def rlaunch():
                               type=int)
     rapid_parser.add_argument('--local_redirect', help="Redirect stdout and stderr to the launch directory",
                               action="store_true")
+    rapid_parser.add_argument('--prefetch', help='number of FireWorks to keep reserved locally, the '
+                                                 'next ones are reserved while the current one runs '
+                                                 '(default 0 disables prefetching)',
+                              default=0, type=int)
 
     multi_parser.add_argument('num_jobs', help='the number of jobs to run in parallel', type=int)
     multi_parser.add_argument('--nlaunches', help='number of FireWorks to run in series per '
@@ -82,6 +86,10 @@ def rlaunch():
                               action="store_true")
     multi_parser.add_argument('--local_redirect', help="Redirect stdout and stderr to the launch directory",
                               action="store_true")
+    multi_parser.add_argument('--batch_size', help='number of FireWorks the parallel jobs reserve at '
+                                                   'once and share (default 0 lets each job check '
+                                                   'out its own FireWork)',
+                              default=0, type=int)
 
     parser.add_argument('-l', '--launchpad_file', help='path to launchpad file')
     parser.add_argument('-w', '--fworker_file', help='path to fworker file')
@@ -138,7 +146,7 @@ def rlaunch():
     if args.command == 'rapidfire':
         rapidfire(launchpad, fworker=fworker, m_dir=None, nlaunches=args.nlaunches,
                   max_loops=args.max_loops, sleep_time=args.sleep, strm_lvl=args.loglvl,
-                  timeout=args.timeout, local_redirect=args.local_redirect)
+                  timeout=args.timeout, local_redirect=args.local_redirect, prefetch=args.prefetch)
     elif args.command == 'multi':
         total_node_list = None
         if args.nodefile:
@@ -149,7 +157,7 @@ def rlaunch():
         launch_multiprocess(launchpad, fworker, args.loglvl, args.nlaunches, args.num_jobs,
                             args.sleep, total_node_list, args.ppn, timeout=args.timeout,
                             exclude_current_node=args.exclude_current_node,
-                            local_redirect=args.local_redirect)
+                            local_redirect=args.local_redirect, batch_size=args.batch_size)
     else:
         launch_rocket(launchpad, fworker, args.fw_id, args.loglvl, pdb_on_exception=args.pdb)
 
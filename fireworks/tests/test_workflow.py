@@ -1,6 +1,12 @@
 import unittest
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 import fireworks as fw
+from fireworks.core.compact_dag import NUMPY_INSTALLED
 
 
 class TestWorkflowState(unittest.TestCase):
@@ -114,3 +120,326 @@ class TestWorkflowState(unittest.TestCase):
                           parents=one)
 
         self.assertEqual(fw.Workflow([one, two]).state, 'READY')
+
+
+class TestWorkflowScaling(unittest.TestCase):
+    """
+    Checks that refreshing large workflows does a linear amount of work, counted in refreshed
+    and ranked Fireworks so that the checks don't depend on the speed of the machine.
+    """
+
+    @staticmethod
+    def _fan_out_wf(n_children):
+        launch = fw.Launch('COMPLETED', '.', host='localhost', ip='127.0.0.1',
+                           action=fw.FWAction(), fw_id=1)
+        root = fw.Firework([], fw_id=1, launches=[launch])
+        children = [fw.Firework([], fw_id=i, parents=root) for i in range(2, n_children + 2)]
+        return fw.Workflow([root] + children)
+
+    def test_fan_out_refresh_is_linear(self):
+        for n_children in (2000, 8000):
+            wf = self._fan_out_wf(n_children)
+            with mock.patch.object(wf, '_refresh_fw', wraps=wf._refresh_fw) as refresh_fw:
+                updated_ids = wf.refresh(1)
+            self.assertEqual(len(updated_ids), n_children + 1)
+            self.assertEqual(refresh_fw.call_count, n_children + 1)
+            self.assertEqual(len(wf._topological_ranks[3]), n_children + 1)
+
+    @staticmethod
+    def _completed_launch(fw_id):
+        return fw.Launch('COMPLETED', '.', host='localhost', ip='127.0.0.1',
+                         action=fw.FWAction(), fw_id=fw_id)
+
+    def _chain_wf(self, n):
+        fws = [fw.Firework([], fw_id=1, launches=[self._completed_launch(1)])]
+        for i in range(2, n + 1):
+            fws.append(fw.Firework([], fw_id=i, parents=fws[-1],
+                                   launches=[self._completed_launch(i)]))
+        return fw.Workflow(fws)
+
+    def _diamond_wf(self, n_middle):
+        top = fw.Firework([], fw_id=1, launches=[self._completed_launch(1)])
+        middle = [fw.Firework([], fw_id=i, parents=top, launches=[self._completed_launch(i)])
+                  for i in range(2, n_middle + 2)]
+        bottom = fw.Firework([], fw_id=n_middle + 2, parents=middle)
+        return fw.Workflow([top] + middle + [bottom])
+
+    def test_deep_chain(self):
+        # 10k levels would exceed the recursion limit of a recursive refresh
+        wf = self._chain_wf(10000)
+        self.assertEqual(len(wf.refresh(1)), 10000)
+        self.assertEqual(wf.state, 'COMPLETED')
+
+        updated_ids = wf.rerun_fw(1)
+        self.assertEqual(len(updated_ids), 10000)
+        self.assertEqual(wf.fw_states[1], 'READY')
+        self.assertEqual(wf.fw_states[10000], 'WAITING')
+
+    def test_wide_diamond(self):
+        wf = self._diamond_wf(10000)
+        with mock.patch.object(wf, '_refresh_fw', wraps=wf._refresh_fw) as refresh_fw:
+            updated_ids = wf.refresh(1)
+        # every firework is refreshed once, the bottom one after all of its parents
+        self.assertEqual(refresh_fw.call_count, 10002)
+        self.assertEqual(len(updated_ids), 10002)
+        self.assertEqual(wf.fw_states[10002], 'READY')
+
+        with mock.patch.object(wf, '_refresh_fw', wraps=wf._refresh_fw) as refresh_fw:
+            wf.rerun_fw(1)
+        self.assertEqual(refresh_fw.call_count, 10002)
+        self.assertEqual(wf.fw_states[10002], 'WAITING')
+
+    def test_chain_and_diamond_refresh_is_linear(self):
+        def count_refreshes(wf):
+            with mock.patch.object(wf, '_refresh_fw', wraps=wf._refresh_fw) as refresh_fw:
+                wf.refresh(1)
+            return refresh_fw.call_count
+
+        for n in (2500, 10000):
+            self.assertEqual(count_refreshes(self._chain_wf(n)), n)
+            self.assertEqual(count_refreshes(self._diamond_wf(n)), n + 2)
+
+    def test_rank_affected_subgraph(self):
+        # completing one child of a large fan-out only ranks the descendants of that child
+        wf = self._diamond_wf(1000)
+        wf.refresh(1)
+        self.assertEqual(len(wf._topological_ranks[3]), 1002)
+        self.assertEqual(wf._get_topological_ranks(2), {2: 0, 1002: 1})
+
+        # the ranks are taken again once the links change
+        wf.links[1002] = [1003]
+        wf.id_fw[1003] = fw.Firework([], fw_id=1003)
+        self.assertEqual(wf._get_topological_ranks(2), {2: 0, 1002: 1, 1003: 2})
+
+    def test_links_index(self):
+        one = fw.Firework([], fw_id=1)
+        two = fw.Firework([], fw_id=2, parents=one)
+        three = fw.Firework([], fw_id=3, parents=one)
+        links = fw.Workflow([one, two, three]).links
+        self.assertEqual(links.parent_links, {2: [1], 3: [1]})
+        self.assertEqual(sorted(links.nodes), [1, 2, 3])
+
+        links[2] = [3]
+        self.assertEqual(links.parent_links, {2: [1], 3: [1, 2]})
+        links[1] = [2]
+        self.assertEqual(links.parent_links, {2: [1], 3: [2]})
+        del links[3]
+        links[4] = []
+        self.assertEqual(links.parent_links, {2: [1], 3: [2]})
+        self.assertEqual(sorted(links.nodes), [1, 2, 3, 4])
+        links[2] = []
+        self.assertEqual(links.parent_links, {2: [1]})
+        self.assertEqual(sorted(links.nodes), [1, 2, 4])
+
+        # the index can't be changed from outside of the links
+        with self.assertRaises(TypeError):
+            links.parent_links[3] = [1]
+        links.parent_links[2].append(4)
+        self.assertEqual(links.parent_links, {2: [1]})
+        with self.assertRaises(AttributeError):
+            links.nodes.append(5)
+
+
+class TestWorkflowStateUpdates(unittest.TestCase):
+
+    def test_state_follows_fw_states(self):
+        one = fw.Firework([], state='COMPLETED', fw_id=1)
+        two = fw.Firework([], state='WAITING', fw_id=2, parents=one)
+        three = fw.Firework([], state='WAITING', fw_id=3, parents=one,
+                            spec={'_allow_fizzled_parents': True})
+        wf = fw.Workflow([one, two, three])
+        self.assertEqual(wf.state, 'RUNNING')
+
+        wf.fw_states[2] = 'COMPLETED'
+        wf.fw_states[3] = 'COMPLETED'
+        self.assertEqual(wf.state, 'COMPLETED')
+
+        wf.fw_states[3] = 'FIZZLED'
+        self.assertEqual(wf.state, 'FIZZLED')
+        wf.fw_states[3] = 'RUNNING'
+        self.assertEqual(wf.state, 'RUNNING')
+
+        # a fizzled parent only blocks if its children don't allow it
+        wf.fw_states[1] = 'FIZZLED'
+        wf.fw_states[2] = 'WAITING'
+        self.assertEqual(wf.state, 'FIZZLED')
+        wf.links[1] = [3]
+        self.assertEqual(wf.state, 'RUNNING')
+
+        wf.fw_states[1] = 'PAUSED'
+        self.assertEqual(wf.state, 'PAUSED')
+        for fw_id in wf.fw_states:
+            wf.fw_states[fw_id] = 'ARCHIVED'
+        self.assertEqual(wf.state, 'ARCHIVED')
+
+    def test_state_after_spec_changes(self):
+        one = fw.Firework([], state='COMPLETED', fw_id=1)
+        two = fw.Firework([], state='FIZZLED', fw_id=2, parents=one)
+        three = fw.Firework([], state='WAITING', fw_id=3, parents=two)
+        wf = fw.Workflow([one, two, three])
+        self.assertEqual(wf.state, 'FIZZLED')
+
+        wf.apply_action(fw.FWAction(update_spec={'_allow_fizzled_parents': True}), 2)
+        self.assertEqual(wf.state, 'RUNNING')
+        wf.apply_action(fw.FWAction(mod_spec=[{'_set': {'_allow_fizzled_parents': False}}],
+                                    propagate=True), 1)
+        self.assertEqual(wf.state, 'FIZZLED')
+
+    def test_state_after_reassign_ids(self):
+        one = fw.Firework([], state='COMPLETED', fw_id=-1)
+        two = fw.Firework([], state='FIZZLED', fw_id=-2, parents=one)
+        wf = fw.Workflow([one, two])
+        self.assertEqual(wf.state, 'FIZZLED')
+        wf._reassign_ids({-1: 1, -2: 2})
+        self.assertEqual(wf.state, 'FIZZLED')
+        wf.fw_states[2] = 'COMPLETED'
+        self.assertEqual(wf.state, 'COMPLETED')
+
+
+class TestWorkflowDbChanges(unittest.TestCase):
+
+    def test_fw_db_changes(self):
+        one = fw.Firework([], state='WAITING', fw_id=1)
+        self.assertIsNone(one._get_db_changes())
+        one._set_db_dict(one.to_db_dict())
+        self.assertEqual(one._get_db_changes(), ({}, []))
+        one.state = 'READY'
+        to_set, to_unset = one._get_db_changes()
+        self.assertEqual(sorted(to_set), ['state', 'updated_on'])
+        self.assertEqual(to_unset, [])
+
+    def test_wf_db_changes(self):
+        one = fw.Firework([], state='COMPLETED', fw_id=1)
+        two = fw.Firework([], state='WAITING', fw_id=2, parents=one)
+        wf = fw.Workflow([one, two])
+        self.assertIsNone(wf._get_db_changes())
+        wf._set_saved()
+        self.assertNotIn('fw_states.2', wf._get_db_changes())
+
+        wf.fw_states[2] = 'READY'
+        changes = wf._get_db_changes()
+        self.assertEqual(changes['fw_states.2'], 'READY')
+        self.assertNotIn('fw_states.1', changes)
+        self.assertEqual(changes['state'], 'RUNNING')
+
+        # structural changes need the whole document to be replaced
+        wf.links[2] = []
+        self.assertIsNone(wf._get_db_changes())
+
+
+
+@unittest.skipIf(not NUMPY_INSTALLED, "NumPy is required for the compact DAG")
+class TestWorkflowCompactDAG(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('fireworks.core.firework.WF_COMPACT_THRESHOLD', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _diamond_wf():
+        launch = fw.Launch('COMPLETED', '.', host='localhost', ip='127.0.0.1',
+                           action=fw.FWAction(), fw_id=1)
+        one = fw.Firework([], fw_id=1, launches=[launch])
+        two = fw.Firework([], fw_id=2, parents=one)
+        three = fw.Firework([], fw_id=3, parents=one)
+        four = fw.Firework([], fw_id=4, parents=[two, three])
+        five = fw.Firework([], fw_id=5, parents=one)
+        return fw.Workflow([one, two, three, four, five])
+
+    def test_roots_and_leaves(self):
+        wf = self._diamond_wf()
+        self.assertIsNotNone(wf._get_compact_dag())
+        self.assertEqual(wf.root_fw_ids, [1])
+        self.assertEqual(sorted(wf.leaf_fw_ids), [4, 5])
+
+        wf.links[6] = [1]
+        wf.id_fw[6] = fw.Firework([], fw_id=6)
+        self.assertEqual(wf.root_fw_ids, [6])
+
+    def test_refresh(self):
+        wf = self._diamond_wf()
+        dag = wf._get_compact_dag()
+        with mock.patch.object(dag, 'children_to_refresh',
+                               wraps=dag.children_to_refresh) as children_to_refresh:
+            self.assertEqual(wf.refresh(1), {1, 2, 3, 5})
+        children_to_refresh.assert_called_once_with(1)
+        self.assertEqual(wf.fw_states, {1: 'COMPLETED', 2: 'READY', 3: 'READY', 4: 'WAITING',
+                                        5: 'READY'})
+        self.assertEqual(wf.state, 'RUNNING')
+
+        # the child of two is skipped as long as three did not finish
+        wf.fw_states[2] = 'COMPLETED'
+        self.assertEqual(dag.children_to_refresh(2), [])
+        wf.fw_states[3] = 'FIZZLED'
+        self.assertEqual(dag.children_to_refresh(2), [4])
+        self.assertEqual(wf.state, 'FIZZLED')
+        wf.id_fw[4].spec['_allow_fizzled_parents'] = True
+        self.assertEqual(wf.state, 'RUNNING')
+
+    def test_index(self):
+        wf = self._diamond_wf()
+        dag = wf._get_compact_dag()
+        self.assertEqual(dag.index(3), 2)
+        self.assertEqual(dag.index(7), -1)
+        self.assertEqual(dag.index([5, 0, 1]).tolist(), [4, -1, 0])
+
+        wf.links[10] = [1]
+        wf.id_fw[10] = fw.Firework([], fw_id=10)
+        dag = wf._get_compact_dag()
+        self.assertEqual(dag.index(10), 5)
+        self.assertEqual(dag.index(7), -1)
+        self.assertEqual(dag.index([10, 6, 4]).tolist(), [5, -1, 3])
+
+    def test_fizzled_parents(self):
+        one = fw.Firework([], state='FIZZLED', fw_id=1)
+        two = fw.Firework([], state='COMPLETED', fw_id=2)
+        three = fw.Firework([], fw_id=3, parents=[one, two],
+                            spec={'_allow_fizzled_parents': True})
+        wf = fw.Workflow([one, two, three])
+        dag = wf._get_compact_dag()
+        self.assertFalse(dag.parents_completed(3))
+        self.assertTrue(dag.parents_completed(3, allow_fizzled=True))
+        self.assertEqual(dag.parents_in_state(3, 'FIZZLED'), [1])
+
+        wf.refresh(3)
+        self.assertEqual(wf.fw_states[3], 'READY')
+        self.assertEqual([p['fw_id'] for p in wf.id_fw[3].spec['_fizzled_parents']], [1])
+        wf.fw_states[1] = 'READY'
+        self.assertFalse(dag.parents_completed(3, allow_fizzled=True))
+
+    def test_large_workflow(self):
+        with mock.patch('fireworks.core.firework.WF_COMPACT_THRESHOLD', 10000):
+            wf = TestWorkflowScaling._fan_out_wf(20000)
+            self.assertEqual(wf.root_fw_ids, [1])
+            self.assertEqual(len(wf.leaf_fw_ids), 20000)
+            self.assertEqual(len(wf.refresh(1)), 20001)
+            self.assertIsNotNone(wf.fw_states.dag)
+            self.assertEqual(wf.state, 'RUNNING')
+            for fw_id in range(2, 20002):
+                wf.fw_states[fw_id] = 'COMPLETED'
+            self.assertEqual(wf.state, 'COMPLETED')
+
+
+@unittest.skipIf(not NUMPY_INSTALLED, "NumPy is required for the compact DAG")
+class TestWorkflowStateCompact(TestWorkflowState):
+    """
+    Runs the state checks on the CompactDAG.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('fireworks.core.firework.WF_COMPACT_THRESHOLD', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@unittest.skipIf(not NUMPY_INSTALLED, "NumPy is required for the compact DAG")
+class TestWorkflowStateUpdatesCompact(TestWorkflowStateUpdates):
+    """
+    Runs the state updates on the CompactDAG.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('fireworks.core.firework.WF_COMPACT_THRESHOLD', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
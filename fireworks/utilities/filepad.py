@@ -10,7 +10,6 @@ add/delete/update any file of any size.
 import zlib
 import os
 
-from pymongo import MongoClient
 import pymongo
 import gridfs
 
@@ -18,7 +17,7 @@ from monty.serialization import loadfn
 from monty.json import MSONable
 
 from fireworks.fw_config import LAUNCHPAD_LOC, MONGO_SOCKET_TIMEOUT_MS
-from fireworks.utilities.fw_utilities import get_fw_logger
+from fireworks.utilities.fw_utilities import get_fw_logger, get_mongo_client
 
 __author__ = 'Kiran Mathew'
 __email__ = 'kmathew@lbl.gov'
@@ -79,21 +78,21 @@ class FilePad(MSONable):
 
         # get connection
         if uri_mode:
-            self.connection = MongoClient(host)
+            self.connection = get_mongo_client(host)
             dbname = host.split('/')[-1].split('?')[
                 0]  # parse URI to extract dbname
             self.db = self.connection[dbname]
         else:
-            self.connection = MongoClient(self.host, self.port, ssl=self.ssl,
-                                          ssl_ca_certs=self.ssl_ca_certs,
-                                          ssl_certfile=self.ssl_certfile,
-                                          ssl_keyfile=self.ssl_keyfile,
-                                          ssl_pem_passphrase=self.ssl_pem_passphrase,
-                                          socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
-                                          username=self.username,
-                                          password=self.password,
-                                          authSource=self.authsource,
-                                          **self.mongoclient_kwargs)
+            self.connection = get_mongo_client(self.host, self.port, ssl=self.ssl,
+                                               ssl_ca_certs=self.ssl_ca_certs,
+                                               ssl_certfile=self.ssl_certfile,
+                                               ssl_keyfile=self.ssl_keyfile,
+                                               ssl_pem_passphrase=self.ssl_pem_passphrase,
+                                               socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                                               username=self.username,
+                                               password=self.password,
+                                               authSource=self.authsource,
+                                               **self.mongoclient_kwargs)
             self.db = self.connection[self.database]
         # except Exception:
         #     raise Exception("connection failed")
@@ -12,8 +12,12 @@ import multiprocessing
 import errno
 import six
 import contextlib
+import threading
 
-from fireworks.fw_config import FWData, FW_BLOCK_FORMAT, DS_PASSWORD, FW_LOGGING_FORMAT
+from pymongo import MongoClient
+
+from fireworks.fw_config import FWData, FW_BLOCK_FORMAT, DS_PASSWORD, FW_LOGGING_FORMAT, \
+    MONGO_SHARE_CLIENTS
 
 __author__ = 'Anubhav Jain, Xiaohui Qu'
 __copyright__ = 'Copyright 2012, The Materials Project'
@@ -179,6 +183,39 @@ def get_my_host():
     return _g_host
 
 
+_mongo_clients = {}  # connection parameters -> MongoClient of this process
+_mongo_clients_pid = None
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(*args, **kwargs):
+    """
+    Get a MongoClient. With MONGO_SHARE_CLIENTS, all callers of a process that pass the same
+    arguments share one client, which is created on first use. A forked process creates its own
+    clients, since a MongoClient must not be used across a fork.
+
+    Args:
+        args: positional arguments of MongoClient
+        kwargs: keyword arguments of MongoClient
+
+    Returns:
+        MongoClient
+    """
+    global _mongo_clients_pid
+    if not MONGO_SHARE_CLIENTS:
+        return MongoClient(*args, **kwargs)
+    key = repr((args, sorted(kwargs.items())))
+    with _mongo_clients_lock:
+        if _mongo_clients_pid != os.getpid():
+            _mongo_clients.clear()  # inherited from the parent process
+            _mongo_clients_pid = os.getpid()
+        client = _mongo_clients.get(key)
+        if client is None:
+            client = MongoClient(*args, **kwargs)
+            _mongo_clients[key] = client
+        return client
+
+
 def get_slug(m_str):
     valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
     m_str = ''.join(c for c in m_str if c in valid_chars)
@@ -0,0 +1,313 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+"""
+This module contains the IndexAdvisor, which explains the queries FireWorks issues, and the ones
+recorded by the database profiler, to find collection scans and in-memory sorts. It proposes (and
+optionally creates) the compound indexes that would avoid them, see "lpad admin tuneup --advise".
+"""
+
+import datetime
+import json
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from fireworks.core.fworker import FWorker
+from fireworks.fw_config import RUN_EXPIRATION_SECS, RESERVATION_EXPIRATION_SECS
+
+# plan stages reported by the advisor
+PLAN_PROBLEMS = [('COLLSCAN', 'collection scan'), ('SORT', 'in-memory sort')]
+
+# predicates an index can answer with point intervals
+EQUALITY_OPERATORS = ('$eq', '$in')
+
+
+def get_index_keys(query, sort=None):
+    """
+    Propose the compound indexes for a query: fields matched by equality first, then the sort
+    keys, then the fields matched by a range. Each branch of a top-level $or gets its own index,
+    like Mongo plans them.
+
+    Args:
+        query (dict): a Mongo query
+        sort ([(str, int)]): sort argument in Pymongo format
+
+    Returns:
+        [[(str, int)]]: the keys of the proposed indexes
+    """
+    sort = list(sort or [])
+    rest = {k: v for k, v in query.items() if k != '$or'}
+    branches = [dict(rest, **b) for b in query['$or']] if '$or' in query else [query]
+    indexes = []
+    for branch in branches:
+        equality, ranges = [], []
+        for key, value in _iter_predicates(branch):
+            fields = equality if _is_equality(value) else ranges
+            if key not in equality + ranges:
+                fields.append(key)
+        keys = [(k, ASCENDING) for k in equality]
+        keys.extend((k, d) for k, d in sort if k not in equality)
+        keys.extend((k, ASCENDING) for k in ranges if k not in dict(keys))
+        if keys and keys not in indexes:
+            indexes.append(keys)
+    return indexes
+
+
+def get_query_shape(query):
+    """
+    Replace the values of a query by placeholders, so that queries differing only in their values
+    share a shape.
+
+    Args:
+        query (dict): a Mongo query
+
+    Returns:
+        dict
+    """
+    if isinstance(query, dict):
+        return {k: get_query_shape(v) for k, v in query.items()}
+    if isinstance(query, (list, tuple)) and query and isinstance(query[0], dict):
+        return [get_query_shape(q) for q in query]
+    return 1
+
+
+def get_plan_stages(explained):
+    """
+    Get the stages of the winning plan of an explained query.
+
+    Args:
+        explained (dict): the output of Cursor.explain()
+
+    Returns:
+        [str]: the stage names, from the root of the plan down
+    """
+    plans = [explained['queryPlanner']['winningPlan']]
+    stages = []
+    while plans:
+        plan = plans.pop(0)
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        if 'queryPlan' in plan:  # slot based execution
+            plans.append(plan['queryPlan'])
+        if 'inputStage' in plan:
+            plans.append(plan['inputStage'])
+        plans.extend(plan.get('inputStages', []))
+        plans.extend(s['winningPlan'] for s in plan.get('shards', []))
+    return stages
+
+
+def get_profiled_query(entry):
+    """
+    Get the query of a read or update recorded by the database profiler.
+
+    Args:
+        entry (dict): a document of the system.profile collection
+
+    Returns:
+        (str, dict, [(str, int)]): the collection name, the query and the sort, None if the
+            entry is not a query
+    """
+    collection = entry.get('ns', '').split('.', 1)[-1]
+    command = entry.get('command') or entry.get('query') or {}
+    if '$query' in command:  # legacy find
+        query, sort = command['$query'], command.get('$orderby')
+    elif 'find' in command:
+        query, sort = command.get('filter', {}), command.get('sort')
+    elif 'findAndModify' in command or 'findandmodify' in command:
+        query, sort = command.get('query', {}), command.get('sort')
+    elif 'count' in command:
+        query, sort = command.get('query', {}), None
+    elif 'q' in command:  # update or delete
+        query, sort = command['q'], None
+    else:
+        return None
+    return collection, query, list(sort.items()) if sort else None
+
+
+def _iter_predicates(query):
+    for key, value in query.items():
+        if key == '$and':
+            for clause in value:
+                for predicate in _iter_predicates(clause):
+                    yield predicate
+        elif key.startswith('$'):  # nested $or, $expr and $text need their own indexes
+            continue
+        elif isinstance(value, dict) and list(value) == ['$elemMatch'] and \
+                not any(k.startswith('$') for k in value['$elemMatch']):
+            # the fields of the array elements are indexed, not the elements
+            for sub_key, sub_value in _iter_predicates(value['$elemMatch']):
+                yield '{}.{}'.format(key, sub_key), sub_value
+        else:
+            yield key, value
+
+
+def _is_equality(value):
+    if not isinstance(value, dict) or not value:
+        return True
+    operators = [k for k in value if k.startswith('$')]
+    return not operators or all(k in EQUALITY_OPERATORS for k in operators)
+
+
+class IndexAdvisor(object):
+    """
+    Explain the queries of FireWorks and of the database profiler and propose indexes for those
+    with a collection scan or an in-memory sort.
+    """
+
+    def __init__(self, launchpad, fworker=None):
+        """
+        Args:
+            launchpad (LaunchPad)
+            fworker (FWorker): the FWorker whose checkout query is explained
+        """
+        self.lp = launchpad
+        self.fworker = fworker if fworker else FWorker()
+
+    def get_fireworks_queries(self):
+        """
+        Get the query shapes FireWorks itself issues: checkouts by the FWorker, lost run and
+        expired reservation detection and the listings of the web GUI, including the lookups by
+        metadata key. The aggregations of the detection are explained stage by stage: their
+        first $match, and the equality match each $lookup runs on the foreign collection for
+        every input document.
+
+        Returns:
+            [(str, str, dict, [(str, int)])]: the source, collection name, query and sort of
+                each query
+        """
+        lp = self.lp
+        now = datetime.datetime.utcnow()
+        checkout_query = dict(self.fworker.query)
+        checkout_query['state'] = 'READY'
+        newest = [('_id', DESCENDING)]
+        queries = [
+            ('checkout', lp.fireworks.name, checkout_query, lp._get_checkout_sort()),
+            ('lost runs', lp.launches.name, lp._get_stale_launch_query(
+                'RUNNING', now - datetime.timedelta(seconds=RUN_EXPIRATION_SECS)), None),
+            ('lost run fireworks', lp.fireworks.name, {'fw_id': {'$in': [0]}, 'state': 'RUNNING'},
+             None),
+            ('lost run launches lookup', lp.launches.name, {'launch_id': {'$in': [0]}}, None),
+            ('inconsistent runs', lp.fireworks.name, {'state': 'RUNNING'}, None),
+            ('expired reservations', lp.launches.name, lp._get_stale_launch_query(
+                'RESERVED', now - datetime.timedelta(seconds=RESERVATION_EXPIRATION_SECS)), None),
+            ('expired reservations lookup', lp.fireworks.name, {'fw_id': 0}, None),
+            ('GUI fireworks', lp.fireworks.name, {'state': 'COMPLETED'}, newest),
+            ('GUI workflows', lp.workflows.name, {'state': 'COMPLETED'}, newest)]
+        for key, value in sorted(self._get_metadata_samples().items()):
+            queries.append(('GUI metadata', lp.workflows.name,
+                            {'metadata.{}'.format(key): value}, newest))
+        return queries
+
+    def get_profiled_queries(self, n_samples=100):
+        """
+        Get the latest queries on the FireWorks collections recorded by the database profiler,
+        which must be enabled (e.g. with db.setProfilingLevel(1) in the mongo shell).
+
+        Args:
+            n_samples (int): max number of profiler entries to read
+
+        Returns:
+            [(str, str, dict, [(str, int)])]: the source, collection name, query and sort of
+                each query
+        """
+        names = [c.name for c in (self.lp.fireworks, self.lp.launches, self.lp.workflows)]
+        entries = self.lp.db['system.profile'].find(
+            {'ns': {'$in': ['{}.{}'.format(self.lp.db.name, n) for n in names]}},
+            sort=[('$natural', DESCENDING)], limit=n_samples)
+        queries = []
+        for entry in entries:
+            profiled = get_profiled_query(entry)
+            if profiled:
+                queries.append(('profile',) + profiled)
+        return queries
+
+    def advise(self, n_samples=100):
+        """
+        Explain the queries of FireWorks and of the profiler, once per query shape.
+
+        Args:
+            n_samples (int): max number of profiler entries to read
+
+        Returns:
+            [dict]: for each query with a collection scan or an in-memory sort, its source,
+                collection, query and sort, the problems found and the proposed indexes that
+                do not exist yet
+        """
+        advice = []
+        shapes = set()
+        for source, collection, query, sort in \
+                self.get_fireworks_queries() + self.get_profiled_queries(n_samples):
+            shape = (collection, json.dumps(get_query_shape(query), sort_keys=True),
+                     json.dumps(sort))
+            if shape in shapes:
+                continue
+            shapes.add(shape)
+            cursor = self.lp.db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                stages = get_plan_stages(cursor.explain())
+            except OperationFailure as e:
+                self.lp.m_logger.warning('Could not explain {} query {}: {}'.format(
+                    collection, query, e))
+                continue
+            problems = [p for p, _ in PLAN_PROBLEMS if p in stages]
+            if problems:
+                indexes = [keys for keys in get_index_keys(query, sort)
+                           if not self._has_index(collection, keys, sort)]
+                advice.append({'source': source, 'collection': collection, 'query': query,
+                               'sort': sort, 'problems': problems, 'indexes': indexes})
+        return advice
+
+    def create_indexes(self, advice, background=True):
+        """
+        Create the indexes proposed by advise().
+
+        Args:
+            advice ([dict]): the output of advise()
+            background (bool): build the indexes in the background
+
+        Returns:
+            [(str, [(str, int)])]: the collection name and keys of the created indexes
+        """
+        created = []
+        for a in advice:
+            for keys in a['indexes']:
+                if not self._has_index(a['collection'], keys, a['sort']):
+                    self.lp.db[a['collection']].create_index(keys, background=background)
+                    created.append((a['collection'], keys))
+        return created
+
+    def _get_metadata_samples(self, n_samples=100):
+        """
+        Returns:
+            dict: a value of each top-level metadata key of the latest workflows
+        """
+        samples = {}
+        for wf in self.lp.workflows.find({'metadata': {'$exists': True, '$ne': {}}},
+                                         {'metadata': 1}, sort=[('_id', DESCENDING)],
+                                         limit=n_samples):
+            for key, value in wf['metadata'].items():
+                if not isinstance(value, (dict, list)):
+                    samples.setdefault(key, value)
+        return samples
+
+    def _has_index(self, collection, keys, sort=None):
+        """
+        Returns:
+            bool: whether an index on the same fields exists, in the directions of the sort or
+                their reverse
+        """
+        sort_fields = [k for k, _ in sort or []]
+        directions = [d for k, d in keys if k in sort_fields]
+        for index in self.lp.db[collection].index_information().values():
+            index_keys = list(index['key'])
+            if [k for k, _ in index_keys] != [k for k, _ in keys]:
+                continue
+            index_directions = [d for k, d in index_keys if k in sort_fields]
+            if index_directions == directions or \
+                    index_directions == [-d for d in directions]:
+                return True
+        return False
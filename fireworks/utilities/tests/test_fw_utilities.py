@@ -0,0 +1,38 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from fireworks.utilities.fw_utilities import get_mongo_client
+
+__author__ = 'Anubhav Jain'
+
+
+class GetMongoClientTest(unittest.TestCase):
+
+    def test_shared_clients(self):
+        client = get_mongo_client('localhost', 27017, connect=False, appname='fw_test')
+        self.assertIs(get_mongo_client('localhost', 27017, connect=False, appname='fw_test'),
+                      client)
+        self.assertIsNot(get_mongo_client('localhost', 27018, connect=False, appname='fw_test'),
+                         client)
+
+        # a forked process does not reuse the clients of its parent
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(get_mongo_client('localhost', 27017, connect=False,
+                                              appname='fw_test'), client)
+
+        with mock.patch('fireworks.utilities.fw_utilities.MONGO_SHARE_CLIENTS', False):
+            self.assertIsNot(get_mongo_client('localhost', 27017, connect=False,
+                                              appname='fw_test'), client)
+
+
+if __name__ == '__main__':
+    unittest.main()
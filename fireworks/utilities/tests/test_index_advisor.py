@@ -0,0 +1,108 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+
+import datetime
+import unittest
+
+from fireworks import LaunchPad, Workflow, Firework, FWorker
+from fireworks.user_objects.firetasks.script_task import ScriptTask
+from fireworks.utilities.index_advisor import IndexAdvisor, get_index_keys, get_query_shape, \
+    get_plan_stages, get_profiled_query
+
+__author__ = 'Anubhav Jain'
+
+TESTDB_NAME = 'fireworks_unittest'
+
+
+class IndexAdvisorFunctionsTest(unittest.TestCase):
+
+    def test_get_index_keys(self):
+        fworker = FWorker(category=['a', 'b'])
+        query = dict(fworker.query, state='READY')
+        self.assertEqual(get_index_keys(query, [('spec._priority', -1)]),
+                         [[('_fworker', 1), ('_category', 1), ('state', 1),
+                           ('spec._priority', -1)]])
+        # equality, sort, range
+        self.assertEqual(get_index_keys({'$and': [{'metadata.x': 1}, {'updated_on': {'$gt': 0}}]},
+                                        [('_id', -1)]),
+                         [[('metadata.x', 1), ('_id', -1), ('updated_on', 1)]])
+        # one index per branch of a $or, on the fields of the array elements
+        cutoff = datetime.datetime(2026, 1, 1)
+        query = {'$or': [
+            {'state': 'RUNNING', 'state_updated_on': {'$lte': cutoff}},
+            {'state': 'RUNNING', 'state_updated_on': {'$exists': False},
+             'state_history': {'$elemMatch': {'state': 'RUNNING', 'updated_on': {'$lte': 'x'}}}}]}
+        self.assertEqual(get_index_keys(query),
+                         [[('state', 1), ('state_updated_on', 1)],
+                          [('state', 1), ('state_history.state', 1), ('state_updated_on', 1),
+                           ('state_history.updated_on', 1)]])
+        self.assertEqual(get_index_keys({}), [])
+
+    def test_get_query_shape(self):
+        self.assertEqual(get_query_shape({'fw_id': {'$in': [1, 2]}, '$or': [{'a': 1}, {'b': 2}]}),
+                         get_query_shape({'fw_id': {'$in': [3]}, '$or': [{'a': 3}, {'b': 4}]}))
+        self.assertNotEqual(get_query_shape({'fw_id': 1}), get_query_shape({'fw_id': {'$gt': 1}}))
+
+    def test_get_plan_stages(self):
+        explained = {'queryPlanner': {'winningPlan': {
+            'stage': 'SORT', 'inputStage': {
+                'stage': 'FETCH', 'inputStage': {
+                    'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}}}}
+        self.assertEqual(get_plan_stages(explained), ['SORT', 'FETCH', 'OR', 'IXSCAN', 'COLLSCAN'])
+
+    def test_get_profiled_query(self):
+        self.assertEqual(get_profiled_query({
+            'op': 'query', 'ns': 'fireworks.fireworks',
+            'command': {'find': 'fireworks', 'filter': {'state': 'READY'},
+                        'sort': {'spec._priority': -1}}}),
+            ('fireworks', {'state': 'READY'}, [('spec._priority', -1)]))
+        self.assertEqual(get_profiled_query({
+            'op': 'update', 'ns': 'fireworks.launches',
+            'command': {'q': {'launch_id': 1}, 'u': {'$set': {'state': 'RUNNING'}}}}),
+            ('launches', {'launch_id': 1}, None))
+        self.assertIsNone(get_profiled_query({'op': 'command', 'ns': 'fireworks.$cmd',
+                                              'command': {'ping': 1}}))
+
+
+class IndexAdvisorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.lp = None
+        try:
+            cls.lp = LaunchPad(name=TESTDB_NAME, strm_lvl='ERROR')
+            cls.lp.reset(password=None, require_password=False)
+        except Exception:
+            raise unittest.SkipTest('MongoDB is not running in localhost:27017! Skipping tests.')
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.lp:
+            cls.lp.connection.drop_database(TESTDB_NAME)
+
+    def test_advise(self):
+        ftask = ScriptTask.from_str('echo "lorem ipsum"')
+        self.lp.add_wf(Workflow([Firework(ftask)], metadata={'project': 'x'}))
+        advisor = IndexAdvisor(self.lp, FWorker(category='a'))
+
+        # the metadata lookups of the web GUI are not indexed by the tuneup
+        advice = advisor.advise(n_samples=0)
+        metadata_advice = [a for a in advice if a['source'] == 'GUI metadata']
+        self.assertEqual(len(metadata_advice), 1)
+        self.assertIn('COLLSCAN', metadata_advice[0]['problems'])
+        self.assertEqual(metadata_advice[0]['indexes'], [[('metadata.project', 1), ('_id', -1)]])
+        # the checkout and the stages of the lost run and reservation detection are indexed
+        sources = [a['source'] for a in advice]
+        for source in ('checkout', 'lost run fireworks', 'lost run launches lookup',
+                       'inconsistent runs', 'expired reservations lookup'):
+            self.assertIn(source, [q[0] for q in advisor.get_fireworks_queries()])
+            self.assertNotIn(source, sources)
+
+        self.assertIn(('workflows', [('metadata.project', 1), ('_id', -1)]),
+                      advisor.create_indexes(advice))
+        self.assertNotIn('GUI metadata', [a['source'] for a in advisor.advise(n_samples=0)])
+
+
+if __name__ == '__main__':
+    unittest.main()